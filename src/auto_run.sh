@@ -50,6 +50,152 @@ python btc.py --paras=paras-1
 # python btc_train.py --paras=paras_name
 # python btc_test.py --paras=paras_name
 # Same parameter as in Section 1
+# Add --resume to continue an interrupted training from
+# the newest weights/paras_name/checkpoint_*.h5
 
 # python btc_train.py --paras=paras-1
+# python btc_train.py --paras=paras-1 --resume
+
+# Train in data parallel by Horovod, add --workers=n to start n worker
+# processes on localhost, and --hosts=h1:2,h2:2 to run on several hosts,
+# weights_save_dir should be on a shared file system to resume training
+# python btc_train.py --paras=paras-1 --workers=2
 # python btc_test.py --paras=paras-1
+
+
+#
+# Section 3
+#
+# Benchmark latency of convolution factorizations on CPU
+# Command:
+# python btc_benchmark.py --paras=paras_name --conv_types=types
+# Parameters:
+# - paras: hyperparameters set in hyper_paras.json
+# - conv_types: comma separated list of "dense", "2plus1d" and "axial"
+
+# python btc_benchmark.py --paras=paras-1 --conv_types=dense,2plus1d,axial
+
+# Compare threads of TensorFlow session, the fastest setting can be
+# set as intra_op_threads and inter_op_threads in pre_paras.json,
+# or given to btc.py, btc_train.py and btc_test.py by
+# --intra_op_threads, --inter_op_threads and --cpu_affinity
+# python btc_benchmark.py --paras=paras-1 --mode=threads --intra=1,2,4,8 --inter=1,2
+
+
+#
+# Section 4
+#
+# Train and test several sets of hyperparameters in parallel,
+# dataset is loaded once and shared by all workers
+# Command:
+# python btc_sweep.py --paras=names --workers=n
+# Parameters:
+# - paras: comma separated hyperparameters sets in hyper_paras.json
+# - workers: number of parallel workers, CPU cores are divided
+#            equally among workers
+# Results of all sets are merged in results/sweep_res.csv
+
+# python btc_sweep.py --paras=paras-1,paras-2 --workers=2
+
+
+#
+# Section 5
+#
+# Search hyperparameters by successive halving
+# Command:
+# python btc_search.py --search=search_name --workers=n
+# Parameters:
+# - search: searching settings in search_paras.json
+# - workers: number of parallel workers
+# The best set is added into hyper_paras.json as search_name-best
+
+# python btc_search.py --search=search-1 --workers=1
+
+
+#
+# Section 6
+#
+# Export inference graph, batch normalization is folded into
+# dense layers and dropout is removed, predictions and latency
+# are compared with the original model
+# Command:
+# python btc_export.py --paras=paras_name --weights=last
+# Parameters:
+# - paras: hyperparameters set in hyper_paras.json
+# - weights: "last" or "best", default is test_weights in pre_paras.json
+# Frozen graph is saved in weights/paras_name/[weights]_frozen.pb
+
+# python btc_export.py --paras=paras-1 --weights=last
+
+
+#
+# Section 7
+#
+# Quantize model into int8 by ONNX Runtime, ranges of activations
+# are calibrated on calib_num samples of training set (pre_paras.json)
+# Command:
+# python btc_quantize.py --paras=paras_name --weights=last
+# Same parameters as in Section 6
+# Metrics of float and int8 model on testing set and their
+# differences are saved in results/paras_name/test_[weights]_quant.csv
+
+# python btc_quantize.py --paras=paras-1 --weights=last
+
+
+#
+# Section 8
+#
+# Predict by ONNX Runtime instead of Keras in testing, set
+#    "backend": "onnx"
+# in pre_paras.json, model is exported into weights/paras_name/[weights].onnx
+# at the first time. Compare predictions and latency of backends:
+# python btc_backends.py --paras=paras_name --backends=onnx
+
+# python btc_backends.py --paras=paras-1 --backends=onnx
+
+
+#
+# Section 9
+#
+# Prune model while fine-tuning, set in hyper_paras.json
+#    "init_weights": "paras-1/last.h5"
+#    "prune_mode": "channel" (or "magnitude")
+#    "prune_schedule": [[0, 0.0], [4, 0.25], [8, 0.5], [12, 0.75]]
+# Weights at the end of each sparsity are saved as
+# weights/paras_name/pruned_[sparsity].h5, then export them
+# and compare parameters, latency and accuracy:
+# python btc_prune.py --paras=paras_name
+# Report is saved in results/paras_name/prune_report.csv
+
+# python btc_train.py --paras=paras-prune
+# python btc_prune.py --paras=paras-prune
+
+
+#
+# Section 10
+#
+# Predict unlabelled raw images, model is loaded once, images in
+# the directory (and its sub-directories) are preprocessed in
+# processes_num processes and predicted batch by batch, masks
+# ("seg" in names) in the same folder are used if "is_mask" is true.
+# Probabilities of each image are saved in CSV file:
+# python btc_predict.py --paras=paras_name --input=dir --output=csv_path
+
+# python btc_predict.py --paras=paras-1 --input=../data/New --output=../results/paras-1/new_pred.csv
+
+
+#
+# Section 11
+#
+# Serve model on local HTTP server, weights are loaded once,
+# images are preprocessed in processes_num processes, concurrent
+# requests are predicted in micro-batches, set in pre_paras.json
+#    "server_host", "server_port", "max_batch_size", "max_wait_ms"
+# Endpoints: POST /predict with JSON {"path": image_path} or bytes
+# of NIfTI file, GET /metrics for latency percentiles and queue depth.
+# python btc_server.py --paras=paras_name
+# Generate load from another terminal:
+# python btc_loadgen.py --input=dir --requests=64 --concurrency=8
+
+# python btc_server.py --paras=paras-1 --max_batch_size=4 --max_wait_ms=50
+# python btc_loadgen.py --input=../data/New --requests=64 --concurrency=8
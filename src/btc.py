@@ -22,13 +22,12 @@ from __future__ import print_function
 import os
 import json
 import argparse
-from btc_test import BTCTest
-from btc_train import BTCTrain
-from btc_dataset import BTCDataset
-from btc_preprocess import BTCPreprocess
+from btc_session import (session_paras,
+                         add_session_args,
+                         limit_omp_threads)
 
 
-def main(hyper_paras_name):
+def main(hyper_paras_name, resume=False, args=None):
     '''MAIN
 
         Main process of Brain Tumor Classification.
@@ -41,6 +40,9 @@ def main(hyper_paras_name):
 
         - hyper_paras_name: string, the name of hyperparanters set,
                             which can be found in hyper_paras.json.
+        - resume: boolean, if True, continue training from checkpoint.
+        - args: argparse Namespace, session settings from command
+                line which override pre_paras.json. Default is None.
 
     '''
 
@@ -68,6 +70,15 @@ def main(hyper_paras_name):
     logs_save_dir = os.path.join(parent_dir, pre_paras["logs_save_dir"])
     # Set directory to save metrics
     results_save_dir = os.path.join(parent_dir, pre_paras["results_save_dir"])
+    # Threads and CPU affinity of TensorFlow session
+    sess_paras = session_paras(pre_paras, args)
+
+    # OpenMP threads are limited before TensorFlow is imported
+    limit_omp_threads(sess_paras["cpu_affinity"])
+    from btc_test import BTCTest
+    from btc_train import BTCTrain
+    from btc_dataset import load_dataset
+    from btc_preprocess import BTCPreprocess
 
     # Preprocessing to enhance tumor regions
     prep = BTCPreprocess([hgg_in_dir, lgg_in_dir],
@@ -75,28 +86,20 @@ def main(hyper_paras_name):
                          pre_paras["volume_type"])
     prep.run(is_mask=pre_paras["is_mask"],
              non_mask_coeff=pre_paras["non_mask_coeff"],
-             processes=pre_paras["processes_num"])
+             processes=pre_paras["processes_num"],
+             save_mask=pre_paras["save_mask"])
 
     # Split dataset
-    data = BTCDataset(hgg_out_dir, lgg_out_dir,
-                      volume_type=pre_paras["volume_type"],
-                      train_prop=pre_paras["train_prop"],
-                      valid_prop=pre_paras["valid_prop"],
-                      random_state=pre_paras["random_state"],
-                      pre_trainset_path=pre_paras["pre_trainset_path"],
-                      pre_validset_path=pre_paras["pre_validset_path"],
-                      pre_testset_path=pre_paras["pre_testset_path"],
-                      data_format=pre_paras["data_format"])
-    data.run(pre_split=pre_paras["pre_split"],
-             save_split=pre_paras["save_split"],
-             save_split_dir=pre_paras["save_split_dir"])
+    data = load_dataset(hgg_out_dir, lgg_out_dir, pre_paras)
 
     # Training the model using enhanced tumor regions
     train = BTCTrain(paras_name=hyper_paras_name,
                      paras_json_path=pre_paras["paras_json_path"],
                      weights_save_dir=weights_save_dir,
                      logs_save_dir=logs_save_dir,
-                     save_best_weights=pre_paras["save_best_weights"])
+                     save_best_weights=pre_paras["save_best_weights"],
+                     resume=resume,
+                     session_paras=sess_paras)
     train.run(data)
 
     # Testing the model
@@ -105,7 +108,10 @@ def main(hyper_paras_name):
                    weights_save_dir=weights_save_dir,
                    results_save_dir=results_save_dir,
                    test_weights=pre_paras["test_weights"],
-                   pred_trainset=pre_paras["pred_trainset"])
+                   pred_trainset=pre_paras["pred_trainset"],
+                   session_paras=sess_paras,
+                   reuse_pred=pre_paras["reuse_pred"],
+                   backend=pre_paras["backend"])
     test.run(data)
 
     return
@@ -122,6 +128,10 @@ if __name__ == "__main__":
     help_str = "Select a set of hyper-parameters in hyper_paras.json"
     parser.add_argument("--paras", action="store", default="paras-1",
                         dest="hyper_paras_name", help=help_str)
+    help_str = "Continue training from the last checkpoint."
+    parser.add_argument("--resume", action="store_true", default=False,
+                        dest="resume", help=help_str)
+    add_session_args(parser)
 
     args = parser.parse_args()
-    main(args.hyper_paras_name)
+    main(args.hyper_paras_name, args.resume, args)
@@ -0,0 +1,486 @@
+# Brain Tumor Classification
+# Inference backends of 3D Multi-Scale CNN.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+#     ,,,         ,,,
+#   ;"   ';     ;'   ",
+#   ;  @.ss$$$$$$s.@  ;
+#   `s$$$$$$$$$$$$$$$'
+#   $$$$$$$$$$$$$$$$$$
+#  $$$$P""Y$$$Y""W$$$$$
+#  $$$$  p"$$$"q  $$$$$
+#  $$$$  .$$$$$.  $$$$'
+#   $$$DaU$$O$$DaU$$$'
+#    '$$$$'.^.'$$$$'
+#       '&$$$$$&'
+
+
+from __future__ import print_function
+
+
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+from btc_session import (set_session,
+                         set_affinity,
+                         session_paras,
+                         add_session_args)
+
+
+# Names of backends, "keras" predicts by Keras model,
+# "onnx" predicts by ONNX Runtime on exported model
+BACKENDS = ["keras", "onnx"]
+
+
+def models_paras(paras):
+    '''MODELS_PARAS
+
+        Generate arguments of BTCModels to build model for
+        inference. Inputs are patches if model is trained
+        on patches.
+
+        Input:
+        ------
+
+        - paras: dictionary, a set in hyper_paras.json.
+
+        Output:
+        -------
+
+        - A dictionary of arguments.
+
+    '''
+
+    input_shape = paras["input_shape"]
+    if paras["patch_shape"]:
+        input_shape = paras["patch_shape"] + input_shape[3:]
+
+    return {"model_name": paras["model_name"],
+            "input_shape": input_shape,
+            "pooling": paras["pooling"],
+            "width_mult": paras["width_mult"],
+            "depth_mult": paras["depth_mult"],
+            "scales": paras["scales"],
+            "conv_type": paras["conv_type"],
+            "global_pool": paras["global_pool"],
+            "early_exit": paras["early_exit"]}
+
+
+# Interface of inference backends, which predict like Keras
+# model, subclasses set self.output_shape and implement _run
+class InferenceModel(object):
+
+    def _run(self, xs):
+        '''_RUN
+
+            Predict one batch.
+
+            Input:
+            ------
+
+            - xs: list of numpy ndarray, one for each input.
+
+            Output:
+            -------
+
+            - list of numpy ndarray, one for each output.
+
+        '''
+
+        raise NotImplementedError
+
+    def predict_on_batch(self, x):
+        '''PREDICT_ON_BATCH
+
+            Predict one batch, see predict.
+
+        '''
+
+        preds = self._run(x if isinstance(x, list) else [x])
+        return preds if len(preds) > 1 else preds[0]
+
+    def predict(self, x, batch_size=1):
+        '''PREDICT
+
+            Predict inputs in batches.
+
+            Inputs:
+            -------
+
+            - x: numpy ndarray, or a list of it for multiple inputs.
+            - batch_size: int, default is 1.
+
+            Output:
+            -------
+
+            - numpy ndarray, or a list of it for multiple outputs.
+
+        '''
+
+        xs = x if isinstance(x, list) else [x]
+        preds = None
+        for start in range(0, len(xs[0]), batch_size):
+            batch = self._run([array[start:start + batch_size] for array in xs])
+            preds = [[] for _ in batch] if preds is None else preds
+            for pred, batch_pred in zip(preds, batch):
+                pred.append(batch_pred)
+
+        preds = [np.concatenate(pred) for pred in preds]
+        return preds if len(preds) > 1 else preds[0]
+
+
+class KerasModel(InferenceModel):
+
+    def __init__(self, paras, weights_path=None, session_paras=None):
+        '''__INIT__
+
+            Build Keras model and load its weights.
+
+            Inputs:
+            -------
+
+            - paras: dictionary, a set in hyper_paras.json.
+            - weights_path: string, path of weights file, default
+                            is None, which keeps initial weights.
+            - session_paras: dictionary, threads and CPU affinity
+                             of TensorFlow session, see set_session
+                             in btc_session.py. Default is None.
+
+        '''
+
+        from btc_models import BTCModels
+
+        if session_paras is not None:
+            set_session(**session_paras)
+
+        self.model = BTCModels(**models_paras(paras)).model
+        if weights_path is not None:
+            self.model.load_weights(weights_path)
+
+        # Shape of fc3 if model has early exit
+        self.output_shape = self.model.output_shape
+        if isinstance(self.output_shape, list):
+            self.output_shape = self.output_shape[0]
+
+        return
+
+    def _run(self, xs):
+        preds = self.model.predict_on_batch(xs if len(xs) > 1 else xs[0])
+        return preds if isinstance(preds, list) else [preds]
+
+
+class OnnxModel(InferenceModel):
+
+    def __init__(self, onnx_path, intra_op_threads=0, inter_op_threads=0):
+        '''__INIT__
+
+            Load ONNX model in ONNX Runtime on CPU.
+
+            Inputs:
+            -------
+
+            - onnx_path: string, path of ONNX model.
+            - intra_op_threads: int, threads within one operation,
+                                0 lets ONNX Runtime decide.
+            - inter_op_threads: int, operations run in parallel,
+                                0 lets ONNX Runtime decide.
+
+        '''
+
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        self.sess = ort.InferenceSession(onnx_path, options,
+                                         providers=["CPUExecutionProvider"])
+        self.inputs = [i.name for i in self.sess.get_inputs()]
+        self.outputs = [o.name for o in self.sess.get_outputs()]
+        self.output_shape = self.sess.get_outputs()[0].shape
+
+        return
+
+    def _run(self, xs):
+        feed = {name: array.astype(np.float32)
+                for name, array in zip(self.inputs, xs)}
+        return self.sess.run(self.outputs, feed)
+
+
+def load_backend(backend,
+                 paras_name,
+                 paras_json_path,
+                 weights_save_dir,
+                 weights="last",
+                 session_paras=None):
+    '''LOAD_BACKEND
+
+        Load trained model in given backend. For "onnx", model
+        is exported into [weights].onnx (see btc_export.py) if
+        it is not exist or older than weights, which is the only
+        step that imports Keras.
+
+        Inputs:
+        -------
+
+        - backend: string, one of BACKENDS.
+        - paras_name: string, name of hyperparameters set,
+                      can be found in hyper_paras.json.
+        - paras_json_path: string, path of "hyper_paras.json".
+        - weights_save_dir: string, directory path where saves
+                            trained model.
+        - weights: string, "last" or "best" weights.
+        - session_paras: dictionary, threads and CPU affinity,
+                         see set_session in btc_session.py.
+                         Default is None.
+
+        Output:
+        -------
+
+        - An InferenceModel instance.
+
+    '''
+
+    paras = json.load(open(paras_json_path))[paras_name]
+    weights_path = os.path.join(weights_save_dir, paras_name, weights + ".h5")
+
+    if backend == "keras":
+        return KerasModel(paras, weights_path, session_paras)
+    elif backend != "onnx":
+        raise ValueError("Unknown backend: " + backend)
+
+    onnx_path = os.path.splitext(weights_path)[0] + ".onnx"
+    if not os.path.isfile(onnx_path) or \
+       os.path.getmtime(onnx_path) < os.path.getmtime(weights_path):
+        from btc_export import BTCExport, export_onnx
+
+        export = BTCExport(paras_name=paras_name,
+                           paras_json_path=paras_json_path,
+                           weights_save_dir=weights_save_dir,
+                           export_weights=weights,
+                           session_paras=session_paras)
+        export.run()
+        export_onnx(export.pb_path, onnx_path)
+        print("ONNX model is saved in " + onnx_path)
+
+    session_paras = session_paras or {}
+    set_affinity(session_paras.get("cpu_affinity"))
+    return OnnxModel(onnx_path,
+                     session_paras.get("intra_op_threads", 0),
+                     session_paras.get("inter_op_threads", 0))
+
+
+def predict_volumes(model, x, batch_size=1,
+                    patch_shape=None, patch_stride=None):
+    '''PREDICT_VOLUMES
+
+        Predict volumes by model of any backend, by sliding
+        windows if model is trained on patches. Only predictions
+        of fc3 are kept if model has early exit.
+
+        Inputs:
+        -------
+
+        - model: Keras Models or InferenceModel instance.
+        - x: numpy ndarray in shape [n, 112, 96, 96, 1], images.
+        - batch_size: int, batch size in prediction, default is 1.
+        - patch_shape, patch_stride: int list, shape and stride of
+                                     windows, default is None,
+                                     which means model predicts
+                                     whole volumes.
+
+        Output:
+        -------
+
+        - numpy ndarray in shape [n, 2], probabilities of classes.
+
+    '''
+
+    if patch_shape:
+        from btc_patches import sliding_window_predict
+        pred = sliding_window_predict(model, x, patch_shape,
+                                      patch_stride, batch_size)
+    else:
+        pred = model.predict(x, batch_size)
+    return pred[0] if isinstance(pred, list) else pred
+
+
+def median_latency(model, x, repeats=10, **kwargs):
+    '''MEDIAN_LATENCY
+
+        Median latency of predicting the first sample of x in
+        milliseconds, the first prediction is not timed.
+        Other arguments are passed to predict_volumes.
+
+    '''
+
+    predict_volumes(model, x[:1], **kwargs)
+    latency = []
+    for _ in range(repeats):
+        start = time.time()
+        predict_volumes(model, x[:1], **kwargs)
+        latency.append((time.time() - start) * 1000)
+    return float(np.median(latency))
+
+
+def save_random_weights(paras, weights_path, seed=0):
+    '''SAVE_RANDOM_WEIGHTS
+
+        Save weights of model which is randomly initialized,
+        so that backends can be compared without trained model.
+        Parameters and moving statistics of batch normalization
+        are also randomized, otherwise folding them (see
+        btc_export.py) is not checked.
+
+        Inputs:
+        -------
+
+        - paras: dictionary, a set in hyper_paras.json.
+        - weights_path: string, path of output weights file.
+        - seed: int, random seed, default is 0.
+
+    '''
+
+    from keras import backend as K
+
+    rng = np.random.RandomState(seed)
+    model = KerasModel(paras).model
+    for layer in model.layers:
+        if layer.__class__.__name__ != "BatchNormalization":
+            continue
+        values = []
+        for weight, value in zip(layer.weights, layer.get_weights()):
+            if "gamma" in weight.name or "moving_variance" in weight.name:
+                values.append(rng.uniform(0.5, 1.5, value.shape))
+            else:
+                values.append(rng.normal(0.0, 0.1, value.shape))
+        layer.set_weights(values)
+
+    weights_dir = os.path.dirname(weights_path)
+    if not os.path.isdir(weights_dir):
+        os.makedirs(weights_dir)
+    model.save_weights(weights_path)
+    K.clear_session()
+
+    return
+
+
+def parity(paras_name,
+           paras_json_path,
+           weights_save_dir,
+           weights="last",
+           backends=BACKENDS,
+           samples_num=8,
+           repeats=10,
+           tolerance=1e-4,
+           session_paras=None):
+    '''PARITY
+
+        Compare predictions of each backend with Keras model
+        on random inputs, and measure median latency of one
+        sample. Each backend is loaded in turn, see load_backend.
+
+        Inputs:
+        -------
+
+        - paras_name, paras_json_path, weights_save_dir, weights,
+          session_paras: see load_backend. If weights is None,
+          randomly initialized weights are saved in a temporary
+          directory instead of weights_save_dir.
+        - backends: string list, backends to compare.
+        - samples_num: int, the number of random inputs.
+        - repeats: int, the number of timed runs.
+        - tolerance: float, the maximum absolute difference
+                     of predictions.
+
+        Output:
+        -------
+
+        - pandas DataFrame, max_diff and latency_ms of each backend.
+
+    '''
+
+    paras = json.load(open(paras_json_path))[paras_name]
+    input_shape = models_paras(paras)["input_shape"]
+    x = np.random.RandomState(0).randn(
+        *([samples_num] + input_shape)).astype(np.float32)
+
+    temp_dir = None
+    if weights is None:
+        temp_dir = tempfile.mkdtemp()
+        weights_save_dir, weights = temp_dir, "random"
+        save_random_weights(paras, os.path.join(weights_save_dir, paras_name,
+                                                weights + ".h5"))
+
+    rows, ref = [], None
+    try:
+        for backend in ["keras"] + [b for b in backends if b != "keras"]:
+            model = load_backend(backend, paras_name, paras_json_path,
+                                 weights_save_dir, weights, session_paras)
+            pred = model.predict(x, 1)
+            pred = pred[0] if isinstance(pred, list) else pred
+            ref = pred if ref is None else ref
+
+            model.predict(x[:1], 1)
+            latency = []
+            for _ in range(repeats):
+                start = time.time()
+                model.predict(x[:1], 1)
+                latency.append((time.time() - start) * 1000)
+
+            rows.append({"backend": backend,
+                         "max_diff": float(np.max(np.abs(pred - ref))),
+                         "latency_ms": float(np.median(latency))})
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+
+    res_df = pd.DataFrame(rows)[["backend", "max_diff", "latency_ms"]]
+    res_df["speedup"] = res_df["latency_ms"][0] / res_df["latency_ms"]
+    print(res_df.to_string(index=False))
+    if res_df["max_diff"].max() > tolerance:
+        raise RuntimeError("Predictions of backends differ from Keras.")
+
+    return res_df
+
+
+if __name__ == "__main__":
+
+    # Command line
+    # python btc_backends.py --paras=paras-1 --weights=last --backends=keras,onnx
+    # python btc_backends.py --paras=paras-1 --random
+
+    parser = argparse.ArgumentParser()
+
+    help_str = "Select a set of hyper-parameters in hyper_paras.json."
+    parser.add_argument("--paras", action="store", default="paras-1",
+                        dest="hyper_paras_name", help=help_str)
+    help_str = "Weights to compare, last or best."
+    parser.add_argument("--weights", action="store", default=None,
+                        choices=["last", "best"],
+                        dest="weights", help=help_str)
+    help_str = "Comma separated backends to compare with Keras."
+    parser.add_argument("--backends", action="store", default="onnx",
+                        dest="backends", help=help_str)
+    help_str = "Compare on randomly initialized model, no weights needed."
+    parser.add_argument("--random", action="store_true", default=False,
+                        dest="random", help=help_str)
+    add_session_args(parser)
+
+    args = parser.parse_args()
+    pre_paras = json.load(open("pre_paras.json"))
+    parent_dir = os.path.dirname(os.getcwd())
+    parity(paras_name=args.hyper_paras_name,
+           paras_json_path=pre_paras["paras_json_path"],
+           weights_save_dir=os.path.join(parent_dir,
+                                         pre_paras["weights_save_dir"]),
+           weights=None if args.random else
+           args.weights or pre_paras["test_weights"],
+           backends=args.backends.split(","),
+           session_paras=session_paras(pre_paras, args))
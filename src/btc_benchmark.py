@@ -0,0 +1,396 @@
+# Brain Tumor Classification
+# Benchmark latency of 3D Multi-Scale CNN on CPU.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+#     ,,,         ,,,
+#   ;"   ';     ;'   ",
+#   ;  @.ss$$$$$$s.@  ;
+#   `s$$$$$$$$$$$$$$$'
+#   $$$$$$$$$$$$$$$$$$
+#  $$$$P""Y$$$Y""W$$$$$
+#  $$$$  p"$$$"q  $$$$$
+#  $$$$  .$$$$$.  $$$$'
+#   $$$DaU$$O$$DaU$$$'
+#    '$$$$'.^.'$$$$'
+#       '&$$$$$&'
+
+
+from __future__ import print_function
+
+
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+from keras import backend as K
+from keras.layers import Input, Conv3D
+from keras.models import Model
+from btc_models import BTCModels
+from btc_train import BTCTrain
+from btc_session import set_session
+
+
+class BTCBenchmark(object):
+
+    def __init__(self,
+                 paras_name,
+                 paras_json_path,
+                 batch_size=1,
+                 repeats=10,
+                 warmup=2):
+        '''__INIT__
+
+            Set configurations before benchmarking.
+
+            Inputs:
+            -------
+
+            - paras_name: string, name of hyperparameters set,
+                          can be found in hyper_paras.json.
+            - paras_json_path: string, path of file which provides
+                               hyperparamters, "hyper_paras.json"
+                               in this project.
+            - batch_size: int, the number of samples in each batch.
+                          Default is 1.
+            - repeats: int, the number of timed runs, median latency
+                       is reported. Default is 10.
+            - warmup: int, the number of untimed runs before timing.
+                      Default is 2.
+
+        '''
+
+        self.paras = BTCTrain.load_paras(paras_json_path, paras_name)
+        self.batch_size = batch_size
+        self.repeats = repeats
+        self.warmup = warmup
+
+        return
+
+    def _models_paras(self, conv_type):
+        '''_MODELS_PARAS
+
+            Generate arguments of BTCModels from hyperparameters.
+
+            Input:
+            ------
+
+            - conv_type: string, factorization of convolutional layers.
+
+            Output:
+            -------
+
+            - A dictionary of arguments.
+
+        '''
+
+        return {"input_shape": self.paras["input_shape"],
+                "pooling": self.paras["pooling"],
+                "l2_coeff": self.paras["l2_coeff"],
+                "drop_rate": self.paras["drop_rate"],
+                "bn_momentum": self.paras["bn_momentum"],
+                "initializer": self.paras["initializer"],
+                "width_mult": self.paras["width_mult"],
+                "depth_mult": self.paras["depth_mult"],
+                "scales": self.paras["scales"],
+                "conv_type": conv_type,
+                "global_pool": self.paras["global_pool"]}
+
+    def _time(self, fcn):
+        '''_TIME
+
+            Measure median latency of given function.
+
+            Input:
+            ------
+
+            - fcn: function without arguments to be timed.
+
+            Output:
+            -------
+
+            - float, median latency in milliseconds.
+
+        '''
+
+        for _ in range(self.warmup):
+            fcn()
+
+        latency = []
+        for _ in range(self.repeats):
+            start = time.time()
+            fcn()
+            latency.append((time.time() - start) * 1000)
+
+        return float(np.median(latency))
+
+    def layers(self, conv_types):
+        '''LAYERS
+
+            Measure forward latency of each convolutional layer
+            in pyramid model with different factorizations.
+            Each layer is built alone and fed with random input
+            in the same shape as in the whole model.
+
+            Input:
+            ------
+
+            - conv_types: string list, factorizations to compare.
+
+            Output:
+            -------
+
+            - pandas DataFrame, one row for each layer and
+              factorization.
+
+        '''
+
+        # Obtain configurations of convolutional layers
+        # from the model with dense kernels
+        model = BTCModels(**self._models_paras("dense")).model
+        layers = [[layer.name, layer.input_shape[1:], layer.filters,
+                   layer.kernel_size[0], layer.strides]
+                  for layer in model.layers if isinstance(layer, Conv3D)]
+        K.clear_session()
+
+        rows = []
+        for conv_type in conv_types:
+            for name, input_shape, filter_num, filter_size, strides in layers:
+                # Build the layer alone
+                btc = BTCModels(model_name=None, **self._models_paras(conv_type))
+                inputs = Input(shape=input_shape)
+                outputs = btc._conv3d(inputs, filter_num, filter_size,
+                                      strides=strides, name=name)
+                layer_model = Model(inputs=inputs, outputs=outputs)
+
+                x = np.random.randn(*([self.batch_size] + list(input_shape)))
+                latency = self._time(lambda: layer_model.predict_on_batch(x))
+                rows.append({"layer": name,
+                             "conv_type": conv_type,
+                             "params": layer_model.count_params(),
+                             "gflops": BTCModels.count_flops(layer_model) / 1e9,
+                             "latency_ms": latency})
+                K.clear_session()
+
+        return pd.DataFrame(rows)[["layer", "conv_type", "params",
+                                   "gflops", "latency_ms"]]
+
+    def models(self, conv_types):
+        '''MODELS
+
+            Measure latency of whole model with different
+            factorizations, in forward pass (inference) and
+            in one training step.
+
+            Input:
+            ------
+
+            - conv_types: string list, factorizations to compare.
+
+            Output:
+            -------
+
+            - pandas DataFrame, one row for each factorization.
+
+        '''
+
+        input_shape = self.paras["input_shape"]
+        x = np.random.randn(*([self.batch_size] + input_shape))
+        y = np.eye(2)[np.random.randint(0, 2, self.batch_size)]
+
+        rows = []
+        for conv_type in conv_types:
+            model = BTCModels(**self._models_paras(conv_type)).model
+            model.compile(loss="categorical_crossentropy",
+                          optimizer="adam", metrics=["accuracy"])
+            rows.append({"conv_type": conv_type,
+                         "params": model.count_params(),
+                         "gflops": BTCModels.count_flops(model) / 1e9,
+                         "predict_ms": self._time(
+                             lambda: model.predict_on_batch(x)),
+                         "train_ms": self._time(
+                             lambda: model.train_on_batch(x, y))})
+            K.clear_session()
+
+        return pd.DataFrame(rows)[["conv_type", "params", "gflops",
+                                   "predict_ms", "train_ms"]]
+
+    def threads(self, intra_list, inter_list, cpu_affinity=None):
+        '''THREADS
+
+            Measure latency of whole model with the convolution
+            type in hyperparameters set, under different threads
+            of TensorFlow session.
+
+            Inputs:
+            -------
+
+            - intra_list: int list, threads within one operation.
+            - inter_list: int list, operations run in parallel.
+            - cpu_affinity: None, int list or string like "0-3,8",
+                            cores to run on. Default is None.
+
+            Output:
+            -------
+
+            - pandas DataFrame, one row for each setting.
+
+        '''
+
+        input_shape = self.paras["input_shape"]
+        x = np.random.randn(*([self.batch_size] + input_shape))
+        y = np.eye(2)[np.random.randint(0, 2, self.batch_size)]
+
+        rows = []
+        for intra in intra_list:
+            for inter in inter_list:
+                set_session(intra, inter, cpu_affinity)
+                model = BTCModels(**self._models_paras(
+                    self.paras["conv_type"])).model
+                model.compile(loss="categorical_crossentropy",
+                              optimizer="adam", metrics=["accuracy"])
+                train_ms = self._time(lambda: model.train_on_batch(x, y))
+                row = {"intra_op_threads": intra,
+                       "inter_op_threads": inter,
+                       "predict_ms": self._time(
+                           lambda: model.predict_on_batch(x)),
+                       "train_ms": train_ms,
+                       "samples_per_sec": self.batch_size * 1000 / train_ms}
+                print(row)
+                rows.append(row)
+                K.clear_session()
+
+        return pd.DataFrame(rows)[["intra_op_threads", "inter_op_threads",
+                                   "predict_ms", "train_ms",
+                                   "samples_per_sec"]]
+
+    def run_threads(self, intra_list, inter_list,
+                    cpu_affinity=None, output_prefix=None):
+        '''RUN_THREADS
+
+            Sweep threads of TensorFlow session and report
+            the fastest setting for training.
+
+            Inputs:
+            -------
+
+            - intra_list: int list, threads within one operation.
+            - inter_list: int list, operations run in parallel.
+            - cpu_affinity: None, int list or string like "0-3,8",
+                            cores to run on. Default is None.
+            - output_prefix: string, if given, results are saved in
+                             [output_prefix]_threads.csv.
+
+        '''
+
+        print("\nBenchmarking threads on batch size {}.\n".format(
+              self.batch_size))
+
+        threads_df = self.threads(intra_list, inter_list, cpu_affinity)
+        print(threads_df.to_string(index=False))
+
+        best = threads_df.loc[threads_df["train_ms"].idxmin()]
+        print("\nFastest training: intra_op_threads {0}, "
+              "inter_op_threads {1}".format(int(best["intra_op_threads"]),
+                                            int(best["inter_op_threads"])))
+
+        if output_prefix is not None:
+            threads_df.to_csv(output_prefix + "_threads.csv", index=False)
+
+        return
+
+    def run(self, conv_types, output_prefix=None):
+        '''RUN
+
+            Compare per-layer and whole-model latency of
+            factorizations against dense kernels.
+
+            Inputs:
+            -------
+
+            - conv_types: string list, factorizations to compare.
+            - output_prefix: string, if given, results are saved in
+                             [output_prefix]_layers.csv and
+                             [output_prefix]_models.csv.
+
+        '''
+
+        print("\nBenchmarking convolutions on batch size {}.\n".format(
+              self.batch_size))
+
+        layers_df = self.layers(conv_types)
+        models_df = self.models(conv_types)
+
+        # Speedup is relative to dense kernels
+        if "dense" in conv_types:
+            dense = layers_df[layers_df["conv_type"] == "dense"]
+            dense = dense.set_index("layer")["latency_ms"]
+            layers_df["speedup"] = layers_df["layer"].map(dense) / \
+                layers_df["latency_ms"]
+            dense = models_df.set_index("conv_type").loc["dense"]
+            models_df["predict_speedup"] = dense["predict_ms"] / \
+                models_df["predict_ms"]
+            models_df["train_speedup"] = dense["train_ms"] / \
+                models_df["train_ms"]
+
+        print(layers_df.to_string(index=False))
+        print()
+        print(models_df.to_string(index=False))
+
+        if output_prefix is not None:
+            layers_df.to_csv(output_prefix + "_layers.csv", index=False)
+            models_df.to_csv(output_prefix + "_models.csv", index=False)
+
+        return
+
+
+if __name__ == "__main__":
+
+    # Command line
+    # python btc_benchmark.py --paras=paras-1 --conv_types=dense,2plus1d,axial
+    # python btc_benchmark.py --paras=paras-1 --mode=threads --intra=1,2,4,8 --inter=1,2
+
+    parser = argparse.ArgumentParser()
+
+    help_str = "Select a set of hyper-parameters in hyper_paras.json."
+    parser.add_argument("--paras", action="store", default="paras-1",
+                        dest="hyper_paras_name", help=help_str)
+    help_str = "Compare convolution types (conv) or session threads (threads)."
+    parser.add_argument("--mode", action="store", default="conv",
+                        choices=["conv", "threads"],
+                        dest="mode", help=help_str)
+    help_str = "Comma separated convolution types to compare."
+    parser.add_argument("--conv_types", action="store",
+                        default="dense,2plus1d,axial",
+                        dest="conv_types", help=help_str)
+    help_str = "Comma separated intra-op threads to compare."
+    parser.add_argument("--intra", action="store", default="1,2,4,8",
+                        dest="intra", help=help_str)
+    help_str = "Comma separated inter-op threads to compare."
+    parser.add_argument("--inter", action="store", default="1,2",
+                        dest="inter", help=help_str)
+    help_str = "Cores to run on, such as 0-3,8."
+    parser.add_argument("--cpu_affinity", action="store", default=None,
+                        dest="cpu_affinity", help=help_str)
+    help_str = "Batch size of random inputs."
+    parser.add_argument("--batch_size", action="store", type=int,
+                        default=1, dest="batch_size", help=help_str)
+    help_str = "Number of timed runs."
+    parser.add_argument("--repeats", action="store", type=int,
+                        default=10, dest="repeats", help=help_str)
+    help_str = "Prefix of csv files to save results."
+    parser.add_argument("--output", action="store", default=None,
+                        dest="output_prefix", help=help_str)
+
+    args = parser.parse_args()
+    bench = BTCBenchmark(paras_name=args.hyper_paras_name,
+                         paras_json_path="hyper_paras.json",
+                         batch_size=args.batch_size,
+                         repeats=args.repeats)
+    if args.mode == "threads":
+        bench.run_threads([int(n) for n in args.intra.split(",")],
+                          [int(n) for n in args.inter.split(",")],
+                          args.cpu_affinity, args.output_prefix)
+    else:
+        bench.run(args.conv_types.split(","), args.output_prefix)
@@ -0,0 +1,188 @@
+# Brain Tumor Classification
+# Cache outputs of convolutional layers to train dense layers.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+#     ,,,         ,,,
+#   ;"   ';     ;'   ",
+#   ;  @.ss$$$$$$s.@  ;
+#   `s$$$$$$$$$$$$$$$'
+#   $$$$$$$$$$$$$$$$$$
+#  $$$$P""Y$$$Y""W$$$$$
+#  $$$$  p"$$$"q  $$$$$
+#  $$$$  .$$$$$.  $$$$'
+#   $$$DaU$$O$$DaU$$$'
+#    '$$$$'.^.'$$$$'
+#       '&$$$$$&'
+
+
+
+from __future__ import print_function
+
+
+import os
+import json
+import numpy as np
+
+
+class FeatureCache(object):
+
+    # Sets to be cached
+    SETS = ["train", "valid", "test"]
+
+    def __init__(self, cache_dir, scales):
+        '''__INIT__
+
+            Outputs of scales computed by convolutional layers
+            of a trained model, saved as [set]_scale[n].npy in
+            float16, with subjects' IDs of each set saved in
+            [set]_ids.json. Attributes are the same as BTCDataset, but
+            each x is a list of arrays, one for each scale:
+            - train_x, train_y
+            - valid_x, valid_y
+            - test_x, test_y
+
+            Inputs:
+            -------
+
+            - cache_dir: string, directory of cached outputs.
+            - scales: int list, scales to be cached.
+
+        '''
+
+        self.cache_dir = cache_dir
+        self.scales = sorted(scales)
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        return
+
+    def _path(self, dataset, scale):
+        return os.path.join(self.cache_dir,
+                            "{0}_scale{1}.npy".format(dataset, scale))
+
+    def _ids_path(self, dataset):
+        return os.path.join(self.cache_dir, "{}_ids.json".format(dataset))
+
+    def _load_ids(self, dataset):
+        path = self._ids_path(dataset)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def missing(self, data, weights_path):
+        '''MISSING
+
+            Find scales whose outputs are not cached, or
+            cached before weights are changed, or cached
+            from different subjects. All scales are computed
+            if subjects of any set are changed.
+
+            Inputs:
+            -------
+
+            - data: an BTCDataset instance.
+            - weights_path: string, weights of convolutional layers.
+
+            Output:
+            -------
+
+            - int list, scales to be computed.
+
+        '''
+
+        weights_time = os.path.getmtime(weights_path)
+
+        for dataset in self.SETS:
+            ids = getattr(data, dataset + "_ids", None)
+            if ids is None or self._load_ids(dataset) != list(ids):
+                return list(self.scales)
+
+        scales = []
+        for scale in self.scales:
+            for dataset in self.SETS:
+                path = self._path(dataset, scale)
+                if not os.path.isfile(path) or \
+                   os.path.getmtime(path) < weights_time or \
+                   len(np.load(path, mmap_mode="r")) != \
+                   len(getattr(data, dataset + "_x")):
+                    scales.append(scale)
+                    break
+
+        return scales
+
+    def build(self, backbone, scales, data, batch_size=16):
+        '''BUILD
+
+            Compute outputs of scales and save them in batches.
+            Each file is written to a temporary path and renamed
+            once it is complete, thus an interrupted run leaves
+            no file to be reused.
+
+            Inputs:
+            -------
+
+            - backbone: Keras Model, whose outputs are given scales.
+            - scales: int list, scales of outputs of backbone.
+            - data: an BTCDataset instance.
+            - batch_size: int, batch size in prediction.
+
+        '''
+
+        shapes = backbone.output_shape
+        if not isinstance(shapes, list):
+            shapes = [shapes]
+
+        for dataset in self.SETS:
+            x = getattr(data, dataset + "_x")
+            print("Caching outputs of {0} set, scales {1}".format(
+                  dataset, scales))
+
+            paths = [self._path(dataset, scale) for scale in scales]
+            caches = [np.lib.format.open_memmap(path + ".tmp",
+                                                mode="w+", dtype=np.float16,
+                                                shape=(len(x),) + shape[1:])
+                      for path, shape in zip(paths, shapes)]
+            for start in range(0, len(x), batch_size):
+                outputs = backbone.predict_on_batch(x[start:start + batch_size])
+                if not isinstance(outputs, list):
+                    outputs = [outputs]
+                for cache, output in zip(caches, outputs):
+                    cache[start:start + batch_size] = output
+
+            for cache in caches:
+                cache.flush()
+            del caches
+            for path in paths:
+                os.rename(path + ".tmp", path)
+
+            # Subjects of cached outputs
+            ids_path = self._ids_path(dataset)
+            with open(ids_path + ".tmp", "w") as f:
+                json.dump(list(getattr(data, dataset + "_ids")), f)
+            os.rename(ids_path + ".tmp", ids_path)
+
+        return
+
+    def load(self, data):
+        '''LOAD
+
+            Load cached outputs as memory mapped files,
+            and labels from dataset.
+
+            Input:
+            ------
+
+            - data: an BTCDataset instance.
+
+        '''
+
+        for dataset in self.SETS:
+            x = [np.load(self._path(dataset, scale), mmap_mode="r")
+                 for scale in self.scales]
+            setattr(self, dataset + "_x", x)
+            setattr(self, dataset + "_y", getattr(data, dataset + "_y"))
+
+        return
@@ -0,0 +1,807 @@
+# Brain Tumor Classification
+# Callbacks for training 3D Multi-Scale CNN.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+#     ,,,         ,,,
+#   ;"   ';     ;'   ",
+#   ;  @.ss$$$$$$s.@  ;
+#   `s$$$$$$$$$$$$$$$'
+#   $$$$$$$$$$$$$$$$$$
+#  $$$$P""Y$$$Y""W$$$$$
+#  $$$$  p"$$$"q  $$$$$
+#  $$$$  .$$$$$.  $$$$'
+#   $$$DaU$$O$$DaU$$$'
+#    '$$$$'.^.'$$$$'
+#       '&$$$$$&'
+
+
+from __future__ import print_function
+
+
+import os
+import re
+import csv
+import glob
+import json
+import time
+import h5py
+import keras
+import random
+import resource
+import threading
+import numpy as np
+
+from keras import backend as K
+from keras.callbacks import Callback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def glob_by_epoch(pattern):
+    '''GLOB_BY_EPOCH
+
+        Find files matched by pattern, such as "checkpoint_*.h5",
+        and sort them by the epoch number at "*", thus
+        checkpoint_1000.h5 is after checkpoint_999.h5.
+
+        Input:
+        ------
+
+        - pattern: string, glob pattern with one "*" at epoch.
+
+        Output:
+        -------
+
+        - A list of paths, from the oldest to the newest.
+
+    '''
+
+    prefix = pattern.split("*", 1)[0]
+
+    def epoch(path):
+        number = re.match(r"\d+", path[len(prefix):])
+        return int(number.group()) if number else -1
+
+    return sorted(glob.glob(pattern), key=lambda path: (epoch(path), path))
+
+
+def get_rss_mb():
+    '''GET_RSS_MB
+
+        Current resident set size of this process in MB.
+        Peak resident set size is returned if /proc is
+        not available.
+
+    '''
+
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 1024.0 ** 2
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class AsyncWriter(object):
+
+    def __init__(self, compression=None, max_queue=2):
+        '''__INIT__
+
+            Write snapshots of model into HDF5 files on a
+            background thread, so that training is not blocked
+            by slow storage. Weights are saved in the same layout
+            as model.save_weights, thus model.load_weights can
+            read the output file.
+
+            Inputs:
+            -------
+
+            - compression: string, compression filter of h5py,
+                           "gzip" or "lzf". Default is None.
+            - max_queue: int, the maximum number of snapshots
+                         waiting to be written. Training is blocked
+                         if the queue is full, which bounds memory
+                         used by snapshots. Default is 2.
+
+        '''
+
+        self.compression = compression
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+
+        self.thread = threading.Thread(target=self._work)
+        self.thread.daemon = True
+        self.thread.start()
+
+        return
+
+    def save(self, model, filepath, include_optimizer=False,
+             state=None, keep_pattern=None, max_to_keep=0):
+        '''SAVE
+
+            Take a snapshot of model in memory and put it into
+            the queue to be written.
+
+            Inputs:
+            -------
+
+            - model: Keras Models instance.
+            - filepath: string, path of output file.
+            - include_optimizer: boolean, if True, save state of
+                                 optimizer. Default is False.
+            - state: dictionary, saved as JSON in attribute
+                     "training_state". Default is None.
+            - keep_pattern: string, glob pattern of files which
+                            are kept at most max_to_keep, the newest
+                            files (by epoch, see glob_by_epoch) are kept.
+            - max_to_keep: int, the number of files to keep,
+                           0 means keeping all files.
+
+        '''
+
+        self._check_error()
+
+        # Copy values of all weights in one session run
+        layers = [layer for layer in model.layers if layer.weights]
+        weights = [w for layer in layers for w in layer.weights]
+        if include_optimizer:
+            weights += model.optimizer.weights
+        values = K.batch_get_value(weights)
+
+        snapshot = {"layers": [], "optimizer": [], "state": state}
+        index = 0
+        for layer in layers:
+            num = len(layer.weights)
+            names = [w.name for w in layer.weights]
+            snapshot["layers"].append([layer.name, names,
+                                       values[index:index + num]])
+            index += num
+        snapshot["optimizer"] = values[index:]
+
+        self.queue.put([filepath, snapshot, keep_pattern, max_to_keep])
+
+        return
+
+    def flush(self):
+        '''FLUSH
+
+            Block until all snapshots in queue are written.
+
+        '''
+
+        self.queue.join()
+        self._check_error()
+        return
+
+    def close(self):
+        '''CLOSE
+
+            Write snapshots left in queue and stop background
+            thread. Errors are not raised, call flush before
+            close to check them.
+
+        '''
+
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        return
+
+    def _check_error(self):
+        '''_CHECK_ERROR
+
+            Raise the error occured in background thread.
+
+        '''
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        return
+
+    def _work(self):
+        '''_WORK
+
+            Loop of background thread to write snapshots.
+
+        '''
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                # Sentinel put by close
+                self.queue.task_done()
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, filepath, snapshot, keep_pattern, max_to_keep):
+        '''_WRITE
+
+            Write one snapshot to temporary file, rename it to
+            target path, and remove old files if necessary.
+
+        '''
+
+        def dataset(group, name, value):
+            # Scalars can not be compressed
+            compression = self.compression if np.ndim(value) else None
+            group.create_dataset(name, data=value, compression=compression)
+            return
+
+        tmp_path = filepath + ".tmp"
+        with h5py.File(tmp_path, "w") as f:
+            f.attrs["layer_names"] = [l[0].encode("utf8")
+                                      for l in snapshot["layers"]]
+            f.attrs["backend"] = K.backend().encode("utf8")
+            f.attrs["keras_version"] = str(keras.__version__).encode("utf8")
+
+            for layer_name, names, values in snapshot["layers"]:
+                g = f.create_group(layer_name)
+                g.attrs["weight_names"] = [n.encode("utf8") for n in names]
+                for name, value in zip(names, values):
+                    dataset(g, name, value)
+
+            if snapshot["optimizer"]:
+                g = f.create_group("optimizer_weights")
+                for i, value in enumerate(snapshot["optimizer"]):
+                    dataset(g, "param_" + str(i), value)
+
+            if snapshot["state"] is not None:
+                state = json.dumps(snapshot["state"])
+                f.attrs["training_state"] = state.encode("utf8")
+
+        # Rename is atomic, the target file is either
+        # the old one or the new complete one
+        os.rename(tmp_path, filepath)
+
+        if keep_pattern is not None and max_to_keep > 0:
+            paths = glob_by_epoch(keep_pattern)
+            for path in paths[:-max_to_keep]:
+                os.remove(path)
+
+        return
+
+    @staticmethod
+    def load_optimizer_weights(model, filepath):
+        '''LOAD_OPTIMIZER_WEIGHTS
+
+            Load state of optimizer written by AsyncWriter.
+            Model should be compiled with the same optimizer.
+
+            Inputs:
+            -------
+
+            - model: compiled Keras Models instance.
+            - filepath: string, path of file with optimizer's state.
+
+        '''
+
+        # Create variables of optimizer
+        model._make_train_function()
+
+        with h5py.File(filepath, "r") as f:
+            g = f["optimizer_weights"]
+            values = [g["param_" + str(i)][()] for i in range(len(g))]
+        model.optimizer.set_weights(values)
+
+        return
+
+
+class AsyncModelCheckpoint(Callback):
+
+    def __init__(self, writer, filepath,
+                 monitor="val_loss",
+                 save_best_only=False,
+                 max_to_keep=0,
+                 verbose=0):
+        '''__INIT__
+
+            Save model's weights after every epoch by AsyncWriter.
+            Monitored quantity is minimized as ModelCheckpoint.
+
+            Inputs:
+            -------
+
+            - writer: AsyncWriter instance.
+            - filepath: string, path of output file, it can contain
+                        "{epoch}" formatting options, such as
+                        "weights_{epoch:03d}.h5".
+            - monitor: string, quantity to monitor, default is
+                       "val_loss".
+            - save_best_only: boolean, if True, only save weights
+                              if monitored quantity improves.
+            - max_to_keep: int, if filepath contains "{epoch}",
+                           keep at most max_to_keep newest files.
+                           0 means keeping all files.
+            - verbose: int, 1 to print message when saving.
+
+        '''
+
+        super(AsyncModelCheckpoint, self).__init__()
+        self.writer = writer
+        self.filepath = filepath
+        self.monitor = monitor
+        self.save_best_only = save_best_only
+        self.max_to_keep = max_to_keep
+        self.verbose = verbose
+        self.best = np.Inf
+
+        # Pattern of files written by this callback
+        self.keep_pattern = None
+        if "{epoch" in filepath:
+            prefix, suffix = filepath.split("{epoch", 1)
+            self.keep_pattern = prefix + "*" + suffix.split("}", 1)[1]
+
+        return
+
+    def on_epoch_end(self, epoch, logs=None):
+        '''ON_EPOCH_END
+
+            Queue weights if monitored quantity improves,
+            or in every epoch if not save_best_only.
+
+        '''
+
+        logs = logs or {}
+        if self.save_best_only:
+            current = logs.get(self.monitor)
+            if current is None or not np.less(current, self.best):
+                return
+            self.best = current
+
+        filepath = self.filepath.format(epoch=epoch + 1, **logs)
+        if self.verbose > 0:
+            print("Epoch {0}: saving model to {1}".format(epoch + 1, filepath))
+        self.writer.save(self.model, filepath,
+                         keep_pattern=self.keep_pattern,
+                         max_to_keep=self.max_to_keep)
+
+        return
+
+
+class TrainingCheckpoint(Callback):
+
+    def __init__(self, writer, filepath, period=1, max_to_keep=2,
+                 monitor_callback=None, extra_state=None, tracked=None):
+        '''__INIT__
+
+            Periodically save everything needed to resume training
+            by AsyncWriter, including:
+            - model's weights and optimizer's state,
+            - index of finished epoch,
+            - current learning rate,
+            - best monitored value of monitor_callback,
+            - attributes of tracked objects, such as counters of
+              ReduceLROnPlateau and EarlyStopping,
+            - random states of NumPy and Python, which decide
+              the order of shuffled samples.
+            Files are written to temporary paths and renamed,
+            thus a preempted job never leaves a broken checkpoint.
+
+            Inputs:
+            -------
+
+            - writer: AsyncWriter instance.
+            - filepath: string, path of checkpoint file, it should
+                        contain "{epoch}" formatting option, such as
+                        "checkpoint_{epoch:03d}.h5".
+            - period: int, save checkpoint every period epochs.
+                      Default is 1.
+            - max_to_keep: int, the number of newest checkpoints
+                           to keep. Default is 2.
+            - monitor_callback: Callback instance with attribute
+                                "best", such as AsyncModelCheckpoint,
+                                its best value is saved and can be
+                                restored when resuming.
+            - extra_state: dictionary, other values to be saved.
+            - tracked: dictionary, name and [object, attribute names],
+                       see CallbackState. Callbacks in it should be
+                       placed before this callback, thus their
+                       attributes are updated in the same epoch.
+
+        '''
+
+        super(TrainingCheckpoint, self).__init__()
+        self.writer = writer
+        self.filepath = filepath
+        self.period = period
+        self.max_to_keep = max_to_keep
+        self.monitor_callback = monitor_callback
+        self.extra_state = extra_state or {}
+        self.tracked = tracked or {}
+
+        prefix, suffix = filepath.split("{epoch", 1)
+        self.keep_pattern = prefix + "*" + suffix.split("}", 1)[1]
+
+        return
+
+    def on_epoch_end(self, epoch, logs=None):
+        '''ON_EPOCH_END
+
+            Save checkpoint every self.period epochs.
+
+        '''
+
+        if self.period <= 0 or (epoch + 1) % self.period:
+            return
+
+        state = {"epoch": epoch,
+                 "lr": float(K.get_value(self.model.optimizer.lr)),
+                 "np_random": self.get_np_random_state(),
+                 "py_random": self.get_py_random_state()}
+        if self.monitor_callback is not None:
+            state["best"] = float(self.monitor_callback.best)
+        if self.tracked:
+            state["tracked"] = CallbackState.collect(self.tracked)
+        state.update(self.extra_state)
+
+        self.writer.save(self.model, self.filepath.format(epoch=epoch + 1),
+                         include_optimizer=True, state=state,
+                         keep_pattern=self.keep_pattern,
+                         max_to_keep=self.max_to_keep)
+
+        return
+
+    @staticmethod
+    def latest(filepath):
+        '''LATEST
+
+            Find the newest checkpoint file.
+
+            Input:
+            ------
+
+            - filepath: string, path of checkpoint file with
+                        "{epoch}" formatting option.
+
+            Output:
+            -------
+
+            - string, path of the newest checkpoint, or None
+              if no checkpoint exists.
+
+        '''
+
+        prefix, suffix = filepath.split("{epoch", 1)
+        paths = glob_by_epoch(prefix + "*" + suffix.split("}", 1)[1])
+        return paths[-1] if paths else None
+
+    @staticmethod
+    def load_state(filepath):
+        '''LOAD_STATE
+
+            Load training state from checkpoint file and
+            restore random states of NumPy and Python.
+
+            Input:
+            ------
+
+            - filepath: string, path of checkpoint file.
+
+            Output:
+            -------
+
+            - state: dictionary of training state.
+
+        '''
+
+        with h5py.File(filepath, "r") as f:
+            state = f.attrs["training_state"]
+        if isinstance(state, bytes):
+            state = state.decode("utf8")
+        state = json.loads(state)
+
+        np_state = state["np_random"]
+        np.random.set_state((str(np_state[0]),
+                             np.array(np_state[1], dtype=np.uint32),
+                             np_state[2], np_state[3], np_state[4]))
+        py_state = state["py_random"]
+        random.setstate((py_state[0], tuple(py_state[1]), py_state[2]))
+
+        return state
+
+    @staticmethod
+    def get_np_random_state():
+        '''GET_NP_RANDOM_STATE
+
+            Convert NumPy's random state to a JSON serializable list.
+
+        '''
+
+        name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        return [name, keys.tolist(), int(pos), int(has_gauss),
+                float(cached_gaussian)]
+
+    @staticmethod
+    def get_py_random_state():
+        '''GET_PY_RANDOM_STATE
+
+            Convert Python's random state to a JSON serializable list.
+
+        '''
+
+        version, internal, gauss_next = random.getstate()
+        return [version, list(internal), gauss_next]
+
+
+class CallbackState(Callback):
+
+    def __init__(self, tracked, state=None):
+        '''__INIT__
+
+            Restore attributes of tracked objects at the beginning
+            of training, such as "wait" and "best" of EarlyStopping.
+            These callbacks reset their attributes in on_train_begin,
+            thus this callback should be placed after them.
+            Attributes are collected again at the end of training,
+            so that they are kept when the same callbacks are used
+            in several calls of fit, such as stages of resolution.
+
+            Inputs:
+            -------
+
+            - tracked: dictionary, name and [object, attribute names].
+            - state: dictionary, name and {attribute: value}, such as
+                     the output of collect which is saved in
+                     checkpoint. Default is None, which means
+                     nothing is restored.
+
+        '''
+
+        super(CallbackState, self).__init__()
+        self.tracked = tracked
+        self.state = state or {}
+
+        return
+
+    def on_train_begin(self, logs=None):
+        self.restore(self.tracked, self.state)
+        return
+
+    def on_train_end(self, logs=None):
+        self.state = self.collect(self.tracked)
+        return
+
+    @staticmethod
+    def collect(tracked):
+        '''COLLECT
+
+            Collect attributes of tracked objects into a JSON
+            serializable dictionary, missing attributes are skipped.
+
+        '''
+
+        state = {}
+        for name, (obj, attrs) in tracked.items():
+            values = {}
+            for attr in attrs:
+                value = getattr(obj, attr, None)
+                if value is not None:
+                    values[attr] = value.item() if hasattr(value, "item") \
+                        else value
+            state[name] = values
+        return state
+
+    @staticmethod
+    def restore(tracked, state):
+        '''RESTORE
+
+            Set attributes of tracked objects by values in state,
+            integer attributes are kept as integers.
+
+        '''
+
+        for name, (obj, attrs) in tracked.items():
+            for attr, value in state.get(name, {}).items():
+                if attr not in attrs:
+                    continue
+                current = getattr(obj, attr, None)
+                if isinstance(current, (int, np.integer)) and \
+                   not isinstance(current, bool):
+                    value = int(value)
+                setattr(obj, attr, value)
+        return
+
+
+class ThroughputLogger(Callback):
+
+    # Columns in output csv file
+    FIELDS = ["epoch", "batch", "size", "wait_ms", "step_ms",
+              "samples_per_sec", "rss_mb"]
+
+    def __init__(self, filepath, append=True):
+        '''__INIT__
+
+            Record for each training batch:
+            - wait_ms: time waiting for input, from the end of
+                       previous batch (or beginning of epoch) to
+                       the beginning of this batch, which includes
+                       slicing arrays or running generator.
+            - step_ms: time of train step.
+            - samples_per_sec: samples in batch / (wait + step).
+            - rss_mb: resident memory of process.
+            Records are written into csv file, and a summary
+            with p50/p95 step latency is printed at the end.
+            This callback should be placed after all other
+            callbacks, thus their time is not counted as waiting.
+
+            Inputs:
+            -------
+
+            - filepath: string, path of output csv file.
+            - append: boolean, if True, append to existing file.
+                      Default is True.
+
+        '''
+
+        super(ThroughputLogger, self).__init__()
+        self.filepath = filepath
+        self.append = append
+        self.file = None
+
+        return
+
+    def on_train_begin(self, logs=None):
+        '''ON_TRAIN_BEGIN
+
+            Open csv file and reset records.
+
+        '''
+
+        self.close()
+        exists = os.path.isfile(self.filepath) and self.append
+        self.file = open(self.filepath, "a" if exists else "w")
+        self.writer = csv.DictWriter(self.file, fieldnames=self.FIELDS)
+        if not exists:
+            self.writer.writeheader()
+
+        self.records = []
+        self.epoch = 0
+        self.last_time = time.time()
+
+        return
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.last_time = time.time()
+        return
+
+    def on_batch_begin(self, batch, logs=None):
+        self.begin_time = time.time()
+        return
+
+    def on_batch_end(self, batch, logs=None):
+        '''ON_BATCH_END
+
+            Record timing and memory of this batch.
+
+        '''
+
+        end_time = time.time()
+        wait = self.begin_time - self.last_time
+        step = end_time - self.begin_time
+        size = (logs or {}).get("size", 0)
+
+        record = {"epoch": self.epoch,
+                  "batch": batch,
+                  "size": size,
+                  "wait_ms": wait * 1000,
+                  "step_ms": step * 1000,
+                  "samples_per_sec": size / max(wait + step, 1e-9),
+                  "rss_mb": get_rss_mb()}
+        self.writer.writerow(record)
+        self.records.append(record)
+
+        self.last_time = end_time
+
+        return
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.file.flush()
+        return
+
+    def on_train_end(self, logs=None):
+        '''ON_TRAIN_END
+
+            Close csv file and print summary.
+
+        '''
+
+        self.close()
+        if not self.records:
+            return
+
+        wait = np.array([r["wait_ms"] for r in self.records])
+        step = np.array([r["step_ms"] for r in self.records])
+        samples = sum([r["size"] for r in self.records])
+        total = (wait.sum() + step.sum()) / 1000.0
+
+        print("\nThroughput summary:")
+        print("Step latency (ms): p50 {0:.1f}, p95 {1:.1f}".format(
+              np.percentile(step, 50), np.percentile(step, 95)))
+        print("Input wait (ms): p50 {0:.1f}, p95 {1:.1f}, "
+              "{2:.1f}% of time".format(np.percentile(wait, 50),
+                                        np.percentile(wait, 95),
+                                        100.0 * wait.sum() / 1000.0 / total))
+        print("Samples/sec: {0:.2f}, Peak RSS (MB): {1:.1f}".format(
+              samples / total, max([r["rss_mb"] for r in self.records])))
+
+        return
+
+    def close(self):
+        '''CLOSE
+
+            Close csv file if it is open.
+
+        '''
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        return
+
+
+class PeriodicValidation(Callback):
+
+    def __init__(self, x, y, batch_size, valid_freq=1):
+        '''__INIT__
+
+            Evaluate model on validation set every valid_freq
+            epochs and in the last epoch. Metrics are added into
+            logs as "val_" + metric name, and NaN is added in
+            other epochs, thus the following callbacks, such as
+            CSVLogger and checkpoints, see the same keys in each
+            epoch. This callback should be placed before them.
+
+            Inputs:
+            -------
+
+            - x, y: numpy ndarray, validation set, or x is a keras
+                    Sequence of batches and y is None.
+            - batch_size: int, batch size in evaluation.
+            - valid_freq: int, evaluate every n epochs, default is 1.
+
+        '''
+
+        super(PeriodicValidation, self).__init__()
+        self.x = x
+        self.y = y
+        self.batch_size = batch_size
+        self.valid_freq = valid_freq
+
+        return
+
+    def on_epoch_end(self, epoch, logs=None):
+        '''ON_EPOCH_END
+
+            Add validation metrics into logs.
+
+        '''
+
+        if logs is None:
+            return
+
+        names = ["val_" + name for name in self.model.metrics_names]
+        last_epoch = epoch + 1 == self.params.get("epochs")
+        if (epoch + 1) % self.valid_freq == 0 or last_epoch:
+            if self.y is None:
+                scores = self.model.evaluate_generator(self.x)
+            else:
+                scores = self.model.evaluate(self.x, self.y,
+                                             self.batch_size, verbose=0)
+            if not isinstance(scores, list):
+                scores = [scores]
+            logs.update(zip(names, scores))
+        else:
+            logs.update([(name, np.nan) for name in names])
+
+        return
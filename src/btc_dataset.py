@@ -25,8 +25,11 @@ import numpy as np
 import pandas as pd
 import nibabel as nib
 from random import seed, shuffle
+from scipy.ndimage.interpolation import zoom
 from keras.utils import to_categorical
 
+from btc_preprocess import BTCPreprocess
+
 
 class BTCDataset(object):
 
@@ -40,7 +43,8 @@ class BTCDataset(object):
                  pre_trainset_path=None,
                  pre_validset_path=None,
                  pre_testset_path=None,
-                 data_format=".nii.gz"):
+                 data_format=".nii.gz",
+                 load_mask=False):
         '''__INIT__
 
             Intialize configurations for loading
@@ -73,6 +77,9 @@ class BTCDataset(object):
               string, path of csv file, gives information of subjects (IDs
               and labels) in training set, validation set and testing set.
             - data_format: string, format of brain images, defalut is ".nii.gz".
+            - load_mask: boolean, if True, load tumor masks saved by
+                         BTCPreprocess as train_m, valid_m and test_m.
+                         Default is False.
 
         '''
 
@@ -94,6 +101,14 @@ class BTCDataset(object):
         self.valid_x, self.valid_y = None, None
         self.test_x, self.test_y = None, None
 
+        # Subjects' IDs of three sets, in the order of
+        # images before augmentation
+        self.train_ids, self.valid_ids, self.test_ids = None, None, None
+
+        # Tumor masks, in the same shape as images
+        self.load_mask = load_mask
+        self.train_m, self.valid_m, self.test_m = None, None, None
+
         return
 
     def run(self, pre_split=True,
@@ -230,6 +245,10 @@ class BTCDataset(object):
 
         '''
 
+        self.train_ids = self.get_ids(trainset)
+        self.valid_ids = self.get_ids(validset)
+        self.test_ids = self.get_ids(testset)
+
         # Load images and labels of subjects in testing set
         self.test_x, test_y = self.load_data(testset, "test set")
         self.test_y = to_categorical(test_y, num_classes=2)
@@ -241,6 +260,15 @@ class BTCDataset(object):
         # Load images and labels of subjects in training set
         train_x, train_y = self.load_data(trainset, "train set")
 
+        if self.load_mask:
+            # Load masks of subjects in three sets
+            self.test_m = self.load_masks(testset, "test set")
+            self.valid_m = self.load_masks(validset, "valid set")
+            self.train_m = self.load_masks(trainset, "train set")
+            if self.is_augment:
+                # Flip masks as images
+                self.train_m, _ = self.augment(self.train_m, train_y)
+
         if self.is_augment:
             # Augmentation on LGG subjects
             train_x, train_y = self.augment(train_x, train_y)
@@ -336,12 +364,8 @@ class BTCDataset(object):
 
         '''
 
-        IDs, labels = [], []
-        for i in dataset:
-            # Extract ID from subject's path
-            IDs.append(i[0].split("/")[-1].split(".")[0])
-            # Extract label
-            labels.append(i[1])
+        IDs = BTCDataset.get_ids(dataset)
+        labels = [i[1] for i in dataset]
 
         # Create pandas DataFrame and save it into csv file
         df = pd.DataFrame(data={"ID": IDs, "label": labels})
@@ -349,6 +373,27 @@ class BTCDataset(object):
 
         return
 
+    @staticmethod
+    def get_ids(dataset):
+        '''GET_IDS
+
+            Extract subjects' IDs from their paths.
+
+            Input:
+            ------
+
+            - dataset: list, information of partition, each element
+                       is [subject_path, label].
+
+            Output:
+            -------
+
+            - A list of IDs.
+
+        '''
+
+        return [i[0].split("/")[-1].split(".")[0] for i in dataset]
+
     @staticmethod
     def get_subjects_path(dir_path, volume_type, label,
                           random_state=0):
@@ -461,20 +506,9 @@ class BTCDataset(object):
         print("Loading {} data ...".format(mode))
         for subject in dataset:
             volume_path, label = subject[0], subject[1]
-            # Load image and rotate it to standard space
+            # Load image and normalize it
             volume = nib.load(volume_path).get_data()
-            volume = np.transpose(volume, axes=[1, 0, 2])
-            volume = np.flipud(volume)
-
-            # Extract mean and std from brain object
-            volume_obj = volume[volume > 0]
-            obj_mean = np.mean(volume_obj)
-            obj_std = np.std(volume_obj)
-            # Normalize whole image
-            volume = (volume - obj_mean) / obj_std
-
-            volume = np.expand_dims(volume, axis=3)
-            x.append(volume.astype(np.float32))
+            x.append(BTCPreprocess.normalize(volume))
             y.append(label)
 
         x = np.array(x)
@@ -482,6 +516,45 @@ class BTCDataset(object):
 
         return x, y
 
+    @staticmethod
+    def load_masks(dataset, mode):
+        '''LOAD_MASKS
+
+            Load tumor masks of subjects. Mask of each subject
+            is the file whose name contains "seg" in the same
+            folder as image.
+
+            Inputs:
+            -------
+
+            - dataset: list with two columns, [subject_path, label].
+            - mode: string, indicates which partition, "train set",
+                    "valid set" or "test set".
+
+            Output:
+            -------
+
+            - masks: numpy ndarray in shape [n, 112, 96, 96, 1],
+                     1 for tumor voxels and 0 for others.
+
+        '''
+
+        masks = []
+        print("Loading {} masks ...".format(mode))
+        for subject in dataset:
+            subject_dir = os.path.dirname(subject[0])
+            mask_name = [name for name in os.listdir(subject_dir)
+                         if "seg" in name][0]
+            # Load mask and rotate it as image
+            mask = nib.load(os.path.join(subject_dir, mask_name)).get_data()
+            mask = np.transpose(mask, axes=[1, 0, 2])
+            mask = np.flipud(mask)
+
+            mask = np.expand_dims(mask > 0, axis=3)
+            masks.append(mask.astype(np.uint8))
+
+        return np.array(masks)
+
     @staticmethod
     def augment(train_x, train_y):
         '''AUGMENT
@@ -517,6 +590,78 @@ class BTCDataset(object):
 
         return train_x, train_y
 
+    @staticmethod
+    def rescale(x, scale, multiple=16):
+        '''RESCALE
+
+            Resize images by scale, each spatial dimension is
+            rounded to a multiple of given number, so that
+            features of all scales in model are aligned.
+
+            Inputs:
+            -------
+
+            - x: numpy ndarray in shape [n, 112, 96, 96, 1], images.
+            - scale: float, ratio of new size to original size.
+            - multiple: int, each spatial dimension of output is
+                        a multiple of it, default is 16.
+
+            Output:
+            -------
+
+            - numpy ndarray in shape [n, 112s, 96s, 96s, 1], resized
+              images, or x itself if its size is not changed.
+
+        '''
+
+        old_shape = list(x.shape[1:4])
+        new_shape = [max(multiple, int(round(d * scale / multiple)) * multiple)
+                     for d in old_shape]
+        if new_shape == old_shape:
+            return x
+
+        # Zoom factors of spatial dimensions and channel
+        factor = [n / float(o) for n, o in zip(new_shape, old_shape)] + [1.0]
+        resized = [zoom(volume, zoom=factor, order=1, prefilter=False)
+                   for volume in x]
+        return np.array(resized, dtype=x.dtype)
+
+
+def load_dataset(hgg_dir, lgg_dir, pre_paras):
+    '''LOAD_DATASET
+
+        Partition and load dataset by settings in pre_paras.json,
+        so that all scripts use the same partition.
+
+        Inputs:
+        -------
+
+        - hgg_dir: string, path of directory contains HGG subjects.
+        - lgg_dir: string, path of directory contains LGG subjects.
+        - pre_paras: dictionary, settings in pre_paras.json.
+
+        Output:
+        -------
+
+        - An BTCDataset instance after running.
+
+    '''
+
+    data = BTCDataset(hgg_dir, lgg_dir,
+                      volume_type=pre_paras["volume_type"],
+                      train_prop=pre_paras["train_prop"],
+                      valid_prop=pre_paras["valid_prop"],
+                      random_state=pre_paras["random_state"],
+                      pre_trainset_path=pre_paras["pre_trainset_path"],
+                      pre_validset_path=pre_paras["pre_validset_path"],
+                      pre_testset_path=pre_paras["pre_testset_path"],
+                      data_format=pre_paras["data_format"],
+                      load_mask=pre_paras["load_mask"])
+    data.run(pre_split=pre_paras["pre_split"],
+             save_split=pre_paras["save_split"],
+             save_split_dir=pre_paras["save_split_dir"])
+    return data
+
 
 if __name__ == "__main__":
 
@@ -0,0 +1,223 @@
+# Brain Tumor Classification
+# Helpers of data-parallel training with Horovod.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+#     ,,,         ,,,
+#   ;"   ';     ;'   ",
+#   ;  @.ss$$$$$$s.@  ;
+#   `s$$$$$$$$$$$$$$$'
+#   $$$$$$$$$$$$$$$$$$
+#  $$$$P""Y$$$Y""W$$$$$
+#  $$$$  p"$$$"q  $$$$$
+#  $$$$  .$$$$$.  $$$$'
+#   $$$DaU$$O$$DaU$$$'
+#    '$$$$'.^.'$$$$'
+#       '&$$$$$&'
+
+
+from __future__ import print_function
+
+
+import os
+import sys
+import math
+import subprocess
+import numpy as np
+
+from keras.utils import Sequence
+
+
+# Environment variables set by horovodrun in each worker
+RANK_KEYS = ["HOROVOD_RANK", "OMPI_COMM_WORLD_RANK", "PMI_RANK"]
+
+
+def import_horovod():
+    '''IMPORT_HOROVOD
+
+        Import Keras API of Horovod, which is an optional
+        dependency only required by distributed training.
+
+        Output:
+        -------
+
+        - horovod.keras module.
+
+    '''
+
+    try:
+        import horovod.keras as hvd
+    except ImportError:
+        raise ImportError("Distributed training requires Horovod, install "
+                          "it by: HOROVOD_WITH_TENSORFLOW=1 pip install horovod")
+    return hvd
+
+
+def is_launched():
+    '''IS_LAUNCHED
+
+        Check if current process is a worker started by horovodrun.
+
+        Output:
+        -------
+
+        - boolean.
+
+    '''
+
+    return any([key in os.environ for key in RANK_KEYS])
+
+
+def launch(workers_num, hosts=None, argv=None):
+    '''LAUNCH
+
+        Start workers by horovodrun, each runs the same
+        script with the same arguments.
+
+        Inputs:
+        -------
+
+        - workers_num: int, the number of worker processes.
+        - hosts: string, hosts and slots such as "h1:2,h2:2",
+                 default is None, which runs all workers on
+                 localhost.
+        - argv: string list, script and its arguments, default
+                is sys.argv of current process.
+
+        Output:
+        -------
+
+        - int, exit code of horovodrun.
+
+    '''
+
+    if hosts is None:
+        hosts = "localhost:{}".format(workers_num)
+    if argv is None:
+        argv = sys.argv
+
+    cmd = ["horovodrun", "-np", str(workers_num), "-H", hosts,
+           sys.executable] + argv
+    print("Launching:", " ".join(cmd))
+
+    return subprocess.call(cmd)
+
+
+def shard_indices(total, rank, size, epoch=0, random_state=0):
+    '''SHARD_INDICES
+
+        Indices of samples of one worker in given epoch.
+        Samples are shuffled by a seed shared by all workers,
+        which changes in each epoch, thus each worker sees
+        different samples in each epoch and classes are mixed.
+        The shuffled order is padded by its beginning to a
+        multiple of size, so that every sample is used in each
+        epoch and all workers run the same number of steps.
+
+        Inputs:
+        -------
+
+        - total: int, the number of samples.
+        - rank: int, index of worker.
+        - size: int, the number of workers.
+        - epoch: int, index of epoch, default is 0.
+        - random_state: int, seed to shuffle samples.
+
+        Output:
+        -------
+
+        - numpy ndarray, indices of this worker, the
+          length is ceil(total / size).
+
+    '''
+
+    seed = (random_state + epoch) % (2 ** 32)
+    order = np.random.RandomState(seed).permutation(total)
+    pad = (-total) % size
+    order = np.concatenate([order, order[:pad]])
+
+    return order[rank::size]
+
+
+def shard(arrays, rank, size):
+    '''SHARD
+
+        Split samples among workers, such as validation set.
+        Each sample belongs to exactly one worker, and sizes
+        of shards differ by one at most. Metrics on shards
+        are averaged over workers.
+
+        Inputs:
+        -------
+
+        - arrays: list of numpy ndarray with the same length,
+                  such as features, labels and masks. None
+                  in list is kept as None.
+        - rank: int, index of worker.
+        - size: int, the number of workers.
+
+        Output:
+        -------
+
+        - list of arrays of this worker.
+
+    '''
+
+    idx = np.arange(len(arrays[0]))[rank::size]
+    return [None if a is None else a[idx] for a in arrays]
+
+
+class ShardSequence(Sequence):
+
+    def __init__(self, x, y, batch_size, rank, size,
+                 random_state=0, epoch=0, targets=None):
+        '''__INIT__
+
+            Batches of one worker in data parallel training,
+            shard of worker is reshuffled in each epoch, see
+            shard_indices.
+
+            Inputs:
+            -------
+
+            - x: numpy ndarray, or a list of it, features.
+            - y: numpy ndarray, labels.
+            - batch_size: int, the number of samples in each batch.
+            - rank: int, index of worker.
+            - size: int, the number of workers.
+            - random_state: int, seed shared by all workers.
+            - epoch: int, index of the first epoch, default is 0.
+            - targets: function to convert labels into targets of
+                       model, default is None, which keeps labels.
+
+        '''
+
+        self.x = x
+        self.y = y
+        self.batch_size = batch_size
+        self.rank = rank
+        self.size = size
+        self.random_state = random_state
+        self.epoch = epoch
+        self.targets = targets
+
+        self.indices = shard_indices(len(y), rank, size,
+                                     epoch, random_state)
+
+        return
+
+    def __len__(self):
+        return int(math.ceil(len(self.indices) / float(self.batch_size)))
+
+    def __getitem__(self, idx):
+        batch = self.indices[idx * self.batch_size:(idx + 1) * self.batch_size]
+        x = [a[batch] for a in self.x] if isinstance(self.x, list) \
+            else self.x[batch]
+        y = self.y[batch]
+        return x, y if self.targets is None else self.targets(y)
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self.indices = shard_indices(len(self.y), self.rank, self.size,
+                                     self.epoch, self.random_state)
+        return
@@ -0,0 +1,587 @@
+# Brain Tumor Classification
+# Export inference graph of 3D Multi-Scale CNN.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+#     ,,,         ,,,
+#   ;"   ';     ;'   ",
+#   ;  @.ss$$$$$$s.@  ;
+#   `s$$$$$$$$$$$$$$$'
+#   $$$$$$$$$$$$$$$$$$
+#  $$$$P""Y$$$Y""W$$$$$
+#  $$$$  p"$$$"q  $$$$$
+#  $$$$  .$$$$$.  $$$$'
+#   $$$DaU$$O$$DaU$$$'
+#    '$$$$'.^.'$$$$'
+#       '&$$$$$&'
+
+
+from __future__ import print_function
+
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from keras import backend as K
+from keras.models import Model
+from keras.layers import (Layer,
+                          Dense,
+                          Input,
+                          Dropout,
+                          InputLayer,
+                          Concatenate,
+                          BatchNormalization)
+from btc_train import BTCTrain
+from btc_backends import KerasModel, InferenceModel
+from btc_session import (set_session,
+                         session_paras,
+                         add_session_args)
+
+
+class Affine(Layer):
+
+    def __init__(self, **kwargs):
+        '''__INIT__
+
+            Per-channel affine transformation, x * scale + offset,
+            which is batch normalization in inference.
+
+        '''
+
+        super(Affine, self).__init__(**kwargs)
+        return
+
+    def build(self, input_shape):
+        '''BUILD
+
+            Create scale and offset of the last axis.
+
+        '''
+
+        channels = input_shape[-1]
+        self.scale = self.add_weight(name="scale", shape=(channels,),
+                                     initializer="ones", trainable=False)
+        self.offset = self.add_weight(name="offset", shape=(channels,),
+                                      initializer="zeros", trainable=False)
+        super(Affine, self).build(input_shape)
+        return
+
+    def call(self, inputs):
+        return inputs * self.scale + self.offset
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+
+def bn_affine(layer):
+    '''BN_AFFINE
+
+        Convert a batch normalization layer in inference
+        into per-channel scale and offset.
+
+        Input:
+        ------
+
+        - layer: Keras BatchNormalization instance.
+
+        Outputs:
+        --------
+
+        - scale, offset: numpy ndarray in size of channels.
+
+    '''
+
+    mean = K.get_value(layer.moving_mean)
+    var = K.get_value(layer.moving_variance)
+    gamma = K.get_value(layer.gamma) if layer.scale else np.ones_like(mean)
+    beta = K.get_value(layer.beta) if layer.center else np.zeros_like(mean)
+
+    scale = gamma / np.sqrt(var + layer.epsilon)
+    offset = beta - mean * scale
+    return scale, offset
+
+
+def fold_model(model):
+    '''FOLD_MODEL
+
+        Build an inference-only copy of model:
+        - Dropout layers are removed.
+        - Batch normalization layers whose outputs only feed Dense
+          layers (through Dropout or Concatenate) are folded into
+          weights of those Dense layers, such as pre_bn into fc1_*,
+          fc1_*_bn into fc2 and fc2_bn into fc3.
+        - Other batch normalization layers are replaced by Affine.
+          In this model they follow ReLU, thus they can not be
+          folded into preceding convolutional layers, and folding
+          them into following ones is not exact at zero padding.
+        Other layers are copied with their weights.
+
+        Input:
+        ------
+
+        - model: Keras Models instance.
+
+        Output:
+        -------
+
+        - folded: Keras Models instance with the same inputs and
+                  outputs as model.
+
+    '''
+
+    def to_list(x):
+        return x if isinstance(x, list) else [x]
+
+    # Layers which consume each tensor
+    consumers = {}
+    for layer in model.layers:
+        if isinstance(layer, InputLayer):
+            continue
+        for tensor in to_list(layer.input):
+            consumers.setdefault(tensor.name, []).append(layer)
+    output_names = [tensor.name for tensor in model.outputs]
+
+    # Helper function to check whether a tensor only
+    # feeds Dense layers through Dropout or Concatenate
+    def to_dense(tensor):
+        if tensor.name in output_names:
+            return False
+        for layer in consumers.get(tensor.name, []):
+            if isinstance(layer, Concatenate) and \
+               layer.axis not in [-1, len(K.int_shape(layer.output)) - 1]:
+                return False
+            if isinstance(layer, (Dropout, Concatenate)):
+                if not to_dense(layer.output):
+                    return False
+            elif not isinstance(layer, Dense):
+                return False
+        return True
+
+    folded_bn = [layer.name for layer in model.layers
+                 if isinstance(layer, BatchNormalization) and
+                 to_dense(layer.output)]
+
+    # Helper function to find scale and offset applied on
+    # inputs of a Dense layer by folded batch normalization,
+    # None if there is no one
+    def input_affine(tensor):
+        layer = tensor._keras_history[0]
+        if isinstance(layer, Dropout):
+            return input_affine(layer.input)
+        if layer.name in folded_bn:
+            return bn_affine(layer)
+        if isinstance(layer, Concatenate):
+            parts = [input_affine(t) for t in layer.input]
+            if all([part is None for part in parts]):
+                return None
+            dims = [K.int_shape(t)[-1] for t in layer.input]
+            parts = [part or (np.ones(dim), np.zeros(dim))
+                     for part, dim in zip(parts, dims)]
+            return (np.concatenate([part[0] for part in parts]),
+                    np.concatenate([part[1] for part in parts]))
+        return None
+
+    # Rebuild model layer by layer in topological order
+    tensors = {}
+
+    def mapped(x):
+        if isinstance(x, list):
+            return [tensors[t.name] for t in x]
+        return tensors[x.name]
+
+    for layer in model.layers:
+        if isinstance(layer, InputLayer):
+            tensors[layer.output.name] = Input(
+                batch_shape=layer.batch_input_shape, name=layer.name)
+            continue
+
+        inputs = mapped(layer.input)
+        if isinstance(layer, Dropout) or layer.name in folded_bn:
+            # Identity in inference
+            outputs = inputs
+        elif isinstance(layer, BatchNormalization):
+            new_layer = Affine(name=layer.name)
+            outputs = new_layer(inputs)
+            new_layer.set_weights(list(bn_affine(layer)))
+        else:
+            new_layer = layer.__class__.from_config(layer.get_config())
+            outputs = new_layer(inputs)
+            weights = layer.get_weights()
+            affine = input_affine(layer.input) \
+                if isinstance(layer, Dense) else None
+            if affine is not None:
+                # dense(x * s + o) = x * (s * W) + (o * W + b)
+                scale, offset = affine
+                kernel, bias = weights
+                weights = [kernel * scale[:, None], bias + offset.dot(kernel)]
+            new_layer.set_weights(weights)
+        tensors[layer.output.name] = outputs
+
+    return Model(inputs=mapped(model.inputs),
+                 outputs=mapped(model.outputs))
+
+
+def freeze_model(model, pb_path):
+    '''FREEZE_MODEL
+
+        Convert variables of model into constants and save the
+        inference graph as binary protobuf. Names of input and
+        output nodes are saved in a json file with the same
+        name, such as last_frozen.json for last_frozen.pb.
+
+        Inputs:
+        -------
+
+        - model: Keras Models instance in current session.
+        - pb_path: string, path of protobuf file.
+
+    '''
+
+    sess = K.get_session()
+    names = {"inputs": [t.name for t in model.inputs],
+             "outputs": [t.name for t in model.outputs]}
+
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        sess, sess.graph.as_graph_def(),
+        [name.split(":")[0] for name in names["outputs"]])
+    graph_def = tf.graph_util.remove_training_nodes(graph_def)
+
+    tf.train.write_graph(graph_def, os.path.dirname(pb_path),
+                         os.path.basename(pb_path), as_text=False)
+    with open(os.path.splitext(pb_path)[0] + ".json", "w") as f:
+        json.dump(names, f, indent=4)
+
+    return
+
+
+def load_frozen(pb_path):
+    '''LOAD_FROZEN
+
+        Load frozen inference graph saved by freeze_model.
+
+        Input:
+        ------
+
+        - pb_path: string, path of protobuf file.
+
+        Outputs:
+        --------
+
+        - graph_def: tf.GraphDef instance.
+        - names: dictionary, names of "inputs" and "outputs" tensors.
+
+    '''
+
+    with open(os.path.splitext(pb_path)[0] + ".json") as f:
+        names = json.load(f)
+
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(pb_path, "rb") as f:
+        graph_def.ParseFromString(f.read())
+
+    return graph_def, names
+
+
+def export_onnx(pb_path, onnx_path, opset=13):
+    '''EXPORT_ONNX
+
+        Convert frozen inference graph saved by freeze_model
+        into ONNX model by tf2onnx.
+
+        Inputs:
+        -------
+
+        - pb_path: string, path of protobuf file.
+        - onnx_path: string, path of ONNX model.
+        - opset: int, ONNX opset, default is 13, which supports
+                 per-channel quantization.
+
+    '''
+
+    import tf2onnx
+
+    graph_def, names = load_frozen(pb_path)
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name="")
+        onnx_graph = tf2onnx.tfonnx.process_tf_graph(
+            graph, opset=opset,
+            input_names=names["inputs"],
+            output_names=names["outputs"])
+    onnx_graph = tf2onnx.optimizer.optimize_graph(onnx_graph)
+    model_proto = onnx_graph.make_model(os.path.basename(onnx_path))
+
+    with open(onnx_path, "wb") as f:
+        f.write(model_proto.SerializeToString())
+
+    return
+
+
+class FrozenModel(InferenceModel):
+
+    def __init__(self, pb_path, config=None):
+        '''__INIT__
+
+            Load frozen inference graph saved by freeze_model
+            in a separate graph and session.
+
+            Inputs:
+            -------
+
+            - pb_path: string, path of protobuf file.
+            - config: tf.ConfigProto of session, default is None.
+
+        '''
+
+        graph_def, names = load_frozen(pb_path)
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.sess = tf.Session(graph=self.graph, config=config)
+        self.inputs = [self.graph.get_tensor_by_name(n) for n in names["inputs"]]
+        self.outputs = [self.graph.get_tensor_by_name(n) for n in names["outputs"]]
+        self.output_shape = self.outputs[0].shape.as_list()
+
+        return
+
+    def _run(self, xs):
+        return self.sess.run(self.outputs, dict(zip(self.inputs, xs)))
+
+
+class BTCExport(object):
+
+    def __init__(self,
+                 paras_name,
+                 paras_json_path,
+                 weights_save_dir,
+                 export_weights="last",
+                 samples_num=8,
+                 repeats=10,
+                 warmup=2,
+                 tolerance=1e-4,
+                 session_paras=None):
+        '''__INIT__
+
+            Set configurations before exporting model.
+
+            Inputs:
+            -------
+
+            - paras_name: string, name of hyperparameters set,
+                          can be found in hyper_paras.json.
+            - paras_json_path: string, path of file which provides
+                               hyperparamters, "hyper_paras.json"
+                               in this project.
+            - weights_save_dir: string, directory path where saves
+                                trained model.
+            - export_weights: string, "last" or "best" weights.
+            - samples_num: int, the number of random inputs to
+                           compare predictions. Default is 8.
+            - repeats: int, the number of timed runs, median latency
+                       is reported. Default is 10.
+            - warmup: int, the number of untimed runs before timing.
+                      Default is 2.
+            - tolerance: float, the maximum absolute difference of
+                         predictions. Default is 1e-4.
+            - session_paras: dictionary, threads and CPU affinity
+                             of TensorFlow session, see set_session
+                             in btc_session.py. Default is None.
+
+        '''
+
+        self.paras = BTCTrain.load_paras(paras_json_path, paras_name)
+        self.samples_num = samples_num
+        self.repeats = repeats
+        self.warmup = warmup
+        self.tolerance = tolerance
+        self.session_paras = session_paras
+
+        model_dir = os.path.join(weights_save_dir, paras_name)
+        self.weights_path = os.path.join(model_dir, export_weights + ".h5")
+        self.pb_path = os.path.join(model_dir, export_weights + "_frozen.pb")
+        self.report_path = os.path.join(model_dir, export_weights + "_export.csv")
+        if not os.path.isfile(self.weights_path):
+            raise IOError("Weights file is not exist: " + self.weights_path)
+
+        return
+
+    def _load_model(self):
+        '''_LOAD_MODEL
+
+            Create 3D Multi-Scale CNN and load weights.
+
+        '''
+
+        self.model = KerasModel(self.paras, self.weights_path).model
+        return
+
+    def _time(self, fcn):
+        '''_TIME
+
+            Measure median latency of given function.
+
+            Input:
+            ------
+
+            - fcn: function without arguments to be timed.
+
+            Output:
+            -------
+
+            - float, median latency in milliseconds.
+
+        '''
+
+        for _ in range(self.warmup):
+            fcn()
+
+        latency = []
+        for _ in range(self.repeats):
+            start = time.time()
+            fcn()
+            latency.append((time.time() - start) * 1000)
+
+        return float(np.median(latency))
+
+    def _check(self, pred, ref, name):
+        '''_CHECK
+
+            Compare predictions with those of original model.
+
+            Inputs:
+            -------
+
+            - pred, ref: numpy ndarray or list of it.
+            - name: string, name of model to be printed.
+
+            Output:
+            -------
+
+            - float, the maximum absolute difference.
+
+        '''
+
+        preds = pred if isinstance(pred, list) else [pred]
+        refs = ref if isinstance(ref, list) else [ref]
+        diff = max([np.max(np.abs(p - r)) for p, r in zip(preds, refs)])
+        print("{0}: max absolute difference {1:.2e}".format(name, diff))
+        if diff > self.tolerance:
+            raise RuntimeError("Predictions of {0} differ from original "
+                               "model by {1:.2e}.".format(name, diff))
+        return float(diff)
+
+    def run(self):
+        '''RUN
+
+            Export model:
+            -1- Load trained model and fold it (see fold_model).
+            -2- Save folded model as frozen graph [weights]_frozen.pb.
+            -3- Compare predictions of folded model and frozen graph
+                with original model on random inputs.
+            -4- Measure latency of each model for one sample, and
+                save the report in [weights]_export.csv.
+
+        '''
+
+        print("\nExporting model: " + self.weights_path + "\n")
+
+        # Frozen graph runs in its own session with the same threads
+        threads = {"intra_op_threads": 0, "inter_op_threads": 0}
+        if self.session_paras is not None:
+            set_session(**self.session_paras)
+            threads.update(self.session_paras)
+        config = tf.ConfigProto(
+            intra_op_parallelism_threads=threads["intra_op_threads"],
+            inter_op_parallelism_threads=threads["inter_op_threads"])
+
+        self._load_model()
+        folded = fold_model(self.model)
+        freeze_model(folded, self.pb_path)
+        frozen = FrozenModel(self.pb_path, config)
+        print("Frozen graph is saved in " + self.pb_path)
+
+        input_shape = K.int_shape(self.model.input)[1:]
+        x = np.random.RandomState(0).randn(
+            *((self.samples_num,) + input_shape)).astype(np.float32)
+        ref = self.model.predict(x, 1)
+
+        models = [["original", self.model],
+                  ["folded", folded],
+                  ["frozen", frozen]]
+        rows = []
+        for name, model in models:
+            diff = 0.0 if name == "original" else \
+                self._check(model.predict(x, 1), ref, name)
+            latency = self._time(lambda: model.predict(x[:1], 1))
+            rows.append({"model": name,
+                         "max_diff": diff,
+                         "latency_ms": latency})
+
+        report = pd.DataFrame(rows)[["model", "max_diff", "latency_ms"]]
+        report["speedup"] = report["latency_ms"][0] / report["latency_ms"]
+        print(report.to_string(index=False))
+        report.to_csv(self.report_path, index=False)
+
+        frozen.sess.close()
+        K.clear_session()
+
+        return
+
+
+def main(hyper_paras_name, export_weights=None, args=None):
+    '''MAIN
+
+        Main process to export model.
+
+        Inputs:
+        -------
+
+        - hyper_paras_name: string, the name of hyperparameters set,
+                            which can be found in hyper_paras.json.
+        - export_weights: string, "last" or "best", default is None,
+                          which means test_weights in pre_paras.json.
+        - args: argparse Namespace, session settings from command
+                line which override pre_paras.json. Default is None.
+
+    '''
+
+    pre_paras_path = "pre_paras.json"
+    pre_paras = json.load(open(pre_paras_path))
+
+    # Set directory of saved weights
+    parent_dir = os.path.dirname(os.getcwd())
+    weights_save_dir = os.path.join(parent_dir, pre_paras["weights_save_dir"])
+
+    export = BTCExport(paras_name=hyper_paras_name,
+                       paras_json_path=pre_paras["paras_json_path"],
+                       weights_save_dir=weights_save_dir,
+                       export_weights=export_weights or pre_paras["test_weights"],
+                       session_paras=session_paras(pre_paras, args))
+    export.run()
+
+    return
+
+
+if __name__ == "__main__":
+
+    # Command line
+    # python btc_export.py --paras=paras-1 --weights=best
+
+    parser = argparse.ArgumentParser()
+
+    help_str = "Select a set of hyper-parameters in hyper_paras.json."
+    parser.add_argument("--paras", action="store", default="paras-1",
+                        dest="hyper_paras_name", help=help_str)
+    help_str = "Weights to export, last or best."
+    parser.add_argument("--weights", action="store", default=None,
+                        choices=["last", "best"],
+                        dest="export_weights", help=help_str)
+    add_session_args(parser)
+
+    args = parser.parse_args()
+    main(args.hyper_paras_name, args.export_weights, args)
@@ -0,0 +1,230 @@
+# Brain Tumor Classification
+# Generate load on local server of 3D Multi-Scale CNN.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+#     ,,,         ,,,
+#   ;"   ';     ;'   ",
+#   ;  @.ss$$$$$$s.@  ;
+#   `s$$$$$$$$$$$$$$$'
+#   $$$$$$$$$$$$$$$$$$
+#  $$$$P""Y$$$Y""W$$$$$
+#  $$$$  p"$$$"q  $$$$$
+#  $$$$  .$$$$$.  $$$$'
+#   $$$DaU$$O$$DaU$$$'
+#    '$$$$'.^.'$$$$'
+#       '&$$$$$&'
+
+
+from __future__ import print_function
+
+
+import os
+import json
+import time
+import argparse
+import threading
+import numpy as np
+
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+
+
+def find_scans(input_path, data_format=".nii.gz"):
+    '''FIND_SCANS
+
+        Find images to be sent, masks ("seg" in names) are skipped.
+
+        Inputs:
+        -------
+
+        - input_path: string, path of one image or directory
+                      of images.
+        - data_format: string, extension of images, default
+                       is ".nii.gz".
+
+        Output:
+        -------
+
+        - A list of paths of images.
+
+    '''
+
+    if os.path.isfile(input_path):
+        return [os.path.abspath(input_path)]
+
+    paths = []
+    for root, _, names in sorted(os.walk(input_path)):
+        for name in sorted(names):
+            if name.endswith(data_format) and "seg" not in name:
+                paths.append(os.path.abspath(os.path.join(root, name)))
+    return paths
+
+
+class BTCLoadGen(object):
+
+    def __init__(self, url, paths, requests_num=32,
+                 concurrency=4, upload=False, timeout=600):
+        '''__INIT__
+
+            Send requests to /predict from several threads,
+            each thread sends next request once previous one
+            is answered.
+
+            Inputs:
+            -------
+
+            - url: string, root url of server.
+            - paths: list of paths of images, sent in turn.
+            - requests_num: int, the number of requests in total.
+                            Default is 32.
+            - concurrency: int, the number of threads. Default is 4.
+            - upload: boolean, if True, send bytes of images,
+                      otherwise send their paths. Default is False.
+            - timeout: float, timeout of each request in seconds.
+                       Default is 600.
+
+        '''
+
+        self.url = url.rstrip("/")
+        self.paths = paths
+        self.requests_num = requests_num
+        self.concurrency = concurrency
+        self.upload = upload
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.latency, self.batch_sizes, self.errors = [], [], []
+
+        return
+
+    def _request(self, path):
+        if self.upload:
+            with open(path, "rb") as f:
+                data = f.read()
+            content_type = "application/octet-stream"
+        else:
+            data = json.dumps({"path": path}).encode("utf-8")
+            content_type = "application/json"
+
+        request = Request(self.url + "/predict", data=data,
+                          headers={"Content-Type": content_type})
+        response = urlopen(request, timeout=self.timeout)
+        return json.loads(response.read().decode("utf-8"))
+
+    def _worker(self):
+        while True:
+            with self.lock:
+                if self.sent >= self.requests_num:
+                    return
+                path = self.paths[self.sent % len(self.paths)]
+                self.sent += 1
+
+            start = time.time()
+            try:
+                result = self._request(path)
+            except (HTTPError, URLError, IOError, ValueError) as e:
+                with self.lock:
+                    self.errors.append(str(e))
+                continue
+
+            with self.lock:
+                self.latency.append((time.time() - start) * 1000)
+                self.batch_sizes.append(result["batch_size"])
+
+    def metrics(self):
+        '''METRICS
+
+            Metrics reported by server.
+
+        '''
+
+        response = urlopen(self.url + "/metrics", timeout=self.timeout)
+        return json.loads(response.read().decode("utf-8"))
+
+    def run(self):
+        '''RUN
+
+            Send all requests and print client side latency
+            percentiles, throughput and metrics of server.
+
+            Output:
+            -------
+
+            - A dictionary of client side results.
+
+        '''
+
+        print("\nSending {} requests to {} in {} threads\n".format(
+            self.requests_num, self.url, self.concurrency))
+
+        start = time.time()
+        threads = [threading.Thread(target=self._worker)
+                   for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        results = {"requests": self.requests_num,
+                   "errors": len(self.errors),
+                   "elapsed_s": elapsed,
+                   "throughput": len(self.latency) / elapsed}
+        if self.latency:
+            for p in [50, 90, 99]:
+                results["p{}_ms".format(p)] = \
+                    float(np.percentile(self.latency, p))
+            results["mean_batch_size"] = float(np.mean(self.batch_sizes))
+
+        for key in sorted(results):
+            print("{}: {}".format(key, results[key]))
+        if self.errors:
+            print("First error: " + self.errors[0])
+
+        print("\nServer metrics:")
+        server_metrics = self.metrics()
+        for key in sorted(server_metrics):
+            print("{}: {}".format(key, server_metrics[key]))
+
+        return results
+
+
+if __name__ == "__main__":
+
+    # Command line
+    # python btc_loadgen.py --input=../data/New --requests=64 --concurrency=8
+
+    parser = argparse.ArgumentParser()
+
+    help_str = "Root url of server."
+    parser.add_argument("--url", action="store",
+                        default="http://127.0.0.1:8000",
+                        dest="url", help=help_str)
+    help_str = "Image, or directory of images, to send."
+    parser.add_argument("--input", action="store", required=True,
+                        dest="input_path", help=help_str)
+    help_str = "The number of requests in total."
+    parser.add_argument("--requests", action="store", type=int, default=32,
+                        dest="requests_num", help=help_str)
+    help_str = "The number of concurrent clients."
+    parser.add_argument("--concurrency", action="store", type=int, default=4,
+                        dest="concurrency", help=help_str)
+    help_str = "Upload bytes of images instead of sending paths."
+    parser.add_argument("--upload", action="store_true", default=False,
+                        dest="upload", help=help_str)
+    help_str = "Extension of images."
+    parser.add_argument("--format", action="store", default=".nii.gz",
+                        dest="data_format", help=help_str)
+
+    args = parser.parse_args()
+    paths = find_scans(args.input_path, args.data_format)
+    if not paths:
+        raise ValueError("No image is found in " + args.input_path)
+
+    loadgen = BTCLoadGen(args.url, paths,
+                         requests_num=args.requests_num,
+                         concurrency=args.concurrency,
+                         upload=args.upload)
+    loadgen.run()
@@ -19,7 +19,9 @@
 from __future__ import print_function
 
 
+import numpy as np
 from keras.layers import *
+from keras import backend as K
 from keras.models import Model
 from keras.regularizers import l2
 
@@ -33,7 +35,14 @@ class BTCModels(object):
                  l2_coeff=5e-5,
                  drop_rate=0.5,
                  bn_momentum=0.9,
-                 initializer="glorot_uniform"):
+                 initializer="glorot_uniform",
+                 width_mult=1.0,
+                 depth_mult=1.0,
+                 scales=[1, 2, 3, 4],
+                 conv_type="dense",
+                 global_pool=False,
+                 early_exit=False,
+                 filters=None):
         '''__INIT__
 
             Intialization to generate model.
@@ -41,8 +50,10 @@ class BTCModels(object):
             Inputs:
             -------
 
-            - model_name: string, selecte model, in this project,
-                          only one choice is "pyramid".
+            - model_name: string, selecte model, "pyramid" for the
+                          whole 3D Multi-Scale CNN, "head" for dense
+                          layers only, whose inputs are outputs of
+                          scales (see self.backbone).
             - input_shape: list, dimentions of input data,
                            [112, 96, 96, 1] is required.
             - pooling: string, pooling mathods, "max" for max pooling,
@@ -53,6 +64,35 @@ class BTCModels(object):
                            default is 0.9.
             - initializer: string, method to initialize parameters,
                            default is "glorot_uniform".
+            - width_mult: float, multiplier of the number of filters
+                          in each convolutional layer and the number
+                          of units in each hidden dense layer.
+                          Default is 1.0.
+            - depth_mult: float, multiplier of the number of
+                          convolutional layers in each block, rounded
+                          to an integer not less than 1. Default is 1.0.
+            - scales: int list, scales of pyramid whose features are
+                      fused, any subset of [1, 2, 3, 4]. Scale 1 is
+                      the coarsest one (conv5). Default is [1, 2, 3, 4].
+            - conv_type: string, factorization of convolutional layers,
+                         "dense" for full 3D kernels, "2plus1d" for
+                         spatial kernels followed by depth kernels,
+                         "axial" for three 1D kernels along each axis.
+                         Default is "dense".
+            - global_pool: boolean, if True, features of each scale
+                           are pooled globally instead of in size of
+                           7*6*6, thus the model accepts inputs in any
+                           size whose spatial dimensions are multiples
+                           of 16, such as [None, None, None, 1].
+                           Default is False.
+            - early_exit: boolean, if True, an extra output layer
+                          "exit1" is built on features of scale 1,
+                          thus the model has two outputs, [fc3, exit1].
+                          Scale 1 should be in scales. Default is False.
+            - filters: dictionary, name of layer and its number of
+                       filters or units, which overrides the number
+                       given by width multiplier, such as models whose
+                       channels are pruned. Default is None.
 
         '''
 
@@ -64,10 +104,28 @@ class BTCModels(object):
         self.bn_momentum = bn_momentum
         self.initializer = initializer
 
+        # Parameters to generate lightweight variants
+        self.width_mult = width_mult
+        self.depth = max(1, int(round(depth_mult)))
+        self.scales = sorted(set(scales))
+        if not self.scales or \
+           any(s not in [1, 2, 3, 4] for s in self.scales):
+            raise ValueError("Scales should be a subset of [1, 2, 3, 4].")
+        if conv_type not in ["dense", "2plus1d", "axial"]:
+            raise ValueError("Unknown convolution type: " + conv_type)
+        self.conv_type = conv_type
+        self.global_pool = global_pool
+        if early_exit and 1 not in self.scales:
+            raise ValueError("Early exit requires scale 1.")
+        self.early_exit = early_exit
+        self.filters = filters or {}
+
         # Build pyramid model, which is referred as
         # 3D Multi-Scale CNN in this project
         if model_name == "pyramid":
             self.model = self._pyramid()
+        elif model_name == "head":
+            self.model = self._head_model()
 
         return
 
@@ -75,7 +133,17 @@ class BTCModels(object):
                 strides=(1, 1, 1), name=None):
         '''_CONV3D
 
-            Construct a convolutional layer.
+            Construct a convolutional layer. According to
+            self.conv_type, a 3D kernel in size of k*k*k is:
+            - "dense": one layer with k*k*k kernel.
+            - "2plus1d": one layer with k*k*1 kernel, followed by
+                         one layer with 1*1*k kernel. The number of
+                         intermediate filters is chosen to keep the
+                         number of parameters as dense kernel.
+            - "axial": three layers with k*1*1, 1*k*1 and 1*1*k
+                       kernels respectively.
+            Intermediate layers are named as [name]_xy, [name]_x and
+            [name]_y, the last layer is always named as [name].
 
             Inputs:
             -------
@@ -83,7 +151,7 @@ class BTCModels(object):
             - inputs: input tensor, it should be original input,
                       or the output from previous layer.
             - filter_num: int, the number of filters.
-            - filter_size: int or int list, the dimensions of filters.
+            - filter_size: int, the dimension of filters.
             - strides: int tuple with length 3, the stride step in
                        each dimension.
             - name: string, layer's name.
@@ -95,13 +163,91 @@ class BTCModels(object):
 
         '''
 
-        return Convolution3D(filter_num, filter_size,
-                             strides=strides,
-                             kernel_initializer=self.initializer,
-                             kernel_regularizer=l2(self.l2_coeff),
-                             activation="relu",
-                             padding="same",
-                             name=name)(inputs)
+        # Helper function to construct one layer
+        def conv3d(x, num, size, stride, layer_name):
+            return Convolution3D(self.filters.get(layer_name, num), size,
+                                 strides=stride,
+                                 kernel_initializer=self.initializer,
+                                 kernel_regularizer=l2(self.l2_coeff),
+                                 activation="relu",
+                                 padding="same",
+                                 name=layer_name)(x)
+
+        k, (s1, s2, s3) = filter_size, strides
+        if self.conv_type == "2plus1d":
+            # The number of intermediate filters, see
+            # "A Closer Look at Spatiotemporal Convolutions
+            # for Action Recognition" by Tran et al.
+            in_num = K.int_shape(inputs)[-1]
+            mid_num = (k ** 3 * in_num * filter_num) // \
+                      (k ** 2 * in_num + k * filter_num)
+            conv = conv3d(inputs, max(1, mid_num), (k, k, 1),
+                          (s1, s2, 1), name + "_xy")
+            return conv3d(conv, filter_num, (1, 1, k), (1, 1, s3), name)
+        elif self.conv_type == "axial":
+            conv = conv3d(inputs, filter_num, (k, 1, 1), (s1, 1, 1), name + "_x")
+            conv = conv3d(conv, filter_num, (1, k, 1), (1, s2, 1), name + "_y")
+            return conv3d(conv, filter_num, (1, 1, k), (1, 1, s3), name)
+
+        return conv3d(inputs, filter_num, filter_size, strides, name)
+
+    def _conv_block(self, inputs, filter_num, filter_size,
+                    strides=(1, 1, 1), name=None):
+        '''_CONV_BLOCK
+
+            Construct a block of convolutional layers. The number
+            of layers is given by depth multiplier, and the number
+            of filters is scaled by width multiplier. Only the first
+            layer uses given strides and the name of block, so that
+            the default variant keeps layers' names of original model.
+
+            Inputs:
+            -------
+
+            - inputs: input tensor, it should be original input,
+                      or the output from previous layer.
+            - filter_num: int, the number of filters before scaling.
+            - filter_size: int, the dimension of filters.
+            - strides: int tuple with length 3, the stride step in
+                       each dimension of the first layer.
+            - name: string, name of the first layer, following layers
+                    are named as [name]_2, [name]_3, ...
+
+            Output:
+            -------
+
+            - output tensor from the last layer in the block.
+
+        '''
+
+        filter_num = self._filters(filter_num)
+        outputs = self._conv3d(inputs, filter_num, filter_size,
+                               strides=strides, name=name)
+        for i in range(2, self.depth + 1):
+            outputs = self._conv3d(outputs, filter_num, filter_size,
+                                   name=name + "_" + str(i))
+        return outputs
+
+    def _filters(self, filter_num):
+        '''_FILTERS
+
+            Scale the number of filters or units by width multiplier.
+            At least 8 filters or units are kept in each layer.
+
+            Input:
+            ------
+
+            - filter_num: int, the number of filters or units
+                          in original model.
+
+            Output:
+            -------
+
+            - int, the number of filters or units in variant.
+
+        '''
+
+        return max(8, int(round(filter_num * self.width_mult)))
 
     def _dense(self, inputs, units, activation="relu", name=None):
         '''_DENSE
@@ -123,7 +269,7 @@ class BTCModels(object):
 
         '''
 
-        return Dense(units,
+        return Dense(self.filters.get(name, units),
                      kernel_initializer=self.initializer,
                      kernel_regularizer=l2(self.l2_coeff),
                      activation=activation,
@@ -133,7 +279,8 @@ class BTCModels(object):
         '''_EXTRACT_FEATURES
 
             Extract features from input tensor by:
-            - Pooling (max or avg) in size 7*6*6.
+            - Pooling (max or avg) in size 7*6*6, or global
+              pooling if self.global_pool is True.
             - Flatten + Batch normalization + Dropout.
             - Dense + Batch normalization.
 
@@ -146,24 +293,33 @@ class BTCModels(object):
             Output:
             -------
 
-            - fc1: tensor in size of 256, features extracted from input.
+            - fc1: tensor in size of 256 (scaled by width multiplier),
+                   features extracted from input.
 
         '''
 
-        # Pooling (max or avg) in size of 7*6*6
-        if self.pooling == "max":
-            pool = MaxPooling3D
-        elif self.pooling == "avg":
-            pool = AveragePooling3D
-        fts_pool = pool((7, 6, 6), name=name + "_pre_pool")(inputs)
-
-        # Flatten + Batch normalization + Dropout
-        fts_flt = Flatten(name=name + "_pre_flt")(fts_pool)
+        if self.global_pool:
+            # Global pooling (max or avg), output is flat
+            if self.pooling == "max":
+                pool = GlobalMaxPooling3D
+            elif self.pooling == "avg":
+                pool = GlobalAveragePooling3D
+            fts_flt = pool(name=name + "_pre_pool")(inputs)
+        else:
+            # Pooling (max or avg) in size of 7*6*6
+            if self.pooling == "max":
+                pool = MaxPooling3D
+            elif self.pooling == "avg":
+                pool = AveragePooling3D
+            fts_pool = pool((7, 6, 6), name=name + "_pre_pool")(inputs)
+            fts_flt = Flatten(name=name + "_pre_flt")(fts_pool)
+
+        # Batch normalization + Dropout
         fts_bn = BatchNormalization(momentum=self.bn_momentum, name=name + "_pre_bn")(fts_flt)
         fts_dp = Dropout(self.drop_rate, name=name + "_pre_dp")(fts_bn)
 
         # Dense + Batch normalization
-        fc1 = self._dense(fts_dp, 256, "relu", name)
+        fc1 = self._dense(fts_dp, self._filters(256), "relu", name)
         fc1 = BatchNormalization(momentum=self.bn_momentum, name=name + "_bn")(fc1)
 
         return fc1
@@ -172,6 +328,9 @@ class BTCModels(object):
         '''_PYRAMID
 
             Build and return 3D Multi-Scale CNN.
+            Convolutional layers (see self._backbone) are also
+            kept as self.backbone, whose outputs are selected
+            scales and feed dense layers (see self._head).
 
             Output:
             -------
@@ -184,101 +343,510 @@ class BTCModels(object):
         inputs = Input(shape=self.input_shape)
         # 112 * 96 * 96 * 1
 
+        scale_outputs = self._backbone(inputs)
+        self.backbone = Model(inputs=inputs, outputs=scale_outputs)
+
+        outputs = self._head(scale_outputs)
+        model = Model(inputs=inputs, outputs=outputs)
+        return model
+
+    def _head_model(self):
+        '''_HEAD_MODEL
+
+            Build dense layers alone, inputs are outputs of
+            selected scales, named as "scale1" to "scale4".
+            Layers' names are the same as in the pyramid model,
+            thus weights can be exchanged by name.
+
+            Output:
+            -------
+
+            - model: Keras Models instance, dense layers.
+
+        '''
+
+        inputs = [Input(shape=self.scale_shape(scale), name="scale" + str(scale))
+                  for scale in self.scales]
+        outputs = self._head(inputs)
+        model = Model(inputs=inputs, outputs=outputs)
+        return model
+
+    def scale_shape(self, scale):
+        '''SCALE_SHAPE
+
+            Shape of output of one scale for one sample.
+            Spatial dimensions are 1/16, 1/8, 1/4 and 1/2 of
+            input for scale 1 to 4.
+
+            Input:
+            ------
+
+            - scale: int, 1, 2, 3 or 4.
+
+            Output:
+            -------
+
+            - list, shape of output, such as [7, 6, 6, 256].
+
+        '''
+
+        factor = 2 ** (5 - scale)
+        dims = [None if d is None else d // factor
+                for d in self.input_shape[:3]]
+        return dims + [self._filters([256, 128, 64, 32][scale - 1])]
+
+    def _backbone(self, inputs):
+        '''_BACKBONE
+
+            Build convolutional layers of 3D Multi-Scale CNN.
+            Upsampling paths are only built up to the finest
+            scale in self.scales.
+
+            Input:
+            ------
+
+            - inputs: input tensor.
+
+            Output:
+            -------
+
+            - list of output tensors of selected scales.
+
+        '''
+
+        # The finest scale to be built
+        max_scale = max(self.scales)
+
         # Conv1 + BN
-        conv1 = self._conv3d(inputs, 32, 5, strides=(2, 2, 2), name="conv1")
+        conv1 = self._conv_block(inputs, 32, 5, strides=(2, 2, 2), name="conv1")
         conv1_bn = BatchNormalization(momentum=self.bn_momentum, name="conv1_bn")(conv1)
         # 56 * 48 * 48 * 32
 
         # Conv2 + Max Pooling + BN
-        conv2 = self._conv3d(conv1_bn, 64, 3, name="conv2")
+        conv2 = self._conv_block(conv1_bn, 64, 3, name="conv2")
         conv2_mp = MaxPooling3D((2, 2, 2), strides=(2, 2, 2), name="conv2_mp")(conv2)
         conv2_bn = BatchNormalization(momentum=self.bn_momentum, name="conv2_bn")(conv2_mp)
         # 28 * 24 * 24 * 64
 
         # Conv3 + Max Pooling + BN
-        conv3 = self._conv3d(conv2_bn, 128, 3, name="conv3")
+        conv3 = self._conv_block(conv2_bn, 128, 3, name="conv3")
         conv3_mp = MaxPooling3D((2, 2, 2), strides=(2, 2, 2), name="conv3_mp")(conv3)
         conv3_bn = BatchNormalization(momentum=self.bn_momentum, name="conv3_bn")(conv3_mp)
         # 14 * 12 * 12 * 128
 
         # Conv4 + Max Pooling + BN
-        conv4 = self._conv3d(conv3_bn, 256, 3, name="conv4")
+        conv4 = self._conv_block(conv3_bn, 256, 3, name="conv4")
         conv4_mp = MaxPooling3D((2, 2, 2), strides=(2, 2, 2), name="conv4_mp")(conv4)
         conv4_bn = BatchNormalization(momentum=self.bn_momentum, name="conv4_bn")(conv4_mp)
         # 7 * 6 * 6 * 256
 
         # Conv5 (Scale1)
-        conv5 = self._conv3d(conv4_bn, 256, 3, name="conv5")
+        conv5 = self._conv_block(conv4_bn, 256, 3, name="conv5")
         # 7 * 6 * 6 * 256
-        # Upsampling1
-        conv5_up = UpSampling3D((2, 2, 2), name="conv5_up")(conv5)
-        # 14 * 12 * 12 * 256
+        scale_outputs = [conv5]
 
-        # Conv4 ADD Upsampling1 + BN
-        sum1 = Add(name="sum1")([conv4, conv5_up])
-        sum1_bn = BatchNormalization(momentum=self.bn_momentum, name="sum1_bn")(sum1)
+        if max_scale >= 2:
+            # Upsampling1
+            conv5_up = UpSampling3D((2, 2, 2), name="conv5_up")(conv5)
+            # 14 * 12 * 12 * 256
 
-        # Conv6 (Scale2)
-        conv6 = self._conv3d(sum1_bn, 128, 3, name="conv6")
-        # 14 * 12 * 12 * 128
-        # Upsampling2
-        conv6_up = UpSampling3D((2, 2, 2), name="conv6_up")(conv6)
-        # 28 * 24 * 24 * 128
+            # Conv4 ADD Upsampling1 + BN
+            sum1 = Add(name="sum1")([conv4, conv5_up])
+            sum1_bn = BatchNormalization(momentum=self.bn_momentum, name="sum1_bn")(sum1)
 
-        # Conv3 ADD Upsampling2 + BN
-        sum2 = Add(name="sum2")([conv3, conv6_up])
-        sum2_bn = BatchNormalization(momentum=self.bn_momentum, name="sum2_bn")(sum2)
+            # Conv6 (Scale2)
+            conv6 = self._conv_block(sum1_bn, 128, 3, name="conv6")
+            # 14 * 12 * 12 * 128
+            scale_outputs.append(conv6)
 
-        # Conv7 (Scale3)
-        conv7 = self._conv3d(sum2_bn, 64, 3, name="conv7")
-        # 28 * 24 * 24 * 64
-        # Upsampling3
-        conv7_up = UpSampling3D((2, 2, 2), name="conv7_up")(conv7)
-        # 56 * 48 * 48 * 64
+        if max_scale >= 3:
+            # Upsampling2
+            conv6_up = UpSampling3D((2, 2, 2), name="conv6_up")(conv6)
+            # 28 * 24 * 24 * 128
 
-        # Conv2 ADD Upsampling3 + BN
-        sum3 = Add(name="sum3")([conv2, conv7_up])
-        sum3_bn = BatchNormalization(momentum=self.bn_momentum, name="sum3_bn")(sum3)
+            # Conv3 ADD Upsampling2 + BN
+            sum2 = Add(name="sum2")([conv3, conv6_up])
+            sum2_bn = BatchNormalization(momentum=self.bn_momentum, name="sum2_bn")(sum2)
 
-        # Conv8 (Scale4)
-        conv8 = self._conv3d(sum3_bn, 32, 3, name="conv8")
-        # 56 * 48 * 48 * 32
+            # Conv7 (Scale3)
+            conv7 = self._conv_block(sum2_bn, 64, 3, name="conv7")
+            # 28 * 24 * 24 * 64
+            scale_outputs.append(conv7)
+
+        if max_scale >= 4:
+            # Upsampling3
+            conv7_up = UpSampling3D((2, 2, 2), name="conv7_up")(conv7)
+            # 56 * 48 * 48 * 64
+
+            # Conv2 ADD Upsampling3 + BN
+            sum3 = Add(name="sum3")([conv2, conv7_up])
+            sum3_bn = BatchNormalization(momentum=self.bn_momentum, name="sum3_bn")(sum3)
 
-        # Extracte features from Scale1
-        fts1 = self._extract_features(conv5, name="fc1_1")  # 256    -->   256
-        # Extracte features from Scale2
-        fts2 = self._extract_features(conv6, name="fc1_2")  # 1024   -->   256
-        # Extracte features from Scale3
-        fts3 = self._extract_features(conv7, name="fc1_3")  # 4096   -->   256
-        # Extracte features from Scale4
-        fts4 = self._extract_features(conv8, name="fc1_4")  # 16384  -->   256
-
-        # Fuse features of 4 scales + Dropout + Dense (256) + BN
-        fts = Concatenate(name="fts_all")([fts1, fts2, fts3, fts4])  # 1024
+            # Conv8 (Scale4)
+            conv8 = self._conv_block(sum3_bn, 32, 3, name="conv8")
+            # 56 * 48 * 48 * 32
+            scale_outputs.append(conv8)
+
+        return [outputs for scale, outputs in enumerate(scale_outputs, 1)
+                if scale in self.scales]
+
+    def _head(self, scale_outputs):
+        '''_HEAD
+
+            Build dense layers on outputs of selected scales.
+
+            Input:
+            ------
+
+            - scale_outputs: list of tensors, outputs of scales
+                             in self.scales.
+
+            Output:
+            -------
+
+            - fc3: output tensor, probabilities of two classes.
+                   If self.early_exit is True, a list of fc3 and
+                   exit1, which is the output layer on features
+                   of scale 1 alone.
+
+        '''
+
+        # Extracte features from selected scales
+        # Scale1: 256    -->   256
+        # Scale2: 1024   -->   256
+        # Scale3: 4096   -->   256
+        # Scale4: 16384  -->   256
+        fts_list = []
+        for scale, outputs in zip(self.scales, scale_outputs):
+            fts_name = "fc1_" + str(scale)
+            fts_list.append(self._extract_features(outputs, name=fts_name))
+
+        # Fuse features of selected scales + Dropout + Dense (256) + BN
+        if len(fts_list) > 1:
+            fts = Concatenate(name="fts_all")(fts_list)  # 1024
+        else:
+            fts = fts_list[0]
         fts_dp = Dropout(rate=self.drop_rate, name="fts_all_dp")(fts)
-        fc2 = self._dense(fts_dp, 256, "relu", name="fc2")
+        fc2 = self._dense(fts_dp, self._filters(256), "relu", name="fc2")
         fc2_bn = BatchNormalization(momentum=self.bn_momentum, name="fc2_bn")(fc2)
 
         # Output layer
         fc3 = self._dense(fc2_bn, 2, "softmax", name="fc3")  # 2
-        model = Model(inputs=inputs, outputs=fc3)
-        return model
+
+        if self.early_exit:
+            # Output layer on the coarsest scale only
+            exit1 = self._dense(fts_list[0], 2, "softmax", name="exit1")  # 2
+            return [fc3, exit1]
+        return fc3
+
+    @staticmethod
+    def exit_models(model):
+        '''EXIT_MODELS
+
+            Split a model with early exit into two models which
+            share layers with it. The coarse model only computes
+            layers which exit1 depends on (conv1 to conv5 and
+            fc1_1), and also outputs activations of these layers
+            which are used by finer scales, such as conv5, skip
+            connections of conv2 to conv4 and features of fc1_1.
+            The fine model takes these activations as inputs and
+            computes the rest layers up to fc3, thus layers of
+            the coarse model are not computed again.
+
+            Input:
+            ------
+
+            - model: Keras Models instance with outputs [fc3, exit1].
+
+            Outputs:
+            --------
+
+            - coarse: Keras Models instance, outputs are exit1 and
+                      activations used by finer scales.
+            - fine: Keras Models instance, inputs are activations
+                    from the coarse model, output is fc3.
+
+        '''
+
+        fc3, exit1 = model.outputs
+        coarse_layers = set([layer.name for layer in
+                             Model(inputs=model.inputs, outputs=exit1).layers])
+
+        # Layers are sorted from inputs to outputs, each of them
+        # is called once in model, find activations of the coarse
+        # model which are used by other layers
+        cuts = []
+        for layer in model.layers:
+            if layer.name in coarse_layers:
+                continue
+            for tensor in layer._inbound_nodes[0].input_tensors:
+                if tensor._keras_history[0].name in coarse_layers and \
+                   all([tensor is not cut for cut in cuts]):
+                    cuts.append(tensor)
+
+        # Call the rest layers on inputs of fine model
+        inputs = [Input(shape=K.int_shape(cut)[1:]) for cut in cuts]
+        tensors = dict(zip([id(cut) for cut in cuts], inputs))
+        for layer in model.layers:
+            if layer.name in coarse_layers:
+                continue
+            node = layer._inbound_nodes[0]
+            layer_inputs = [tensors[id(t)] for t in node.input_tensors]
+            outputs = layer(layer_inputs if len(layer_inputs) > 1
+                            else layer_inputs[0])
+            tensors[id(node.output_tensors[0])] = outputs
+
+        coarse = Model(inputs=model.inputs, outputs=[exit1] + cuts)
+        fine = Model(inputs=inputs, outputs=tensors[id(fc3)])
+        return coarse, fine
+
+    @staticmethod
+    def early_exit_predict(coarse, fine, x, threshold, batch_size=1):
+        '''EARLY_EXIT_PREDICT
+
+            Predict with early exit. Each batch is predicted by
+            the coarse model first, and only samples whose
+            confidence (the maximum probability) is lower than
+            threshold are predicted by the fine model, using
+            activations computed by the coarse model.
+
+            Inputs:
+            -------
+
+            - coarse, fine: Keras Models instances, see exit_models.
+            - x: numpy ndarray, input samples.
+            - threshold: float, confidence to exit early.
+            - batch_size: int, batch size in prediction, default is 1.
+
+            Outputs:
+            --------
+
+            - pred: numpy ndarray, probabilities of two classes.
+            - exited: boolean ndarray, True for samples which
+                      exit early.
+
+        '''
+
+        preds, exited = [], []
+        for start in range(0, len(x), batch_size):
+            outputs = coarse.predict_on_batch(x[start:start + batch_size])
+            pred, cuts = outputs[0], outputs[1:]
+            batch_exited = np.max(pred, axis=1) >= threshold
+            if not np.all(batch_exited):
+                uncertain = [cut[~batch_exited] for cut in cuts]
+                pred[~batch_exited] = fine.predict_on_batch(uncertain)
+            preds.append(pred)
+            exited.append(batch_exited)
+
+        return np.concatenate(preds), np.concatenate(exited)
+
+    @staticmethod
+    def layer_flops(layer):
+        '''LAYER_FLOPS
+
+            Count floating point operations of one layer
+            for one sample in forward pass. A multiply-add
+            is counted as two operations. Layers without
+            arithmetic (Input, Flatten, Dropout, UpSampling3D,
+            Concatenate) are counted as zero.
+
+            Input:
+            ------
+
+            - layer: Keras Layer instance in a built model.
+
+            Output:
+            -------
+
+            - flops: int, the number of operations.
+
+        '''
+
+        def prod(shape):
+            return int(np.prod([d for d in shape if d is not None]))
+
+        if isinstance(layer, (Conv3D, Dense)):
+            in_shape, out_shape = layer.input_shape, layer.output_shape
+            kernel_num = prod(layer.kernel_size) if isinstance(layer, Conv3D) else 1
+            flops = 2 * prod(out_shape[1:]) * kernel_num * in_shape[-1]
+            if layer.use_bias:
+                flops += prod(out_shape[1:])
+        elif isinstance(layer, (MaxPooling3D, AveragePooling3D)):
+            flops = prod(layer.output_shape[1:]) * prod(layer.pool_size)
+        elif isinstance(layer, BatchNormalization):
+            flops = 2 * prod(layer.output_shape[1:])
+        elif isinstance(layer, Add):
+            flops = (len(layer.input_shape) - 1) * prod(layer.output_shape[1:])
+        else:
+            flops = 0
+
+        return flops
+
+    @staticmethod
+    def count_flops(model):
+        '''COUNT_FLOPS
+
+            Count floating point operations of whole model
+            for one sample in forward pass.
+
+            Input:
+            ------
+
+            - model: Keras Models instance.
+
+            Output:
+            -------
+
+            - int, the number of operations.
+
+        '''
+
+        return sum([BTCModels.layer_flops(layer) for layer in model.layers])
+
+    @staticmethod
+    def profile(model, batch_size=1, optimizer="adam", verbose=True):
+        '''PROFILE
+
+            Walk through layers of a built model and report:
+            - FLOPs of each layer for one sample.
+            - Bytes of parameters of each layer.
+            - Bytes of activations (outputs) of each layer
+              for one sample.
+            Peak memory in training is estimated as:
+            - parameters, gradients and optimizer's slots
+              (2 for "adam", 0 for others),
+            - activations of all layers, which are kept for
+              backward pass, for all samples in one batch,
+            - gradients of the two largest activations in
+              one batch, which are alive at the same time
+              in backward pass.
+
+            Inputs:
+            -------
+
+            - model: Keras Models instance.
+            - batch_size: int, the number of samples in each batch.
+                          Default is 1.
+            - optimizer: string, optimizer to train model,
+                         default is "adam".
+            - verbose: boolean, if True, print the report.
+
+            Outputs:
+            --------
+
+            - rows: list of dictionary, profile of each layer with
+                    keys "name", "flops", "param_bytes" and
+                    "act_bytes".
+            - peak_bytes: int, estimated peak memory in training.
+
+        '''
+
+        dtype_bytes = np.dtype(K.floatx()).itemsize
+
+        def act_bytes(shape):
+            shapes = shape if isinstance(shape, list) else [shape]
+            return sum([int(np.prod(s[1:])) * dtype_bytes for s in shapes])
+
+        rows = []
+        for layer in model.layers:
+            rows.append({"name": layer.name,
+                         "flops": BTCModels.layer_flops(layer),
+                         "param_bytes": layer.count_params() * dtype_bytes,
+                         "act_bytes": act_bytes(layer.output_shape)})
+
+        # Parameters, gradients and optimizer's slots
+        slots_num = 2 if optimizer == "adam" else 0
+        param_bytes = sum([row["param_bytes"] for row in rows])
+        state_bytes = param_bytes * (2 + slots_num)
+
+        # Activations in forward pass and their
+        # gradients in backward pass
+        acts = sorted([row["act_bytes"] for row in rows])
+        acts_bytes = sum(acts) * batch_size
+        grads_bytes = sum(acts[-2:]) * batch_size
+        peak_bytes = state_bytes + acts_bytes + grads_bytes
+
+        if verbose:
+            mb = 1024.0 ** 2
+            line = "{0:<16}{1:>14}{2:>14}{3:>16}"
+            print(line.format("Layer", "MFLOPs", "Params (MB)",
+                              "Acts/sample (MB)"))
+            for row in rows:
+                print(line.format(row["name"],
+                                  "{:.1f}".format(row["flops"] / 1e6),
+                                  "{:.2f}".format(row["param_bytes"] / mb),
+                                  "{:.2f}".format(row["act_bytes"] / mb)))
+            print("Total GFLOPs per sample: {:.2f}".format(
+                  sum([row["flops"] for row in rows]) / 1e9))
+            print("Parameters + gradients + optimizer (MB): {:.1f}".format(
+                  state_bytes / mb))
+            print("Activations for batch size {0} (MB): {1:.1f}".format(
+                  batch_size, (acts_bytes + grads_bytes) / mb))
+            print("Estimated peak training memory (MB): {:.1f}".format(
+                  peak_bytes / mb))
+
+        return rows, peak_bytes
 
 
 if __name__ == "__main__":
 
-    # A test to print model's architecture.
+    # A test to print model's architecture and its profile.
+    # Command line
+    # python btc_models.py --paras=paras-1 --batch_size=16
 
+    import json
+    import argparse
     from keras.optimizers import Adam
 
-    model = BTCModels(model_name="pyramid",
-                      input_shape=[112, 96, 96, 1],
-                      pooling="max",
-                      l2_coeff=5e-5,
-                      drop_rate=0.5,
-                      bn_momentum=0.9,
-                      initializer="glorot_uniform").model
+    parser = argparse.ArgumentParser()
+
+    help_str = "Select a set of hyper-parameters in hyper_paras.json."
+    parser.add_argument("--paras", action="store", default="paras-1",
+                        dest="hyper_paras_name", help=help_str)
+    help_str = "Batch size to estimate peak training memory."
+    parser.add_argument("--batch_size", action="store", type=int,
+                        default=None, dest="batch_size", help=help_str)
+
+    args = parser.parse_args()
+    paras = json.load(open("hyper_paras.json"))[args.hyper_paras_name]
+    batch_size = args.batch_size or paras["batch_size"]
+
+    model = BTCModels(model_name=paras["model_name"],
+                      input_shape=paras["input_shape"],
+                      pooling=paras["pooling"],
+                      l2_coeff=paras["l2_coeff"],
+                      drop_rate=paras["drop_rate"],
+                      bn_momentum=paras["bn_momentum"],
+                      initializer=paras["initializer"],
+                      width_mult=paras["width_mult"],
+                      depth_mult=paras["depth_mult"],
+                      scales=paras["scales"],
+                      conv_type=paras["conv_type"],
+                      global_pool=paras["global_pool"],
+                      early_exit=paras["early_exit"]).model
     model.compile(loss="categorical_crossentropy",
-                  optimizer=Adam(lr=1e-3),
+                  optimizer=Adam(lr=paras["lr_start"]),
                   metrics=["accuracy"])
     model.summary()
+    BTCModels.profile(model, batch_size, paras["optimizer"])
+    K.clear_session()
+
+    # A test to print parameters and FLOPs of variants,
+    # each variant is [width_mult, depth_mult, scales]
+    variants = [[1.0, 1.0, [1, 2, 3, 4]],
+                [0.5, 1.0, [1, 2, 3, 4]],
+                [0.25, 1.0, [1, 2, 3, 4]],
+                [1.0, 1.0, [1, 2]],
+                [0.5, 1.0, [1, 2]],
+                [0.5, 1.0, [1]],
+                [0.5, 2.0, [1, 2, 3, 4]]]
+
+    print("\nwidth, depth, scales, params, GFLOPs")
+    for width_mult, depth_mult, scales in variants:
+        model = BTCModels(width_mult=width_mult,
+                          depth_mult=depth_mult,
+                          scales=scales).model
+        print("{0}, {1}, {2}, {3}, {4:.2f}".format(
+              width_mult, depth_mult, "-".join([str(s) for s in scales]),
+              model.count_params(), BTCModels.count_flops(model) / 1e9))
+        K.clear_session()
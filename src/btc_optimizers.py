@@ -0,0 +1,142 @@
+# Brain Tumor Classification
+# Optimizers for training 3D Multi-Scale CNN.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+#     ,,,         ,,,
+#   ;"   ';     ;'   ",
+#   ;  @.ss$$$$$$s.@  ;
+#   `s$$$$$$$$$$$$$$$'
+#   $$$$$$$$$$$$$$$$$$
+#  $$$$P""Y$$$Y""W$$$$$
+#  $$$$  p"$$$"q  $$$$$
+#  $$$$  .$$$$$.  $$$$'
+#   $$$DaU$$O$$DaU$$$'
+#    '$$$$'.^.'$$$$'
+#       '&$$$$$&'
+
+
+from __future__ import print_function
+
+
+from keras import backend as K
+from keras.legacy import interfaces
+from keras.optimizers import Optimizer
+
+
+class AdamAccumulate(Optimizer):
+
+    def __init__(self,
+                 lr=0.001,
+                 beta_1=0.9,
+                 beta_2=0.999,
+                 epsilon=None,
+                 accum_steps=1,
+                 lr_multipliers=None,
+                 **kwargs):
+        '''__INIT__
+
+            Adam optimizer which accumulates gradients over
+            several micro-batches before each update. Gradients
+            are averaged over accumulation steps, thus training
+            with batch size n and accum_steps k is equivalent to
+            training with batch size n * k, except for moving
+            statistics of batch normalization, which are still
+            updated in each micro-batch.
+
+            Inputs:
+            -------
+
+            - lr: float, learning rate, default is 0.001.
+            - beta_1, beta_2: float, exponential decay rates of
+                              the first and second moments.
+            - epsilon: float, fuzz factor, default is K.epsilon().
+            - accum_steps: int, the number of micro-batches whose
+                           gradients are accumulated before each
+                           update. Default is 1.
+            - lr_multipliers: dictionary, name of parameter and the
+                              multiplier of its learning rate. Other
+                              parameters use learning rate as given.
+                              Default is None.
+
+        '''
+
+        super(AdamAccumulate, self).__init__(**kwargs)
+        with K.name_scope(self.__class__.__name__):
+            self.iterations = K.variable(0, dtype="int64", name="iterations")
+            self.lr = K.variable(lr, name="lr")
+            self.beta_1 = K.variable(beta_1, name="beta_1")
+            self.beta_2 = K.variable(beta_2, name="beta_2")
+
+        if epsilon is None:
+            epsilon = K.epsilon()
+        self.epsilon = epsilon
+        self.accum_steps = int(accum_steps)
+        self.lr_multipliers = lr_multipliers or {}
+
+        return
+
+    @interfaces.legacy_get_updates_support
+    def get_updates(self, loss, params):
+        '''GET_UPDATES
+
+            Generate update operations of parameters.
+            Parameters and moments are only changed in
+            the last micro-batch of each accumulation.
+
+        '''
+
+        grads = self.get_gradients(loss, params)
+        self.updates = [K.update_add(self.iterations, 1)]
+
+        # 1 in the last micro-batch of each accumulation, otherwise 0
+        is_update = K.equal((self.iterations + 1) % self.accum_steps, 0)
+        is_update = K.cast(is_update, K.floatx())
+
+        # Index of current update, starts from 1
+        t = K.cast(self.iterations // self.accum_steps + 1, K.floatx())
+        lr_t = self.lr * (K.sqrt(1. - K.pow(self.beta_2, t)) /
+                          (1. - K.pow(self.beta_1, t)))
+
+        shapes = [K.int_shape(p) for p in params]
+        ms = [K.zeros(shape) for shape in shapes]
+        vs = [K.zeros(shape) for shape in shapes]
+        accums = [K.zeros(shape) for shape in shapes]
+        self.weights = [self.iterations] + ms + vs + accums
+
+        for p, g, m, v, a in zip(params, grads, ms, vs, accums):
+            a_t = a + g
+            g_t = a_t / self.accum_steps
+
+            m_t = (self.beta_1 * m) + (1. - self.beta_1) * g_t
+            v_t = (self.beta_2 * v) + (1. - self.beta_2) * K.square(g_t)
+            lr_p = lr_t * self.lr_multipliers.get(p.name, 1.)
+            p_t = p - lr_p * m_t / (K.sqrt(v_t) + self.epsilon)
+
+            # Keep accumulating or apply the update
+            self.updates.append(K.update(m, is_update * m_t + (1. - is_update) * m))
+            self.updates.append(K.update(v, is_update * v_t + (1. - is_update) * v))
+            self.updates.append(K.update(a, (1. - is_update) * a_t))
+
+            new_p = is_update * p_t + (1. - is_update) * p
+            if getattr(p, "constraint", None) is not None:
+                new_p = p.constraint(new_p)
+            self.updates.append(K.update(p, new_p))
+
+        return self.updates
+
+    def get_config(self):
+        '''GET_CONFIG
+
+            Configurations to serialize optimizer.
+
+        '''
+
+        config = {"lr": float(K.get_value(self.lr)),
+                  "beta_1": float(K.get_value(self.beta_1)),
+                  "beta_2": float(K.get_value(self.beta_2)),
+                  "epsilon": self.epsilon,
+                  "accum_steps": self.accum_steps,
+                  "lr_multipliers": self.lr_multipliers}
+        base_config = super(AdamAccumulate, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
@@ -0,0 +1,227 @@
+# Brain Tumor Classification
+# Patch sampling for training and sliding-window prediction.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+#     ,,,         ,,,
+#   ;"   ';     ;'   ",
+#   ;  @.ss$$$$$$s.@  ;
+#   `s$$$$$$$$$$$$$$$'
+#   $$$$$$$$$$$$$$$$$$
+#  $$$$P""Y$$$Y""W$$$$$
+#  $$$$  p"$$$"q  $$$$$
+#  $$$$  .$$$$$.  $$$$'
+#   $$$DaU$$O$$DaU$$$'
+#    '$$$$'.^.'$$$$'
+#       '&$$$$$&'
+
+
+
+from __future__ import print_function
+
+
+import math
+import itertools
+import numpy as np
+from keras.utils import Sequence
+from btc_distributed import shard_indices
+
+
+class PatchSampler(Sequence):
+
+    def __init__(self, x, y, masks=None,
+                 patch_shape=[64, 64, 64],
+                 batch_size=16,
+                 tumor_prob=0.8,
+                 random_state=0,
+                 fixed=False,
+                 rank=0,
+                 size=1):
+        '''__INIT__
+
+            Generate batches of random 3D patches from volumes.
+            Each volume provides one patch in each epoch. With
+            probability tumor_prob, a patch is centered at a random
+            tumor voxel in the mask of volume, otherwise at a random
+            voxel. Patches are labelled as their volumes.
+            Random state of each batch only depends on epoch and
+            index of batch, thus batches can be generated in any
+            order or in parallel workers.
+
+            Inputs:
+            -------
+
+            - x: numpy ndarray in shape [n, 112, 96, 96, 1], images.
+            - y: numpy ndarray in shape [n, 2], labels.
+            - masks: numpy ndarray in shape [n, 112, 96, 96, 1],
+                     tumor masks. Default is None, which means
+                     sampling patches uniformly.
+            - patch_shape: int list, spatial shape of patches,
+                           default is [64, 64, 64].
+            - batch_size: int, the number of patches in each batch.
+            - tumor_prob: float from 0 to 1, probability to center
+                          a patch at tumor. Default is 0.8.
+            - random_state: int, seed of sampling.
+            - fixed: boolean, if True, the same patches are generated
+                     in every epoch, which is used for validation.
+                     Default is False.
+            - rank, size: int, index of worker and the number of
+                          workers in data parallel training, each
+                          worker samples patches from its shard of
+                          volumes, see shard_indices. Default is 0
+                          and 1, which means no sharding.
+
+        '''
+
+        self.x = x
+        self.y = y
+        self.masks = masks
+        self.patch_shape = list(patch_shape)
+        self.batch_size = batch_size
+        self.tumor_prob = tumor_prob if masks is not None else 0.0
+        self.random_state = random_state
+        self.fixed = fixed
+        self.rank = rank
+        self.size = size
+
+        self.volume_shape = list(x.shape[1:4])
+        if any(p > v for p, v in zip(self.patch_shape, self.volume_shape)):
+            raise ValueError("Patch is larger than volume.")
+
+        # Flat indices of tumor voxels in each volume
+        self.tumor_idx = [None] * len(x)
+        self.epoch = 0
+
+        return
+
+    def __len__(self):
+        shard_num = int(math.ceil(len(self.x) / float(self.size)))
+        return int(math.ceil(shard_num / float(self.batch_size)))
+
+    def _tumor_voxels(self, i):
+        '''_TUMOR_VOXELS
+
+            Flat indices of tumor voxels in i-th volume,
+            computed once for each volume.
+
+        '''
+
+        if self.tumor_idx[i] is None:
+            self.tumor_idx[i] = np.flatnonzero(self.masks[i, ..., 0])
+        return self.tumor_idx[i]
+
+    def _corner(self, i, rng):
+        '''_CORNER
+
+            Select the corner of a patch in i-th volume.
+
+        '''
+
+        tumor = self._tumor_voxels(i) if self.tumor_prob > 0 else []
+        if len(tumor) > 0 and rng.rand() < self.tumor_prob:
+            center = np.unravel_index(tumor[rng.randint(len(tumor))],
+                                      self.volume_shape)
+        else:
+            center = [rng.randint(v) for v in self.volume_shape]
+
+        # Keep the patch inside volume
+        return [int(min(max(c - p // 2, 0), v - p)) for c, p, v in
+                zip(center, self.patch_shape, self.volume_shape)]
+
+    def __getitem__(self, idx):
+        '''__GETITEM__
+
+            Generate idx-th batch of patches and labels.
+
+        '''
+
+        seed = self.random_state + \
+            (self.epoch * len(self) + idx) * self.size + self.rank
+        rng = np.random.RandomState(seed % (2 ** 32))
+
+        # Volumes are shuffled in each epoch
+        order = shard_indices(len(self.x), self.rank, self.size,
+                              self.epoch, self.random_state)
+        batch = order[idx * self.batch_size:(idx + 1) * self.batch_size]
+
+        (p0, p1, p2) = self.patch_shape
+        patches = []
+        for i in batch:
+            c0, c1, c2 = self._corner(i, rng)
+            patches.append(self.x[i, c0:c0 + p0, c1:c1 + p1, c2:c2 + p2])
+
+        return np.array(patches), self.y[batch]
+
+    def on_epoch_end(self):
+        if not self.fixed:
+            self.epoch += 1
+        return
+
+
+def window_corners(volume_shape, patch_shape, stride):
+    '''WINDOW_CORNERS
+
+        Corners of overlapping windows which cover the volume.
+        The last window along each axis is aligned to the end.
+
+        Inputs:
+        -------
+
+        - volume_shape: int list, spatial shape of volume.
+        - patch_shape: int list, spatial shape of windows.
+        - stride: int list, step between windows along each axis.
+
+        Output:
+        -------
+
+        - list of corners, each is [c0, c1, c2].
+
+    '''
+
+    starts = []
+    for v, p, s in zip(volume_shape, patch_shape, stride):
+        axis = list(range(0, max(v - p, 0) + 1, s))
+        if axis[-1] != v - p:
+            axis.append(v - p)
+        starts.append(axis)
+
+    return [list(c) for c in itertools.product(*starts)]
+
+
+def sliding_window_predict(model, x, patch_shape, stride, batch_size=16):
+    '''SLIDING_WINDOW_PREDICT
+
+        Predict each volume by averaging class probabilities
+        of overlapping windows. Windows of all volumes are
+        predicted in batches.
+
+        Inputs:
+        -------
+
+        - model: Keras Model, whose inputs are patches.
+        - x: numpy ndarray in shape [n, 112, 96, 96, 1], images.
+        - patch_shape: int list, spatial shape of windows.
+        - stride: int list, step between windows along each axis.
+        - batch_size: int, the number of windows in each batch.
+
+        Output:
+        -------
+
+        - numpy ndarray in shape [n, 2], predictions of volumes.
+
+    '''
+
+    (p0, p1, p2) = patch_shape
+    corners = window_corners(x.shape[1:4], patch_shape, stride)
+    windows = [[i] + c for i in range(len(x)) for c in corners]
+
+    pred = np.zeros([len(x), model.output_shape[-1]])
+    for start in range(0, len(windows), batch_size):
+        batch = windows[start:start + batch_size]
+        patches = np.array([x[i, c0:c0 + p0, c1:c1 + p1, c2:c2 + p2]
+                            for i, c0, c1, c2 in batch])
+        batch_pred = model.predict_on_batch(patches)
+        for (i, _, _, _), p in zip(batch, batch_pred):
+            pred[i] += p
+
+    return pred / len(corners)
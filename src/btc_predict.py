@@ -0,0 +1,444 @@
+# Brain Tumor Classification
+# Predict unlabelled NIfTI images by 3D Multi-Scale CNN.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+#     ,,,         ,,,
+#   ;"   ';     ;'   ",
+#   ;  @.ss$$$$$$s.@  ;
+#   `s$$$$$$$$$$$$$$$'
+#   $$$$$$$$$$$$$$$$$$
+#  $$$$P""Y$$$Y""W$$$$$
+#  $$$$  p"$$$"q  $$$$$
+#  $$$$  .$$$$$.  $$$$'
+#   $$$DaU$$O$$DaU$$$'
+#    '$$$$'.^.'$$$$'
+#       '&$$$$$&'
+
+
+from __future__ import print_function
+
+
+import os
+import csv
+import json
+import time
+import argparse
+import numpy as np
+
+from btc_test import BTCTest
+from btc_preprocess import BTCPreprocess
+from btc_backends import BACKENDS, load_backend, predict_volumes
+from btc_session import session_paras, add_session_args
+from multiprocessing import Pool, cpu_count
+
+
+LABELS = ["LGG", "HGG"]
+COLUMNS = ["path", "lgg_prob", "hgg_prob", "pred", "enhanced", "error"]
+
+
+def load_scan(volume_path, mask_path=None, non_mask_coeff=0.333):
+    '''LOAD_SCAN
+
+        Preprocess one raw image in memory, the result is
+        same as image preprocessed by BTCPreprocess and
+        loaded by BTCDataset:
+        -1- If mask_path is given, enhance tumor region.
+        -2- Remove background and resize image.
+        -3- Rotate image to standard space and normalize it.
+
+        Inputs:
+        -------
+
+        - volume_path: string, path of raw image.
+        - mask_path: string, path of mask of raw image,
+                     default is None.
+        - non_mask_coeff: float from 0 to 1, the coefficient of
+                          voxels in non-tumor region. Default is 0.333.
+
+        Outputs:
+        --------
+
+        - volume: numpy ndarray in shape [112, 96, 96, 1],
+                  None if image can not be preprocessed.
+        - error: string, error message, empty if no error.
+
+    '''
+
+    try:
+        volume = BTCPreprocess.load_nii(volume_path)
+        mask = None
+        if mask_path is not None:
+            mask = BTCPreprocess.load_nii(mask_path)
+        volume = BTCPreprocess.process(volume, mask, non_mask_coeff)
+        volume = BTCPreprocess.volume2nii(volume)
+        return BTCPreprocess.normalize(volume), ""
+    except Exception as e:
+        return None, "{}: {}".format(type(e).__name__, e)
+
+
+def find_mask(dir_path, data_format=".nii.gz"):
+    '''FIND_MASK
+
+        Find mask ("seg" in its name) in given directory.
+
+        Inputs:
+        -------
+
+        - dir_path: string, directory of raw images.
+        - data_format: string, extension of images, default
+                       is ".nii.gz".
+
+        Output:
+        -------
+
+        - string, path of mask, None if no mask is found.
+
+    '''
+
+    if not os.path.isdir(dir_path):
+        return None
+    for name in sorted(os.listdir(dir_path)):
+        if "seg" in name and name.endswith(data_format):
+            return os.path.join(dir_path, name)
+    return None
+
+
+# Helper function to run in multiple processes
+def unwrap_load_scan(arg):
+    return load_scan(*arg)
+
+
+class BTCPredict(object):
+
+    def __init__(self,
+                 paras_name,
+                 paras_json_path,
+                 weights_save_dir,
+                 pred_weights="last",
+                 backend="keras",
+                 batch_size=None,
+                 volume_type="t1ce",
+                 data_format=".nii.gz",
+                 is_mask=True,
+                 non_mask_coeff=0.333,
+                 processes=-1,
+                 session_paras=None):
+        '''__INIT__
+
+            Load trained model once to predict raw images.
+
+            Inputs:
+            -------
+
+            - paras_name: string, name of hyperparameters set,
+                          can be found in hyper_paras.json.
+            - paras_json_path: string, path of file which provides
+                               hyperparamters, "hyper_paras.json"
+                               in this project.
+            - weights_save_dir: string, directory path where saves
+                                trained model.
+            - pred_weights: string, "last" or "best" weights.
+            - backend: string, one of BACKENDS, default is "keras".
+            - batch_size: int, the number of images in each batch,
+                          default is None, which means batch_size
+                          in hyper_paras.json.
+            - volume_type: string, type of brain volume, one of "t1ce",
+                           "t1", "t2" or "flair". Default is "t1ce".
+                           None means all images are predicted.
+            - data_format: string, extension of images, default
+                           is ".nii.gz".
+            - is_mask: boolean, if True, enhance tumor region by mask
+                       ("seg" in its name) in the same folder as image.
+                       Default is True.
+            - non_mask_coeff: float from 0 to 1, the coefficient of
+                              voxels in non-tumor region. Default is 0.333.
+            - processes: int, the number of processes to preprocess
+                         images. Default is -1, which means use all
+                         processes. 0 means no pool is created, and
+                         run is not available.
+            - session_paras: dictionary, threads and CPU affinity,
+                             see set_session in btc_session.py.
+                             Default is None.
+
+        '''
+
+        self.paras = BTCTest.load_paras(paras_json_path, paras_name)
+        self.batch_size = batch_size or self.paras["batch_size"]
+        self.patch_shape = self.paras["patch_shape"]
+        self.patch_stride = self.paras["patch_stride"]
+
+        self.volume_type = volume_type
+        self.data_format = data_format
+        self.is_mask = is_mask
+        self.non_mask_coeff = non_mask_coeff
+
+        # Pool is created before model is loaded, thus processes
+        # are forked without threads of TensorFlow or ONNX Runtime,
+        # and are not pinned on cores of session_paras
+        if processes == -1 or processes > cpu_count():
+            processes = cpu_count()
+        self.pool = Pool(processes=processes) if processes > 0 else None
+
+        self.model = load_backend(backend, paras_name, paras_json_path,
+                                  weights_save_dir, pred_weights,
+                                  session_paras)
+
+        return
+
+    def scan_paths(self, input_dir):
+        '''SCAN_PATHS
+
+            Find images to be predicted in input directory
+            and its sub-directories.
+
+            Input:
+            ------
+
+            - input_dir: string, directory of raw images.
+
+            Output:
+            -------
+
+            - A list, each element is [volume_path, mask_path],
+              mask_path is None if is_mask is False or no mask
+              is found.
+
+        '''
+
+        paths = []
+        for root, _, names in sorted(os.walk(input_dir)):
+            names = sorted(n for n in names if n.endswith(self.data_format))
+            mask_path = None
+            if self.is_mask:
+                mask_path = find_mask(root, self.data_format)
+
+            for name in names:
+                if "seg" in name:
+                    continue
+                if self.volume_type is not None and \
+                   self.volume_type not in name:
+                    continue
+                paths.append([os.path.join(root, name), mask_path])
+
+        return paths
+
+    def predict(self, x):
+        '''PREDICT
+
+            Predict one batch of images, see predict_volumes
+            in btc_backends.py.
+
+            Input:
+            ------
+
+            - x: numpy ndarray in shape [n, 112, 96, 96, 1],
+                 images processed by load_scan.
+
+            Output:
+            -------
+
+            - numpy ndarray in shape [n, 2], probabilities
+              of LGG and HGG.
+
+        '''
+
+        return predict_volumes(self.model, x, self.batch_size,
+                               self.patch_shape, self.patch_stride)
+
+    def _write_batch(self, batch, writer):
+        '''_WRITE_BATCH
+
+            Predict one batch of [volume_path, mask_path, volume]
+            and write probabilities of each image. Time spent in
+            model is returned.
+
+        '''
+
+        start = time.time()
+        pred = self.predict(np.array([b[2] for b in batch]))
+        pred_time = time.time() - start
+
+        for (volume_path, mask_path, _), prob in zip(batch, pred):
+            writer.writerow([volume_path, prob[0], prob[1],
+                             LABELS[int(np.argmax(prob))],
+                             mask_path is not None, ""])
+
+        return pred_time
+
+    def run(self, input_dir, output_path):
+        '''RUN
+
+            Predict all images in input directory. Images are
+            preprocessed in a pool of processes and streamed
+            into model batch by batch, thus preprocessing of
+            next images overlaps prediction of current batch.
+            Probabilities of each image are written in output
+            CSV file as soon as its batch is predicted.
+
+            Inputs:
+            -------
+
+            - input_dir: string, directory of raw images.
+            - output_path: string, path of output CSV file.
+
+            Output:
+            -------
+
+            - float, throughput in scans per second.
+
+        '''
+
+        if self.pool is None:
+            raise ValueError("No pool to preprocess images, processes is 0.")
+
+        paths = self.scan_paths(input_dir)
+        print("\nPredicting {} images in {}\n".format(len(paths), input_dir))
+        if self.is_mask:
+            no_mask = sum(mask_path is None for _, mask_path in paths)
+            if no_mask:
+                print("{} images have no mask, ".format(no_mask) +
+                      "tumor region is not enhanced.")
+
+        output_dir = os.path.dirname(output_path)
+        if output_dir and not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        paras = [[volume_path, mask_path, self.non_mask_coeff]
+                 for volume_path, mask_path in paths]
+
+        start = time.time()
+        pred_time, pred_num = 0.0, 0
+        with open(output_path, "w") as f:
+            writer = csv.writer(f)
+            writer.writerow(COLUMNS)
+
+            batch = []
+            scans = self.pool.imap(unwrap_load_scan, paras)
+            for (volume_path, mask_path), (volume, error) in zip(paths, scans):
+                if volume is None:
+                    print("\tFailed to preprocess: " + volume_path)
+                    writer.writerow([volume_path, "", "", "",
+                                     mask_path is not None, error])
+                    continue
+
+                batch.append([volume_path, mask_path, volume])
+                if len(batch) == self.batch_size:
+                    pred_time += self._write_batch(batch, writer)
+                    pred_num += len(batch)
+                    f.flush()
+                    batch = []
+
+            if batch:
+                pred_time += self._write_batch(batch, writer)
+                pred_num += len(batch)
+
+        elapsed = time.time() - start
+        throughput = pred_num / elapsed if elapsed > 0 else 0.0
+        print("\nPredicted {} of {} images in {:.2f}s".format(
+            pred_num, len(paths), elapsed))
+        print("Throughput: {:.2f} scans/sec, model: {:.2f} scans/sec".format(
+            throughput, pred_num / pred_time if pred_time > 0 else 0.0))
+        print("Predictions are saved in " + output_path)
+
+        return throughput
+
+    def close(self):
+        '''CLOSE
+
+            Stop processes in pool.
+
+        '''
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        return
+
+
+def main(hyper_paras_name, input_dir, output_path,
+         pred_weights=None, batch_size=None, args=None):
+    '''MAIN
+
+        Main process to predict raw images.
+
+        Inputs:
+        -------
+
+        - hyper_paras_name: string, the name of hyperparameters set,
+                            which can be found in hyper_paras.json.
+        - input_dir: string, directory of raw images.
+        - output_path: string, path of output CSV file.
+        - pred_weights: string, "last" or "best", default is None,
+                        which means test_weights in pre_paras.json.
+        - batch_size: int, default is None, which means
+                      batch_size in hyper_paras.json.
+        - args: argparse Namespace, session settings from command
+                line which override pre_paras.json. Default is None.
+
+    '''
+
+    # Basic settings in pre_paras.json
+    pre_paras_path = "pre_paras.json"
+    pre_paras = json.load(open(pre_paras_path))
+
+    # Set directory of weights
+    parent_dir = os.path.dirname(os.getcwd())
+    weights_save_dir = os.path.join(parent_dir, pre_paras["weights_save_dir"])
+
+    backend = pre_paras["backend"]
+    if args is not None and args.backend is not None:
+        backend = args.backend
+
+    predict = BTCPredict(paras_name=hyper_paras_name,
+                         paras_json_path=pre_paras["paras_json_path"],
+                         weights_save_dir=weights_save_dir,
+                         pred_weights=pred_weights or pre_paras["test_weights"],
+                         backend=backend,
+                         batch_size=batch_size,
+                         volume_type=pre_paras["volume_type"],
+                         data_format=pre_paras["data_format"],
+                         is_mask=pre_paras["is_mask"],
+                         non_mask_coeff=pre_paras["non_mask_coeff"],
+                         processes=pre_paras["processes_num"],
+                         session_paras=session_paras(pre_paras, args))
+    try:
+        predict.run(input_dir, output_path)
+    finally:
+        predict.close()
+
+    return
+
+
+if __name__ == "__main__":
+
+    # Command line
+    # python btc_predict.py --paras=paras-1 --input=../data/New --output=pred.csv
+
+    parser = argparse.ArgumentParser()
+
+    help_str = "Select a set of hyper-parameters in hyper_paras.json."
+    parser.add_argument("--paras", action="store", default="paras-1",
+                        dest="hyper_paras_name", help=help_str)
+    help_str = "Directory of raw NIfTI images to be predicted."
+    parser.add_argument("--input", action="store", required=True,
+                        dest="input_dir", help=help_str)
+    help_str = "Path of output CSV file."
+    parser.add_argument("--output", action="store", default="predictions.csv",
+                        dest="output_path", help=help_str)
+    help_str = "Weights to predict, last or best."
+    parser.add_argument("--weights", action="store", default=None,
+                        choices=["last", "best"],
+                        dest="pred_weights", help=help_str)
+    help_str = "The number of images in each batch."
+    parser.add_argument("--batch_size", action="store", type=int,
+                        default=None, dest="batch_size", help=help_str)
+    help_str = "Backend to predict, overrides pre_paras.json."
+    parser.add_argument("--backend", action="store", default=None,
+                        choices=BACKENDS, dest="backend", help=help_str)
+    add_session_args(parser)
+
+    args = parser.parse_args()
+    main(args.hyper_paras_name, args.input_dir, args.output_path,
+         args.pred_weights, args.batch_size, args)
@@ -66,7 +66,8 @@ class BTCPreprocess(object):
 
         return
 
-    def run(self, is_mask=True, non_mask_coeff=0.333, processes=-1):
+    def run(self, is_mask=True, non_mask_coeff=0.333, processes=-1,
+            save_mask=False):
         '''RUN
 
             Function to map task to multiple processes.
@@ -80,6 +81,9 @@ class BTCPreprocess(object):
                               voxels in non-tumor region. Default is 0.333.
             - processes: int, the number of processes used. Default is -1,
                          which means use all processes.
+            - save_mask: boolean, if True, mask is trimmed and resized
+                         as image, and saved in the same folder.
+                         Default is False.
 
         '''
 
@@ -88,7 +92,8 @@ class BTCPreprocess(object):
 
         # Generate parameters
         paras = zip([self] * num, self.in_paths, self.out_paths, self.mask_paths,
-                    [is_mask] * num, [non_mask_coeff] * num)
+                    [is_mask] * num, [non_mask_coeff] * num,
+                    [save_mask] * num)
 
         # Set the number of processes
         if processes == -1 or processes > cpu_count():
@@ -101,7 +106,8 @@ class BTCPreprocess(object):
         return
 
     def _preprocess(self, in_path, to_path, mask_path,
-                    is_mask=True, non_mask_coeff=0.333):
+                    is_mask=True, non_mask_coeff=0.333,
+                    save_mask=False):
         '''_PREPROCESS
 
             For each input image, four steps are done:
@@ -109,6 +115,8 @@ class BTCPreprocess(object):
             -2- Remove background.
             -3- Resize image.
             -4- Save image.
+            If save_mask, mask is trimmed in the same area, resized
+            by nearest neighbour and saved with its original name.
 
             Inputs:
             -------
@@ -120,6 +128,8 @@ class BTCPreprocess(object):
                        Default is True.
             - non_mask_coeff: float from 0 to 1, the coefficient of
                               voxels in non-tumor region. Default is 0.333.
+            - save_mask: boolean, if True, save preprocessed mask.
+                         Default is False.
 
         '''
 
@@ -127,14 +137,21 @@ class BTCPreprocess(object):
             print("Preprocessing on: " + in_path)
             # Load image
             volume = self.load_nii(in_path)
-            if is_mask:
-                # Enhance tumor region
+            mask = None
+            if is_mask or save_mask:
                 mask = self.load_nii(mask_path)
-                volume = self.segment(volume, mask, non_mask_coeff)
-            # Removce background
-            volume = self.trim(volume)
-            # Resize image
-            volume = self.resize(volume, [112, 112, 96])
+            if save_mask:
+                # Trim, resize and save mask as image
+                enhanced = self.segment(volume, mask, non_mask_coeff) \
+                    if is_mask else volume
+                mask_out = self.trim(mask, reference=enhanced)
+                mask_out = self.resize(mask_out, [112, 112, 96], order=0)
+                mask_to_path = os.path.join(os.path.dirname(to_path),
+                                            os.path.basename(mask_path))
+                self.save2nii(mask_to_path, mask_out)
+            # Enhance tumor region, remove background and resize image
+            volume = self.process(volume, mask if is_mask else None,
+                                  non_mask_coeff)
             # Save image
             self.save2nii(to_path, volume)
         except RuntimeError:
@@ -269,15 +286,19 @@ class BTCPreprocess(object):
         return segged
 
     @staticmethod
-    def trim(volume):
+    def trim(volume, reference=None):
         '''TRIM
 
             Remove unnecessary background around brain.
 
-            Input:
-            ------
+            Inputs:
+            -------
 
             - volume: numpy ndarray, input image.
+            - reference: numpy ndarray, image to find the area
+                         of brain, default is None, which means
+                         volume itself. It is used to trim mask
+                         in the same area as image.
 
             Output:
             -------
@@ -286,18 +307,22 @@ class BTCPreprocess(object):
 
         '''
 
+        if reference is None:
+            reference = volume
+
         # Get indices of slices that have brain's voxels
-        non_zero_slices = [i for i in range(volume.shape[-1])
-                           if np.sum(volume[..., i]) > 0]
+        non_zero_slices = [i for i in range(reference.shape[-1])
+                           if np.sum(reference[..., i]) > 0]
         # Remove slices that only have background
         volume = volume[..., non_zero_slices]
+        reference = reference[..., non_zero_slices]
 
         # In each slice, find the minimum area of brain
         # Coordinates of area are saved
         row_begins, row_ends = [], []
         col_begins, col_ends = [], []
         for i in range(volume.shape[-1]):
-            non_zero_pixels = np.where(volume > 0)
+            non_zero_pixels = np.where(reference > 0)
             row_begins.append(np.min(non_zero_pixels[0]))
             row_ends.append(np.max(non_zero_pixels[0]))
             col_begins.append(np.min(non_zero_pixels[1]))
@@ -325,12 +350,14 @@ class BTCPreprocess(object):
         return trimmed
 
     @staticmethod
-    def resize(volume, target_shape=[112, 112, 96]):
+    def resize(volume, target_shape=[112, 112, 96], order=1):
         '''RESIZE
 
             Resize input image to target shape.
             -1- Resize to [112, 112, 96].
             -2- Crop image to [112, 96, 96].
+            Masks should be resized with order 0 (nearest
+            neighbour) to keep labels.
 
         '''
 
@@ -339,13 +366,100 @@ class BTCPreprocess(object):
 
         # Resize image
         factor = [n / float(o) for n, o in zip(target_shape, old_shape)]
-        resized = zoom(volume, zoom=factor, order=1, prefilter=False)
+        resized = zoom(volume, zoom=factor, order=order, prefilter=False)
 
         # Crop image
         resized = resized[:, 8:104, :]
 
         return resized
 
+    @staticmethod
+    def process(volume, mask=None, non_mask_coeff=0.333):
+        '''PROCESS
+
+            Preprocess one image in memory:
+            -1- If mask is given, enhance tumor region.
+            -2- Remove background.
+            -3- Resize image.
+
+            Inputs:
+            -------
+
+            - volume: numpy ndarray, image loaded by load_nii.
+            - mask: numpy ndarray, mask with segmentation labels,
+                    default is None, which means no enhancement.
+            - non_mask_coeff: float from 0 to 1, the coefficient of
+                              voxels in non-tumor region. Default is 0.333.
+
+            Output:
+            -------
+
+            - numpy ndarray, preprocessed image.
+
+        '''
+
+        if mask is not None:
+            volume = BTCPreprocess.segment(volume, mask, non_mask_coeff)
+        volume = BTCPreprocess.trim(volume)
+        return BTCPreprocess.resize(volume, [112, 112, 96])
+
+    @staticmethod
+    def volume2nii(volume):
+        '''VOLUME2NII
+
+            Convert preprocessed image into the array which is
+            saved in NIfTi image and loaded by BTCDataset.
+
+            Input:
+            ------
+
+            - volume: numpy ndarray, preprocessed image.
+
+            Output:
+            -------
+
+            - numpy ndarray in int16.
+
+        '''
+
+        # Rotate image to standard space
+        volume = volume.astype(np.int16)
+        return np.rot90(volume, 3)
+
+    @staticmethod
+    def normalize(volume):
+        '''NORMALIZE
+
+            Rotate image to standard space and normalize it
+            by mean and std of brain object.
+
+            Input:
+            ------
+
+            - volume: numpy ndarray, image in NIfTI file which
+                      is saved by save2nii.
+
+            Output:
+            -------
+
+            - numpy ndarray in shape [112, 96, 96, 1].
+
+        '''
+
+        # Rotate image to standard space
+        volume = np.transpose(volume, axes=[1, 0, 2])
+        volume = np.flipud(volume)
+
+        # Extract mean and std from brain object
+        volume_obj = volume[volume > 0]
+        obj_mean = np.mean(volume_obj)
+        obj_std = np.std(volume_obj)
+        # Normalize whole image
+        volume = (volume - obj_mean) / obj_std
+
+        volume = np.expand_dims(volume, axis=3)
+        return volume.astype(np.float32)
+
     @staticmethod
     def save2nii(to_path, volume):
         '''SAVE2NII
@@ -360,8 +474,7 @@ class BTCPreprocess(object):
 
         '''
         # Rotate image to standard space
-        volume = volume.astype(np.int16)
-        volume = np.rot90(volume, 3)
+        volume = BTCPreprocess.volume2nii(volume)
 
         # Convert to NIfTi
         volume_nii = nib.Nifti1Image(volume, np.eye(4))
@@ -0,0 +1,710 @@
+# Brain Tumor Classification
+# Prune 3D Multi-Scale CNN by magnitude or by channel.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+#     ,,,         ,,,
+#   ;"   ';     ;'   ",
+#   ;  @.ss$$$$$$s.@  ;
+#   `s$$$$$$$$$$$$$$$'
+#   $$$$$$$$$$$$$$$$$$
+#  $$$$P""Y$$$Y""W$$$$$
+#  $$$$  p"$$$"q  $$$$$
+#  $$$$  .$$$$$.  $$$$'
+#   $$$DaU$$O$$DaU$$$'
+#    '$$$$'.^.'$$$$'
+#       '&$$$$$&'
+
+
+from __future__ import print_function
+
+
+import os
+import re
+import glob
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+from keras import backend as K
+from keras.layers import *
+from keras.callbacks import Callback
+from btc_test import BTCTest
+from btc_models import BTCModels
+from btc_backends import (models_paras,
+                          median_latency,
+                          predict_volumes)
+from btc_session import (set_session,
+                         session_paras,
+                         add_session_args)
+
+
+# Layers which keep channels of their inputs
+PASS_LAYERS = (BatchNormalization, MaxPooling3D, AveragePooling3D,
+               GlobalMaxPooling3D, GlobalAveragePooling3D,
+               UpSampling3D, Dropout, Activation)
+
+
+def prunable_layers(model):
+    '''PRUNABLE_LAYERS
+
+        Convolutional and dense layers except output layers.
+
+        Input:
+        ------
+
+        - model: Keras Models instance.
+
+        Output:
+        -------
+
+        - list of Keras Layer instances.
+
+    '''
+
+    outputs = [tensor.name for tensor in model.outputs]
+    return [layer for layer in model.layers
+            if isinstance(layer, (Conv3D, Dense)) and
+            layer.output.name not in outputs]
+
+
+def channel_groups(model):
+    '''CHANNEL_GROUPS
+
+        Group prunable layers whose output channels are added
+        together, such as conv4 and conv5 by sum1. Channels of
+        layers in one group are pruned together. In pyramid
+        model, groups of convolutional layers are conv1,
+        [conv2, conv7], [conv3, conv6], [conv4, conv5] and conv8.
+
+        Input:
+        ------
+
+        - model: Keras Models instance.
+
+        Output:
+        -------
+
+        - list of string lists, names of layers in each group.
+
+    '''
+
+    names = [layer.name for layer in prunable_layers(model)]
+    parent = {name: name for name in names}
+    # Layers whose channels are added with unprunable ones
+    blocked = []
+
+    def find(name):
+        while parent[name] != name:
+            name = parent[name]
+        return name
+
+    # Helper function to find the layer which
+    # produces channels of a tensor
+    def source(tensor):
+        layer = tensor._keras_history[0]
+        if isinstance(layer, PASS_LAYERS):
+            return source(layer.input)
+        if isinstance(layer, Add):
+            return source(layer.input[0])
+        return layer.name if layer.name in parent else None
+
+    for layer in model.layers:
+        if isinstance(layer, Add):
+            sources = [source(tensor) for tensor in layer.input]
+            if None in sources:
+                blocked += [name for name in sources if name is not None]
+                continue
+            for name in sources[1:]:
+                parent[find(name)] = find(sources[0])
+
+    groups = {}
+    for name in names:
+        groups.setdefault(find(name), []).append(name)
+    return [group for group in groups.values()
+            if not any([name in blocked for name in group])]
+
+
+def tensor_masks(model, layer_masks):
+    '''TENSOR_MASKS
+
+        Propagate channel masks of prunable layers through
+        model, the mask of a tensor indicates which elements
+        in its last axis are kept.
+
+        Inputs:
+        -------
+
+        - model: Keras Models instance.
+        - layer_masks: dictionary, name of layer and mask of its
+                       output channels, 1 for kept, 0 for pruned.
+
+        Output:
+        -------
+
+        - masks: dictionary, name of tensor and its mask.
+
+    '''
+
+    masks = {}
+    for layer in model.layers:
+        channels = K.int_shape(layer.output)[-1]
+        if isinstance(layer, InputLayer):
+            mask = np.ones(channels)
+        elif layer.name in layer_masks:
+            mask = layer_masks[layer.name]
+        elif isinstance(layer, (Conv3D, Dense)):
+            mask = np.ones(channels)
+        elif isinstance(layer, Concatenate):
+            mask = np.concatenate([masks[t.name] for t in layer.input])
+        elif isinstance(layer, Flatten):
+            # Channels are the last axis before flattening
+            in_mask = masks[layer.input.name]
+            mask = np.tile(in_mask, channels // len(in_mask))
+        elif isinstance(layer, Add):
+            mask = np.max([masks[t.name] for t in layer.input], axis=0)
+        else:
+            mask = masks[layer.input.name]
+        masks[layer.output.name] = mask
+
+    return masks
+
+
+def channel_masks(model, groups, sparsity):
+    '''CHANNEL_MASKS
+
+        Prune channels of each group by L1 norm. The score of a
+        channel is the sum of mean absolute kernel weights of the
+        channel in each layer of the group. A proportion of
+        sparsity channels with the lowest scores are pruned,
+        at least one channel is kept.
+
+        Inputs:
+        -------
+
+        - model: Keras Models instance.
+        - groups: list of string lists, see channel_groups.
+        - sparsity: float, proportion of channels to be pruned.
+
+        Output:
+        -------
+
+        - layer_masks: dictionary, name of layer and its mask.
+
+    '''
+
+    layer_masks = {}
+    for group in groups:
+        kernels = [K.get_value(model.get_layer(name).kernel)
+                   for name in group]
+        scores = sum([np.abs(k.reshape(-1, k.shape[-1])).mean(axis=0)
+                      for k in kernels])
+
+        pruned_num = min(int(sparsity * len(scores)), len(scores) - 1)
+        mask = np.ones(len(scores))
+        mask[np.argsort(scores)[:pruned_num]] = 0
+        for name in group:
+            layer_masks[name] = mask
+
+    return layer_masks
+
+
+def weights_masks(model, groups):
+    '''WEIGHTS_MASKS
+
+        Recover channel masks from pruned weights, a channel
+        is pruned if its kernel weights and bias are zero in
+        each layer of the group.
+
+        Inputs:
+        -------
+
+        - model: Keras Models instance with pruned weights.
+        - groups: list of string lists, see channel_groups.
+
+        Output:
+        -------
+
+        - layer_masks: dictionary, name of layer and its mask.
+
+    '''
+
+    layer_masks = {}
+    for group in groups:
+        mask = 0
+        for name in group:
+            kernel, bias = model.get_layer(name).get_weights()
+            kernel = kernel.reshape(-1, kernel.shape[-1])
+            mask = mask + np.abs(kernel).sum(axis=0) + np.abs(bias)
+        mask = (mask > 0).astype(np.float32)
+        if not mask.any():
+            # Keep at least one channel
+            mask[0] = 1
+        for name in group:
+            layer_masks[name] = mask
+
+    return layer_masks
+
+
+def shrink_model(model, paras, groups):
+    '''SHRINK_MODEL
+
+        Build model without pruned channels, and copy kept
+        weights from model whose channels are pruned by masks.
+
+        Inputs:
+        -------
+
+        - model: Keras Models instance with pruned weights.
+        - paras: dictionary, a set in hyper_paras.json.
+        - groups: list of string lists, see channel_groups.
+
+        Outputs:
+        --------
+
+        - small: Keras Models instance without pruned channels.
+        - filters: dictionary, name of layer and its number of
+                   filters or units, see BTCModels.
+
+    '''
+
+    layer_masks = weights_masks(model, groups)
+    filters = {name: int(mask.sum()) for name, mask in layer_masks.items()}
+    small = BTCModels(filters=filters, **models_paras(paras)).model
+
+    masks = tensor_masks(model, layer_masks)
+    for layer in model.layers:
+        weights = layer.get_weights()
+        if not weights:
+            continue
+
+        kept_in = np.flatnonzero(masks[layer.input.name])
+        kept_out = np.flatnonzero(masks[layer.output.name])
+        if isinstance(layer, (Conv3D, Dense)):
+            kernel, bias = weights
+            kernel = kernel[..., kept_in, :][..., kept_out]
+            weights = [kernel, bias[kept_out]]
+        elif isinstance(layer, BatchNormalization):
+            weights = [w[kept_out] for w in weights]
+        small.get_layer(layer.name).set_weights(weights)
+
+    return small, filters
+
+
+def save_sparse(model, npz_path):
+    '''SAVE_SPARSE
+
+        Save weights in compressed sparse format, each weight
+        is saved as flat indices of nonzero values, the values
+        and its shape.
+
+        Inputs:
+        -------
+
+        - model: Keras Models instance.
+        - npz_path: string, path of npz file.
+
+    '''
+
+    arrays = {}
+    for layer in model.layers:
+        for i, w in enumerate(layer.get_weights()):
+            key = "{0}/{1}".format(layer.name, i)
+            idx = np.flatnonzero(w)
+            arrays[key + "/indices"] = idx.astype(np.int32)
+            arrays[key + "/values"] = w.ravel()[idx]
+            arrays[key + "/shape"] = np.array(w.shape)
+    np.savez_compressed(npz_path, **arrays)
+
+    return
+
+
+def load_sparse(model, npz_path):
+    '''LOAD_SPARSE
+
+        Load weights saved by save_sparse into model.
+
+        Inputs:
+        -------
+
+        - model: Keras Models instance, in the same structure
+                 as the model whose weights are saved.
+        - npz_path: string, path of npz file.
+
+    '''
+
+    arrays = np.load(npz_path)
+    for layer in model.layers:
+        weights = []
+        for i, w in enumerate(layer.get_weights()):
+            key = "{0}/{1}".format(layer.name, i)
+            value = np.zeros(int(np.prod(arrays[key + "/shape"])), w.dtype)
+            value[arrays[key + "/indices"]] = arrays[key + "/values"]
+            weights.append(value.reshape(arrays[key + "/shape"]))
+        if weights:
+            layer.set_weights(weights)
+
+    return
+
+
+class Pruning(Callback):
+
+    def __init__(self, mode, schedule, snapshot_path=None, hvd=None):
+        '''__INIT__
+
+            Prune model while training. At each epoch in schedule,
+            masks are computed from current weights to reach the
+            sparsity, and pruned weights are set to zero after each
+            batch. Weights at the end of each sparsity level are
+            saved as snapshots.
+            - "magnitude": weights of kernels with the lowest
+                           absolute values in each prunable layer.
+            - "channel": channels of each group (see channel_groups)
+                         with the lowest L1 norm, including bias and
+                         gamma and beta of following batch
+                         normalization, thus pruned channels are
+                         exactly zero and can be removed.
+
+            Inputs:
+            -------
+
+            - mode: string, "magnitude" or "channel".
+            - schedule: list of [epoch, sparsity], sorted by epoch.
+            - snapshot_path: string, path of snapshots with a field
+                             of sparsity, such as pruned_{:.2f}.h5.
+                             Default is None, which saves nothing.
+            - hvd: Horovod module in distributed training, masks
+                   of the chief are sent to all workers. Default
+                   is None.
+
+        '''
+
+        super(Pruning, self).__init__()
+        if mode not in ["magnitude", "channel"]:
+            raise ValueError("Unknown pruning mode: " + mode)
+
+        self.mode = mode
+        self.schedule = sorted(schedule)
+        self.snapshot_path = snapshot_path
+        self.hvd = hvd
+        self.sparsity = None
+        self.updates_num = 0
+
+        return
+
+    def set_model(self, model):
+        '''SET_MODEL
+
+            Create masks and operations to apply them.
+
+        '''
+
+        super(Pruning, self).set_model(model)
+        # Masks are recomputed in the next epoch
+        self.sparsity = None
+
+        self.groups = channel_groups(model)
+        self.layers = prunable_layers(model)
+        if self.mode == "magnitude":
+            weights = [layer.kernel for layer in self.layers]
+        else:
+            # Batch normalization following pruned channels
+            names = sum(self.groups, [])
+            masks = tensor_masks(model, {name: np.zeros(
+                K.int_shape(model.get_layer(name).output)[-1])
+                for name in names})
+            self.bns = [layer for layer in model.layers
+                        if isinstance(layer, BatchNormalization) and
+                        not masks[layer.input.name].all()]
+            weights = [w for layer in self.layers if layer.name in names
+                       for w in [layer.kernel, layer.bias]] + \
+                      [w for layer in self.bns for w in [layer.gamma, layer.beta]]
+
+        self.weights = weights
+        self.masks = [K.variable(np.ones(K.int_shape(w))) for w in weights]
+        self.apply_ops = [K.update(w, w * m)
+                          for w, m in zip(self.weights, self.masks)]
+
+        return
+
+    def _level(self, epoch):
+        '''_LEVEL
+
+            Sparsity in given epoch.
+
+        '''
+
+        sparsity = 0.0
+        for start, level in self.schedule:
+            if epoch >= start:
+                sparsity = level
+        return sparsity
+
+    def _update_masks(self, sparsity):
+        '''_UPDATE_MASKS
+
+            Compute masks of given sparsity and apply them.
+
+        '''
+
+        if self.mode == "magnitude":
+            values = []
+            for w in K.batch_get_value(self.weights):
+                mask = np.ones(w.size)
+                mask[np.argsort(np.abs(w).ravel())[:int(sparsity * w.size)]] = 0
+                values.append(mask.reshape(w.shape))
+        else:
+            layer_masks = channel_masks(self.model, self.groups, sparsity)
+            masks = tensor_masks(self.model, layer_masks)
+            values = [layer_masks[layer.name] * np.ones(K.int_shape(w))
+                      for layer in self.layers if layer.name in layer_masks
+                      for w in [layer.kernel, layer.bias]] + \
+                     [masks[layer.input.name] for layer in self.bns
+                      for _ in range(2)]
+
+        if self.hvd is not None:
+            # Weights may differ among workers before broadcasting
+            values = [self.hvd.broadcast(value, 0, name="prune_mask_{0}_{1}".format(
+                      self.updates_num, i)) for i, value in enumerate(values)]
+        self.updates_num += 1
+
+        K.batch_set_value(list(zip(self.masks, values)))
+        K.get_session().run(self.apply_ops)
+        print("Pruning sparsity:", sparsity)
+
+        return
+
+    def _snapshot(self):
+        '''_SNAPSHOT
+
+            Save weights of current sparsity.
+
+        '''
+
+        if self.snapshot_path is not None and self.sparsity is not None:
+            self.model.save_weights(self.snapshot_path.format(self.sparsity))
+        return
+
+    def on_epoch_begin(self, epoch, logs=None):
+        sparsity = self._level(epoch)
+        if sparsity != self.sparsity:
+            self._snapshot()
+            self._update_masks(sparsity)
+            self.sparsity = sparsity
+        return
+
+    def on_batch_end(self, batch, logs=None):
+        K.get_session().run(self.apply_ops)
+        return
+
+    def on_train_end(self, logs=None):
+        self._snapshot()
+        return
+
+
+class BTCPrune(object):
+
+    def __init__(self,
+                 paras_name,
+                 paras_json_path,
+                 weights_save_dir,
+                 results_save_dir,
+                 repeats=10,
+                 tolerance=1e-4,
+                 session_paras=None):
+        '''__INIT__
+
+            Set configurations before exporting pruned models.
+
+            Inputs:
+            -------
+
+            - paras_name: string, name of hyperparameters set,
+                          can be found in hyper_paras.json.
+            - paras_json_path: string, path of file which provides
+                               hyperparamters, "hyper_paras.json"
+                               in this project.
+            - weights_save_dir: string, directory path where saves
+                                trained model.
+            - results_save_dir: string, dorectory to save results.
+            - repeats: int, the number of timed runs, median latency
+                       is reported. Default is 10.
+            - tolerance: float, the maximum absolute difference of
+                         predictions between masked and shrunk
+                         model. Default is 1e-4.
+            - session_paras: dictionary, threads and CPU affinity
+                             of TensorFlow session, see set_session
+                             in btc_session.py. Default is None.
+
+        '''
+
+        self.paras = BTCTest.load_paras(paras_json_path, paras_name)
+        self.mode = self.paras["prune_mode"]
+        self.batch_size = self.paras["batch_size"]
+        self.patch_shape = self.paras["patch_shape"]
+        self.patch_stride = self.paras["patch_stride"]
+        self.repeats = repeats
+        self.tolerance = tolerance
+        self.session_paras = session_paras
+
+        self.weights_dir = os.path.join(weights_save_dir, paras_name)
+        self.results_dir = os.path.join(results_save_dir, paras_name)
+        BTCTest.create_dir(self.results_dir, rm=False)
+        self.report_path = os.path.join(self.results_dir, "prune_report.csv")
+
+        return
+
+    def _predict(self, model, x):
+        return predict_volumes(model, x, self.batch_size,
+                               self.patch_shape, self.patch_stride)
+
+    def _latency(self, model, x):
+        return median_latency(model, x, self.repeats,
+                              batch_size=self.batch_size,
+                              patch_shape=self.patch_shape,
+                              patch_stride=self.patch_stride)
+
+    def run(self, data):
+        '''RUN
+
+            Export snapshots pruned_[sparsity].h5 saved while
+            training, and evaluate them on testing set.
+            - "channel": pruned channels are removed, weights of the
+                         smaller model are saved in
+                         pruned_[sparsity]_small.h5, and its filters
+                         in pruned_[sparsity]_filters.json.
+            - "magnitude": weights are saved in sparse format in
+                           pruned_[sparsity]_sparse.npz, and reloaded
+                           into a new model to be checked, latency
+                           is measured on dense kernels.
+            Parameters, file size, latency and metrics of each
+            sparsity are saved in prune_report.csv.
+
+            Input:
+            ------
+
+            - data: an BTCDataset instance, including features and
+                    labels of training, validation and testing set.
+
+        '''
+
+        print("\nExporting pruned models.\n")
+
+        pattern = re.compile(r"pruned_([0-9.]+)\.h5$")
+        snapshots = sorted([[float(pattern.search(path).group(1)), path]
+                            for path in glob.glob(os.path.join(
+                                self.weights_dir, "pruned_*.h5"))
+                            if pattern.search(path)])
+        if not snapshots:
+            raise IOError("No pruned snapshot in " + self.weights_dir)
+
+        rows = []
+        for sparsity, path in snapshots:
+            prefix = os.path.splitext(path)[0]
+
+            if self.session_paras is not None:
+                set_session(**self.session_paras)
+            model = BTCModels(**models_paras(self.paras)).model
+            model.load_weights(path)
+
+            if self.mode == "channel":
+                exported, filters = shrink_model(model, self.paras,
+                                                 channel_groups(model))
+                exported.save_weights(prefix + "_small.h5")
+                with open(prefix + "_filters.json", "w") as f:
+                    json.dump(filters, f, indent=4)
+                export_path = prefix + "_small.h5"
+            else:
+                # Check weights reloaded from sparse format
+                export_path = prefix + "_sparse.npz"
+                save_sparse(model, export_path)
+                exported = BTCModels(**models_paras(self.paras)).model
+                load_sparse(exported, export_path)
+
+            pred = self._predict(exported, data.test_x)
+            diff = np.max(np.abs(pred - self._predict(model, data.test_x)))
+            if diff > self.tolerance:
+                raise RuntimeError("Predictions of exported model differ "
+                                   "by {:.2e}.".format(diff))
+
+            results = BTCTest.compute_metrics(data.test_y, pred)
+            nonzero = sum([np.count_nonzero(w) for w in model.get_weights()])
+            results.update({"sparsity": sparsity,
+                            "params": exported.count_params(),
+                            "nonzero_params": int(nonzero),
+                            "file_mb": os.path.getsize(export_path) / 1024.0 ** 2,
+                            "latency_ms": self._latency(exported, data.test_x),
+                            "max_diff": diff})
+            rows.append(results)
+            K.clear_session()
+
+        columns = ["sparsity", "params", "nonzero_params", "file_mb",
+                   "latency_ms", "acc", "roc_auc", "loss", "max_diff"]
+        report = pd.DataFrame(rows)[columns]
+        print(report.to_string(index=False))
+        report.to_csv(self.report_path, index=False)
+
+        return
+
+
+def main(hyper_paras_name, args=None):
+    '''MAIN
+
+        Main process to export pruned models.
+
+        Inputs:
+        -------
+
+        - hyper_paras_name: string, the name of hyperparameters set,
+                            which can be found in hyper_paras.json.
+        - args: argparse Namespace, session settings from command
+                line which override pre_paras.json. Default is None.
+
+    '''
+
+    from btc_dataset import load_dataset
+
+    # Basic settings in pre_paras.json
+    pre_paras_path = "pre_paras.json"
+    pre_paras = json.load(open(pre_paras_path))
+
+    # Get root path of input data
+    parent_dir = os.path.dirname(os.getcwd())
+    data_dir = os.path.join(parent_dir, pre_paras["data_dir"])
+
+    # Set directories of preprocessed images
+    hgg_dir = os.path.join(data_dir, pre_paras["hgg_out"])
+    lgg_dir = os.path.join(data_dir, pre_paras["lgg_out"])
+
+    # Set directories of weights and results
+    weights_save_dir = os.path.join(parent_dir, pre_paras["weights_save_dir"])
+    results_save_dir = os.path.join(parent_dir, pre_paras["results_save_dir"])
+
+    # Partition dataset
+    data = load_dataset(hgg_dir, lgg_dir, pre_paras)
+
+    prune = BTCPrune(paras_name=hyper_paras_name,
+                     paras_json_path=pre_paras["paras_json_path"],
+                     weights_save_dir=weights_save_dir,
+                     results_save_dir=results_save_dir,
+                     session_paras=session_paras(pre_paras, args))
+    prune.run(data)
+
+    return
+
+
+if __name__ == "__main__":
+
+    # Command line
+    # python btc_prune.py --paras=paras-1
+
+    parser = argparse.ArgumentParser()
+
+    help_str = "Select a set of hyper-parameters in hyper_paras.json."
+    parser.add_argument("--paras", action="store", default="paras-1",
+                        dest="hyper_paras_name", help=help_str)
+    add_session_args(parser)
+
+    args = parser.parse_args()
+    main(args.hyper_paras_name, args)
@@ -0,0 +1,315 @@
+# Brain Tumor Classification
+# Quantize 3D Multi-Scale CNN into int8.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+#     ,,,         ,,,
+#   ;"   ';     ;'   ",
+#   ;  @.ss$$$$$$s.@  ;
+#   `s$$$$$$$$$$$$$$$'
+#   $$$$$$$$$$$$$$$$$$
+#  $$$$P""Y$$$Y""W$$$$$
+#  $$$$  p"$$$"q  $$$$$
+#  $$$$  .$$$$$.  $$$$'
+#   $$$DaU$$O$$DaU$$$'
+#    '$$$$'.^.'$$$$'
+#       '&$$$$$&'
+
+
+from __future__ import print_function
+
+
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+from btc_test import BTCTest, METRICS
+from btc_patches import PatchSampler
+from btc_backends import (OnnxModel,
+                          load_backend,
+                          median_latency,
+                          predict_volumes)
+from btc_session import session_paras, add_session_args
+from onnxruntime.quantization import (QuantType,
+                                      QuantFormat,
+                                      quantize_static,
+                                      CalibrationDataReader)
+
+
+class CalibrationReader(CalibrationDataReader):
+
+    def __init__(self, x, input_name, batch_size=1):
+        '''__INIT__
+
+            Feed calibration samples to quantize_static.
+
+            Inputs:
+            -------
+
+            - x: numpy ndarray, calibration samples.
+            - input_name: string, name of input of ONNX model.
+            - batch_size: int, the number of samples in each batch.
+
+        '''
+
+        self.x = x.astype(np.float32)
+        self.input_name = input_name
+        self.batch_size = batch_size
+        self.start = 0
+
+        return
+
+    def get_next(self):
+        if self.start >= len(self.x):
+            return None
+        batch = self.x[self.start:self.start + self.batch_size]
+        self.start += self.batch_size
+        return {self.input_name: batch}
+
+    def rewind(self):
+        self.start = 0
+        return
+
+
+class BTCQuantize(object):
+
+    def __init__(self,
+                 paras_name,
+                 paras_json_path,
+                 weights_save_dir,
+                 results_save_dir,
+                 quant_weights="last",
+                 calib_num=32,
+                 per_channel=True,
+                 repeats=10,
+                 session_paras=None):
+        '''__INIT__
+
+            Set configurations before quantizing model.
+
+            Inputs:
+            -------
+
+            - paras_name: string, name of hyperparameters set,
+                          can be found in hyper_paras.json.
+            - paras_json_path: string, path of file which provides
+                               hyperparamters, "hyper_paras.json"
+                               in this project.
+            - weights_save_dir: string, directory path where saves
+                                trained model.
+            - results_save_dir: string, dorectory to save results.
+            - quant_weights: string, "last" or "best" weights.
+            - calib_num: int, the number of training samples to
+                         calibrate ranges of activations.
+                         Default is 32.
+            - per_channel: boolean, if True, weights are quantized
+                           in each output channel. Default is True.
+            - repeats: int, the number of timed runs, median latency
+                       is reported. Default is 10.
+            - session_paras: dictionary, threads and CPU affinity,
+                             see set_session in btc_session.py.
+                             Default is None.
+
+        '''
+
+        self.paras_name = paras_name
+        self.paras_json_path = paras_json_path
+        self.weights_save_dir = weights_save_dir
+        self.weights = quant_weights
+        self.calib_num = calib_num
+        self.per_channel = per_channel
+        self.repeats = repeats
+        self.session_paras = session_paras or {}
+
+        self.paras = BTCTest.load_paras(paras_json_path, paras_name)
+        self.batch_size = self.paras["batch_size"]
+        self.patch_shape = self.paras["patch_shape"]
+        self.patch_stride = self.paras["patch_stride"]
+
+        model_dir = os.path.join(weights_save_dir, paras_name)
+        self.float_path = os.path.join(model_dir, quant_weights + ".onnx")
+        self.int8_path = os.path.join(model_dir, quant_weights + "_int8.onnx")
+
+        self.results_dir = os.path.join(results_save_dir, paras_name)
+        BTCTest.create_dir(self.results_dir, rm=False)
+        self.results_path = os.path.join(
+            self.results_dir, "test_" + quant_weights + "_quant.csv")
+
+        return
+
+    def _calib_samples(self, data):
+        '''_CALIB_SAMPLES
+
+            Draw calibration samples from training set. If model
+            is trained on patches, one fixed patch is sampled from
+            each volume.
+
+            Input:
+            ------
+
+            - data: an BTCDataset instance.
+
+            Output:
+            -------
+
+            - numpy ndarray, calibration samples.
+
+        '''
+
+        train_num = len(data.train_x)
+        idx = np.sort(np.random.RandomState(0).choice(
+            train_num, min(self.calib_num, train_num), replace=False))
+        x = data.train_x[idx]
+
+        if self.patch_shape:
+            masks = getattr(data, "train_m", None)
+            patches = PatchSampler(x, data.train_y[idx],
+                                   None if masks is None else masks[idx],
+                                   self.patch_shape, len(idx),
+                                   self.paras["patch_tumor_prob"],
+                                   fixed=True)
+            x = patches[0][0]
+
+        return x
+
+    def _predict(self, model, x):
+        return predict_volumes(model, x, self.batch_size,
+                               self.patch_shape, self.patch_stride)
+
+    def _latency(self, model, x):
+        return median_latency(model, x, self.repeats,
+                              batch_size=self.batch_size,
+                              patch_shape=self.patch_shape,
+                              patch_stride=self.patch_stride)
+
+    def run(self, data):
+        '''RUN
+
+            Quantize model:
+            -1- Load ONNX model [weights].onnx, which is exported
+                if it is not exist (see load_backend).
+            -2- Quantize weights (int8) and activations (uint8) of
+                ONNX model with ranges calibrated on samples from
+                training set, save it as [weights]_int8.onnx.
+            -3- Evaluate float and int8 model on testing set by
+                metrics of BTCTest, results and their differences
+                (int8 - float) are saved in test_[weights]_quant.csv.
+
+            Input:
+            ------
+
+            - data: an BTCDataset instance, including features and
+                    labels of training, validation and testing set.
+
+        '''
+
+        print("\nQuantizing the model.\n")
+
+        float_model = load_backend("onnx", self.paras_name,
+                                   self.paras_json_path,
+                                   self.weights_save_dir, self.weights,
+                                   self.session_paras or None)
+
+        reader = CalibrationReader(self._calib_samples(data),
+                                   float_model.inputs[0])
+        quantize_static(self.float_path, self.int8_path, reader,
+                        quant_format=QuantFormat.QDQ,
+                        per_channel=self.per_channel,
+                        activation_type=QuantType.QUInt8,
+                        weight_type=QuantType.QInt8)
+        int8_model = OnnxModel(self.int8_path,
+                               self.session_paras.get("intra_op_threads", 0),
+                               self.session_paras.get("inter_op_threads", 0))
+        print("Int8 model is saved in " + self.int8_path)
+
+        rows = []
+        for name, model, path in [["float", float_model, self.float_path],
+                                  ["int8", int8_model, self.int8_path]]:
+            pred = self._predict(model, data.test_x)
+            results = BTCTest.compute_metrics(data.test_y, pred)
+            results["model"] = name
+            results["latency_ms"] = self._latency(model, data.test_x)
+            results["size_mb"] = os.path.getsize(path) / 1024.0 ** 2
+            rows.append(results)
+
+        columns = METRICS + ["latency_ms", "size_mb"]
+        delta = {key: rows[1][key] - rows[0][key] for key in columns}
+        delta["model"] = "delta"
+        res_df = pd.DataFrame(rows + [delta])[["model"] + columns]
+        print(res_df[["model", "acc", "roc_auc", "loss",
+                      "latency_ms", "size_mb"]].to_string(index=False))
+        res_df.to_csv(self.results_path, index=False)
+
+        return
+
+
+def main(hyper_paras_name, quant_weights=None, args=None):
+    '''MAIN
+
+        Main process to quantize model.
+
+        Inputs:
+        -------
+
+        - hyper_paras_name: string, the name of hyperparameters set,
+                            which can be found in hyper_paras.json.
+        - quant_weights: string, "last" or "best", default is None,
+                         which means test_weights in pre_paras.json.
+        - args: argparse Namespace, session settings from command
+                line which override pre_paras.json. Default is None.
+
+    '''
+
+    from btc_dataset import load_dataset
+
+    # Basic settings in pre_paras.json
+    pre_paras_path = "pre_paras.json"
+    pre_paras = json.load(open(pre_paras_path))
+
+    # Get root path of input data
+    parent_dir = os.path.dirname(os.getcwd())
+    data_dir = os.path.join(parent_dir, pre_paras["data_dir"])
+
+    # Set directories of preprocessed images
+    hgg_dir = os.path.join(data_dir, pre_paras["hgg_out"])
+    lgg_dir = os.path.join(data_dir, pre_paras["lgg_out"])
+
+    # Set directories of weights and results
+    weights_save_dir = os.path.join(parent_dir, pre_paras["weights_save_dir"])
+    results_save_dir = os.path.join(parent_dir, pre_paras["results_save_dir"])
+
+    # Partition dataset
+    data = load_dataset(hgg_dir, lgg_dir, pre_paras)
+
+    quantize = BTCQuantize(paras_name=hyper_paras_name,
+                           paras_json_path=pre_paras["paras_json_path"],
+                           weights_save_dir=weights_save_dir,
+                           results_save_dir=results_save_dir,
+                           quant_weights=quant_weights or pre_paras["test_weights"],
+                           calib_num=pre_paras["calib_num"],
+                           session_paras=session_paras(pre_paras, args))
+    quantize.run(data)
+
+    return
+
+
+if __name__ == "__main__":
+
+    # Command line
+    # python btc_quantize.py --paras=paras-1 --weights=last
+
+    parser = argparse.ArgumentParser()
+
+    help_str = "Select a set of hyper-parameters in hyper_paras.json."
+    parser.add_argument("--paras", action="store", default="paras-1",
+                        dest="hyper_paras_name", help=help_str)
+    help_str = "Weights to quantize, last or best."
+    parser.add_argument("--weights", action="store", default=None,
+                        choices=["last", "best"],
+                        dest="quant_weights", help=help_str)
+    add_session_args(parser)
+
+    args = parser.parse_args()
+    main(args.hyper_paras_name, args.quant_weights, args)
@@ -0,0 +1,384 @@
+# Brain Tumor Classification
+# Search hyperparameters by successive halving.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+#     ,,,         ,,,
+#   ;"   ';     ;'   ",
+#   ;  @.ss$$$$$$s.@  ;
+#   `s$$$$$$$$$$$$$$$'
+#   $$$$$$$$$$$$$$$$$$
+#  $$$$P""Y$$$Y""W$$$$$
+#  $$$$  p"$$$"q  $$$$$
+#  $$$$  .$$$$$.  $$$$'
+#   $$$DaU$$O$$DaU$$$'
+#    '$$$$'.^.'$$$$'
+#       '&$$$$$&'
+
+
+from __future__ import print_function
+
+
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+from collections import OrderedDict
+from btc_train import BTCTrain
+from btc_sweep import BTCSweep
+
+
+class BTCSearch(object):
+
+    def __init__(self,
+                 search_name,
+                 search_json_path,
+                 paras_json_path,
+                 weights_save_dir,
+                 logs_save_dir,
+                 workers_num=1):
+        '''__INIT__
+
+            Set configurations of searching.
+
+            Inputs:
+            -------
+
+            - search_name: string, name of searching settings,
+                           can be found in search_paras.json.
+            - search_json_path: string, path of file which provides
+                                searching settings, "search_paras.json"
+                                in this project.
+            - paras_json_path: string, path of file which provides
+                               hyperparamters, "hyper_paras.json"
+                               in this project. The best set is
+                               added into this file.
+            - weights_save_dir: string, directory path where saves
+                                trained model.
+            - logs_save_dir: string, directory path where saves
+                             logs of training process.
+            - workers_num: int, the number of parallel workers,
+                           see BTCSweep. Default is 1, which trains
+                           candidates one by one in this process.
+
+        '''
+
+        self.search_name = search_name
+        self.paras_json_path = paras_json_path
+        self.weights_save_dir = weights_save_dir
+        self.logs_save_dir = logs_save_dir
+        self.workers_num = workers_num
+
+        # Load searching settings and the base hyperparameters set
+        self.search = self.load_paras(search_json_path)[search_name]
+        self.base_paras = self.load_paras(paras_json_path)[self.search["base_paras"]]
+
+        # Candidates are saved in a separate hyperparameters file
+        self.search_dir = os.path.join(logs_save_dir, search_name)
+        BTCTrain.create_dir(self.search_dir)
+        self.candidates_path = os.path.join(self.search_dir, "hyper_paras.json")
+        self.results_path = os.path.join(self.search_dir, "search_res.csv")
+
+        return
+
+    def _sample(self):
+        '''_SAMPLE
+
+            Generate candidates by sampling values of keys
+            in searching space. Each value is described as:
+            - {"uniform": [low, high]}
+            - {"log_uniform": [low, high]}
+            - {"choice": [value1, value2, ...]}
+
+            Output:
+            -------
+
+            - candidates: OrderedDict, name and hyperparameters
+                          of each candidate.
+
+        '''
+
+        rng = np.random.RandomState(self.search["random_state"])
+
+        candidates = OrderedDict()
+        for i in range(self.search["configs_num"]):
+            paras = OrderedDict(self.base_paras)
+            paras["comment"] = "candidate of " + self.search_name
+            for key, dist in self.search["space"].items():
+                if "uniform" in dist:
+                    value = rng.uniform(*dist["uniform"])
+                elif "log_uniform" in dist:
+                    value = np.exp(rng.uniform(*np.log(dist["log_uniform"])))
+                elif "choice" in dist:
+                    value = dist["choice"][rng.randint(len(dist["choice"]))]
+                else:
+                    raise ValueError("Unknown distribution of " + key)
+                if isinstance(value, float):
+                    # Keep 4 significant digits
+                    value = float("{:.4g}".format(value))
+                paras[key] = value
+
+            # Save checkpoint in each epoch, so that
+            # promoted candidates can continue training
+            paras["checkpoint_period"] = 1
+            candidates["{0}-{1:03d}".format(self.search_name, i)] = paras
+
+        return candidates
+
+    def _train(self, names, resume, data):
+        '''_TRAIN
+
+            Train candidates in this process or in parallel workers.
+
+            Inputs:
+            -------
+
+            - names: string list, names of candidates.
+            - resume: boolean, if True, continue training
+                      from checkpoints.
+            - data: an BTCDataset instance.
+
+        '''
+
+        if self.workers_num > 1:
+            sweep = BTCSweep(paras_names=names,
+                             paras_json_path=self.candidates_path,
+                             weights_save_dir=self.weights_save_dir,
+                             logs_save_dir=self.logs_save_dir,
+                             results_save_dir=None,
+                             workers_num=self.workers_num,
+                             resume=resume,
+                             run_test=False)
+            sweep.run(data)
+        else:
+            for name in names:
+                train = BTCTrain(paras_name=name,
+                                 paras_json_path=self.candidates_path,
+                                 weights_save_dir=self.weights_save_dir,
+                                 logs_save_dir=self.logs_save_dir,
+                                 resume=resume)
+                train.run(data)
+
+        return
+
+    def _score(self, name, paras):
+        '''_SCORE
+
+            Minimum validation loss in learning curves
+            of a candidate, infinity if training failed.
+            Only loss of fc3 is used if early exit is enabled.
+
+            Inputs:
+            -------
+
+            - name: string, name of candidate.
+            - paras: dictionary, hyperparameters of candidate.
+
+            Output:
+            -------
+
+            - float, score to rank candidates, lower is better.
+
+        '''
+
+        curves_path = os.path.join(self.logs_save_dir, name, "curves.csv")
+        if not os.path.isfile(curves_path):
+            return np.inf
+
+        monitor = "val_fc3_loss" if paras["early_exit"] else "val_loss"
+        val_loss = pd.read_csv(curves_path)[monitor].min()
+        return np.inf if np.isnan(val_loss) else float(val_loss)
+
+    def run(self, data):
+        '''RUN
+
+            Successive halving:
+            -1- Train all candidates for min_epochs.
+            -2- Keep the best 1 / eta candidates by validation loss.
+            -3- Continue training kept candidates until eta times
+                of epochs, and repeat -2- and -3- until one candidate
+                is left or epochs_num of base set is reached.
+            -4- Add the best candidate into hyper_paras.json as
+                [search_name]-best with full epochs_num.
+
+            Input:
+            ------
+
+            - data: an BTCDataset instance, including features and
+                    labels of training, validation and testing set.
+
+        '''
+
+        print("\nSearching hyperparameters: " + self.search_name + "\n")
+
+        eta = self.search["eta"]
+        max_epochs = self.base_paras["epochs_num"]
+        candidates = self._sample()
+
+        survivors = list(candidates.keys())
+        epochs, rounds, records = self.search["min_epochs"], 0, []
+        while True:
+            print("Round {0}: {1} candidates, {2} epochs".format(
+                  rounds, len(survivors), epochs))
+
+            # Training stops at epochs in this round, learning
+            # rate is scheduled in epochs_num of base set
+            for name in survivors:
+                candidates[name]["epochs_num"] = epochs
+                candidates[name]["lr_epochs"] = max_epochs
+            self.save_paras(self.candidates_path, candidates)
+            self._train(survivors, rounds > 0, data)
+
+            scores = {name: self._score(name, candidates[name])
+                      for name in survivors}
+            for name in survivors:
+                record = OrderedDict([("round", rounds),
+                                      ("epochs", epochs),
+                                      ("name", name),
+                                      ("val_loss", scores[name])])
+                for key in self.search["space"]:
+                    record[key] = candidates[name][key]
+                records.append(record)
+            pd.DataFrame(records).to_csv(self.results_path, index=False)
+
+            # Promote the best candidates
+            survivors = sorted(survivors, key=lambda n: scores[n])
+            survivors = survivors[:max(1, len(survivors) // eta)]
+            if len(survivors) == 1 or epochs >= max_epochs:
+                break
+
+            epochs = min(epochs * eta, max_epochs)
+            rounds += 1
+
+        # Add the best set into hyper_paras.json
+        best_name = survivors[0]
+        best_paras = OrderedDict(self.base_paras)
+        for key in self.search["space"]:
+            best_paras[key] = candidates[best_name][key]
+        best_paras["comment"] = "best of {0} ({1}), val_loss {2:.4f}".format(
+            self.search_name, best_name, scores[best_name])
+
+        all_paras = self.load_paras(self.paras_json_path)
+        all_paras[self.search_name + "-best"] = best_paras
+        self.save_paras(self.paras_json_path, all_paras)
+        print("Best set is saved as " + self.search_name + "-best")
+
+        return
+
+    @staticmethod
+    def load_paras(json_path):
+        '''LOAD_PARAS
+
+            Load all sets from json file and keep their order.
+
+            Input:
+            ------
+
+            - json_path: string, path of json file.
+
+            Output:
+            -------
+
+            - OrderedDict of all sets.
+
+        '''
+
+        return json.load(open(json_path), object_pairs_hook=OrderedDict)
+
+    @staticmethod
+    def save_paras(json_path, all_paras):
+        '''SAVE_PARAS
+
+            Save all sets into json file in the same layout
+            as hyper_paras.json, one key in each line.
+
+            Inputs:
+            -------
+
+            - json_path: string, path of json file.
+            - all_paras: dictionary, name and hyperparameters
+                         of each set.
+
+        '''
+
+        entries = []
+        for name, paras in all_paras.items():
+            items = ["        {0}: {1}".format(json.dumps(key), json.dumps(value))
+                     for key, value in paras.items()]
+            entries.append("    {0}: {{\n{1}\n    }}".format(
+                           json.dumps(name), ",\n".join(items)))
+
+        with open(json_path, "w") as f:
+            f.write("{\n" + ",\n".join(entries) + "\n}\n")
+
+        return
+
+
+def main(search_name, workers_num):
+    '''MAIN
+
+        Main process to search hyperparameters.
+
+        Inputs:
+        -------
+
+        - search_name: string, the name of searching settings,
+                       which can be found in search_paras.json.
+        - workers_num: int, the number of parallel workers.
+
+    '''
+
+    from btc_dataset import load_dataset
+
+    # Basic settings in pre_paras.json, including
+    # 1. directory paths for input and output
+    # 2. necessary information for splitting dataset
+    pre_paras_path = "pre_paras.json"
+    pre_paras = json.load(open(pre_paras_path))
+
+    # Get root path of input data
+    parent_dir = os.path.dirname(os.getcwd())
+    data_dir = os.path.join(parent_dir, pre_paras["data_dir"])
+
+    # Set directories of preprocessed images
+    hgg_dir = os.path.join(data_dir, pre_paras["hgg_out"])
+    lgg_dir = os.path.join(data_dir, pre_paras["lgg_out"])
+
+    # Set directory to save weights
+    weights_save_dir = os.path.join(parent_dir, pre_paras["weights_save_dir"])
+    # Set directory to save training and validation logs
+    logs_save_dir = os.path.join(parent_dir, pre_paras["logs_save_dir"])
+
+    # Partition dataset
+    data = load_dataset(hgg_dir, lgg_dir, pre_paras)
+
+    # Search hyperparameters
+    search = BTCSearch(search_name=search_name,
+                       search_json_path=pre_paras["search_json_path"],
+                       paras_json_path=pre_paras["paras_json_path"],
+                       weights_save_dir=weights_save_dir,
+                       logs_save_dir=logs_save_dir,
+                       workers_num=workers_num)
+    search.run(data)
+
+    return
+
+
+if __name__ == "__main__":
+
+    # Command line
+    # python btc_search.py --search=search-1 --workers=1
+
+    parser = argparse.ArgumentParser()
+
+    help_str = "Select searching settings in search_paras.json."
+    parser.add_argument("--search", action="store", default="search-1",
+                        dest="search_name", help=help_str)
+    help_str = "Number of parallel workers."
+    parser.add_argument("--workers", action="store", type=int, default=1,
+                        dest="workers_num", help=help_str)
+
+    args = parser.parse_args()
+    main(args.search_name, args.workers_num)
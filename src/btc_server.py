@@ -0,0 +1,522 @@
+# Brain Tumor Classification
+# Local HTTP server to predict NIfTI images by 3D Multi-Scale CNN.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+#     ,,,         ,,,
+#   ;"   ';     ;'   ",
+#   ;  @.ss$$$$$$s.@  ;
+#   `s$$$$$$$$$$$$$$$'
+#   $$$$$$$$$$$$$$$$$$
+#  $$$$P""Y$$$Y""W$$$$$
+#  $$$$  p"$$$"q  $$$$$
+#  $$$$  .$$$$$.  $$$$'
+#   $$$DaU$$O$$DaU$$$'
+#    '$$$$'.^.'$$$$'
+#       '&$$$$$&'
+
+
+from __future__ import print_function
+
+
+import os
+import json
+import time
+import queue
+import argparse
+import tempfile
+import threading
+import numpy as np
+
+from collections import deque
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from multiprocessing import Pool, cpu_count
+
+from btc_backends import BACKENDS
+from btc_session import session_paras, add_session_args
+from btc_predict import LABELS, BTCPredict, find_mask, unwrap_load_scan
+
+
+# Maximum size of uploaded image
+MAX_UPLOAD_MB = 512
+# Percentiles reported in /metrics
+PERCENTILES = [50, 90, 99]
+
+
+class ServerMetrics(object):
+
+    def __init__(self, window=1000):
+        '''__INIT__
+
+            Counters and latencies of recent requests,
+            shared by all threads.
+
+            Input:
+            ------
+
+            - window: int, the number of recent requests whose
+                      latencies are kept. Default is 1000.
+
+        '''
+
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.counts = {"requests": 0, "errors": 0,
+                       "batches": 0, "batched_scans": 0,
+                       "preprocessing": 0}
+        self.latency = {key: deque(maxlen=window) for key in
+                        ["total", "preprocess", "queue", "model"]}
+
+        return
+
+    def add(self, key, value=1):
+        with self.lock:
+            self.counts[key] += value
+        return
+
+    def record(self, **latency):
+        with self.lock:
+            for key, value in latency.items():
+                self.latency[key].append(value * 1000)
+        return
+
+    def report(self, queue_depth):
+        '''REPORT
+
+            Snapshot of metrics, latencies are in milliseconds.
+
+        '''
+
+        with self.lock:
+            report = dict(self.counts)
+            for key, values in self.latency.items():
+                values = list(values)
+                for p in PERCENTILES:
+                    report["{}_p{}_ms".format(key, p)] = \
+                        float(np.percentile(values, p)) if values else None
+
+        report["queue_depth"] = queue_depth
+        report["uptime_s"] = time.time() - self.start
+        report["mean_batch_size"] = report["batched_scans"] / \
+            float(report["batches"]) if report["batches"] else None
+        return report
+
+
+class MicroBatcher(threading.Thread):
+
+    def __init__(self, predict_paras, metrics,
+                 max_batch_size=4, max_wait_ms=50):
+        '''__INIT__
+
+            Thread which owns the model. Requests are taken from
+            queue, once the first one arrives, others are waited
+            for at most max_wait_ms, or until max_batch_size
+            requests are collected, then they are predicted in
+            one batch.
+
+            Model is loaded in this thread since graph and session
+            of Keras are bound to the thread which builds them.
+
+            Inputs:
+            -------
+
+            - predict_paras: dictionary, arguments of BTCPredict.
+            - metrics: a ServerMetrics instance.
+            - max_batch_size: int, the maximum number of requests
+                              in each batch. Default is 4.
+            - max_wait_ms: float, the maximum time to wait for
+                           more requests after the first one.
+                           Default is 50.
+
+        '''
+
+        super(MicroBatcher, self).__init__()
+        self.daemon = True
+
+        self.predict_paras = predict_paras
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+
+        self.queue = queue.Queue()
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+        self.error = None
+
+        return
+
+    def submit(self, volume):
+        '''SUBMIT
+
+            Put one preprocessed image into queue, and
+            wait until it is predicted.
+
+            Input:
+            ------
+
+            - volume: numpy ndarray, image processed by load_scan.
+
+            Output:
+            -------
+
+            - A dictionary with "prob" (or "error"), "batch_size",
+              "queue" and "model" time in seconds.
+
+        '''
+
+        item = {"volume": volume, "time": time.time(),
+                "done": threading.Event()}
+        self.queue.put(item)
+        item["done"].wait()
+        return item
+
+    def _collect(self):
+        '''_COLLECT
+
+            Collect one batch of requests, None if stopped.
+
+        '''
+
+        while not self.stopped.is_set():
+            try:
+                batch = [self.queue.get(timeout=0.5)]
+                break
+            except queue.Empty:
+                continue
+        else:
+            return None
+
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def run(self):
+        try:
+            predict = BTCPredict(**self.predict_paras)
+        except Exception as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.ready.set()
+
+        while True:
+            batch = self._collect()
+            if batch is None:
+                break
+
+            start = time.time()
+            try:
+                pred = predict.predict(np.array([b["volume"] for b in batch]))
+                error = None
+            except Exception as e:
+                pred, error = [None] * len(batch), str(e)
+            model_time = time.time() - start
+
+            self.metrics.add("batches")
+            self.metrics.add("batched_scans", len(batch))
+            for item, prob in zip(batch, pred):
+                item["volume"] = None
+                item["prob"] = None if prob is None else prob.tolist()
+                item["error"] = error
+                item["batch_size"] = len(batch)
+                item["queue"] = start - item["time"]
+                item["model"] = model_time
+                item["done"].set()
+
+        return
+
+    def stop(self):
+        self.stopped.set()
+        return
+
+
+class BTCServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, batcher, pool, metrics,
+                 is_mask=True, non_mask_coeff=0.333,
+                 data_format=".nii.gz"):
+        '''__INIT__
+
+            HTTP server, each request is handled in its own thread,
+            images are preprocessed in pool and predicted by batcher.
+
+            Inputs:
+            -------
+
+            - address: tuple, (host, port).
+            - batcher: a MicroBatcher instance.
+            - pool: multiprocessing Pool to preprocess images.
+            - metrics: a ServerMetrics instance.
+            - is_mask: boolean, if True, enhance tumor region by mask
+                       which is given in request or found in the
+                       same folder as image. Default is True.
+            - non_mask_coeff: float from 0 to 1, the coefficient of
+                              voxels in non-tumor region. Default is 0.333.
+            - data_format: string, extension of images, default
+                           is ".nii.gz".
+
+        '''
+
+        HTTPServer.__init__(self, address, BTCRequestHandler)
+        self.batcher = batcher
+        self.pool = pool
+        self.metrics = metrics
+        self.is_mask = is_mask
+        self.non_mask_coeff = non_mask_coeff
+        self.data_format = data_format
+
+        return
+
+
+class BTCRequestHandler(BaseHTTPRequestHandler):
+
+    '''Endpoints:
+
+        - POST /predict: predict one image, body is either JSON
+          {"path": path_of_image, "mask_path": path_of_mask},
+          "mask_path" is optional, or raw bytes of a NIfTI file
+          (.nii or .nii.gz), which is not enhanced by mask.
+        - GET /metrics: counters, queue depth and latency percentiles.
+        - GET /health: 200 once model is loaded.
+
+    '''
+
+    def log_message(self, format, *args):
+        return
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        return
+
+    def do_GET(self):
+        server = self.server
+        if self.path == "/metrics":
+            queue_depth = server.batcher.queue.qsize()
+            self._reply(200, server.metrics.report(queue_depth))
+        elif self.path == "/health":
+            self._reply(200, {"status": "ok"})
+        else:
+            self._reply(404, {"error": "Unknown path: " + self.path})
+        return
+
+    def _scan_paths(self, body):
+        '''_SCAN_PATHS
+
+            Parse request body into [volume_path, mask_path, temp],
+            uploaded image is written into a temporary file "temp",
+            which is removed after preprocessing.
+
+        '''
+
+        server = self.server
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("application/json"):
+            request = json.loads(body.decode("utf-8"))
+            volume_path = request["path"]
+            if not os.path.isfile(volume_path):
+                raise ValueError("Image is not exist: " + volume_path)
+            mask_path = request.get("mask_path")
+            if mask_path is None and server.is_mask:
+                mask_path = find_mask(os.path.dirname(volume_path),
+                                      server.data_format)
+            if not server.is_mask:
+                mask_path = None
+            return volume_path, mask_path, None
+
+        # Raw NIfTI bytes, gzip is detected by magic number
+        suffix = ".nii.gz" if body[:2] == b"\x1f\x8b" else ".nii"
+        temp, volume_path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(temp, "wb") as f:
+            f.write(body)
+        return volume_path, None, volume_path
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._reply(404, {"error": "Unknown path: " + self.path})
+            return
+
+        server = self.server
+        start = time.time()
+        server.metrics.add("requests")
+
+        length = int(self.headers.get("Content-Length", 0))
+        if length <= 0 or length > MAX_UPLOAD_MB * 1024 ** 2:
+            server.metrics.add("errors")
+            self._reply(413 if length else 400,
+                        {"error": "Invalid body length: {}".format(length)})
+            return
+        body = self.rfile.read(length)
+
+        temp = None
+        try:
+            volume_path, mask_path, temp = self._scan_paths(body)
+
+            # Preprocess in pool
+            server.metrics.add("preprocessing")
+            try:
+                volume, error = server.pool.apply(
+                    unwrap_load_scan,
+                    ([volume_path, mask_path, server.non_mask_coeff],))
+            finally:
+                server.metrics.add("preprocessing", -1)
+            preprocess_time = time.time() - start
+            if volume is None:
+                raise ValueError(error)
+
+            # Predict in micro-batch
+            item = server.batcher.submit(volume)
+            if item["error"] is not None:
+                raise RuntimeError(item["error"])
+        except Exception as e:
+            server.metrics.add("errors")
+            self._reply(400 if isinstance(e, (ValueError, KeyError))
+                        else 500, {"error": str(e)})
+            return
+        finally:
+            if temp is not None and os.path.isfile(temp):
+                os.remove(temp)
+
+        total_time = time.time() - start
+        server.metrics.record(total=total_time,
+                              preprocess=preprocess_time,
+                              queue=item["queue"],
+                              model=item["model"])
+
+        prob = item["prob"]
+        self._reply(200, {"path": None if temp else volume_path,
+                          "lgg_prob": prob[0],
+                          "hgg_prob": prob[1],
+                          "pred": LABELS[int(np.argmax(prob))],
+                          "enhanced": mask_path is not None,
+                          "batch_size": item["batch_size"],
+                          "latency_ms": total_time * 1000})
+        return
+
+
+def main(hyper_paras_name, pred_weights=None, args=None):
+    '''MAIN
+
+        Main process to serve model.
+
+        Inputs:
+        -------
+
+        - hyper_paras_name: string, the name of hyperparameters set,
+                            which can be found in hyper_paras.json.
+        - pred_weights: string, "last" or "best", default is None,
+                        which means test_weights in pre_paras.json.
+        - args: argparse Namespace, server and session settings from
+                command line which override pre_paras.json.
+                Default is None.
+
+    '''
+
+    # Basic settings in pre_paras.json
+    pre_paras_path = "pre_paras.json"
+    pre_paras = json.load(open(pre_paras_path))
+    for key in ["backend", "server_host", "server_port",
+                "max_batch_size", "max_wait_ms"]:
+        if args is not None and getattr(args, key, None) is not None:
+            pre_paras[key] = getattr(args, key)
+
+    # Set directory of weights
+    parent_dir = os.path.dirname(os.getcwd())
+    weights_save_dir = os.path.join(parent_dir, pre_paras["weights_save_dir"])
+
+    # Create pool before model is loaded, thus processes
+    # are forked without TensorFlow runtime
+    processes = pre_paras["processes_num"]
+    if processes == -1 or processes > cpu_count():
+        processes = cpu_count()
+    pool = Pool(processes=processes)
+
+    metrics = ServerMetrics()
+    predict_paras = {"paras_name": hyper_paras_name,
+                     "paras_json_path": pre_paras["paras_json_path"],
+                     "weights_save_dir": weights_save_dir,
+                     "pred_weights": pred_weights or pre_paras["test_weights"],
+                     "backend": pre_paras["backend"],
+                     "batch_size": pre_paras["max_batch_size"],
+                     "processes": 0,
+                     "session_paras": session_paras(pre_paras, args)}
+    batcher = MicroBatcher(predict_paras, metrics,
+                           max_batch_size=pre_paras["max_batch_size"],
+                           max_wait_ms=pre_paras["max_wait_ms"])
+    batcher.start()
+    batcher.ready.wait()
+    if batcher.error is not None:
+        pool.terminate()
+        raise batcher.error
+
+    address = (pre_paras["server_host"], pre_paras["server_port"])
+    server = BTCServer(address, batcher, pool, metrics,
+                       is_mask=pre_paras["is_mask"],
+                       non_mask_coeff=pre_paras["non_mask_coeff"],
+                       data_format=pre_paras["data_format"])
+    print("\nServing {} on http://{}:{}, ".format(hyper_paras_name, *address) +
+          "max batch size {}, max wait {}ms\n".format(
+              pre_paras["max_batch_size"], pre_paras["max_wait_ms"]))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopping server.")
+    finally:
+        server.server_close()
+        batcher.stop()
+        batcher.join()
+        pool.close()
+        pool.join()
+
+    return
+
+
+if __name__ == "__main__":
+
+    # Command line
+    # python btc_server.py --paras=paras-1 --port=8000 --max_batch_size=4
+
+    parser = argparse.ArgumentParser()
+
+    help_str = "Select a set of hyper-parameters in hyper_paras.json."
+    parser.add_argument("--paras", action="store", default="paras-1",
+                        dest="hyper_paras_name", help=help_str)
+    help_str = "Weights to serve, last or best."
+    parser.add_argument("--weights", action="store", default=None,
+                        choices=["last", "best"],
+                        dest="pred_weights", help=help_str)
+    help_str = "Backend to predict, overrides pre_paras.json."
+    parser.add_argument("--backend", action="store", default=None,
+                        choices=BACKENDS, dest="backend", help=help_str)
+    help_str = "Host to bind."
+    parser.add_argument("--host", action="store", default=None,
+                        dest="server_host", help=help_str)
+    help_str = "Port to listen."
+    parser.add_argument("--port", action="store", type=int, default=None,
+                        dest="server_port", help=help_str)
+    help_str = "The maximum number of requests in each batch."
+    parser.add_argument("--max_batch_size", action="store", type=int,
+                        default=None, dest="max_batch_size", help=help_str)
+    help_str = "The maximum time (ms) to wait for more requests."
+    parser.add_argument("--max_wait_ms", action="store", type=float,
+                        default=None, dest="max_wait_ms", help=help_str)
+    add_session_args(parser)
+
+    args = parser.parse_args()
+    main(args.hyper_paras_name, args.pred_weights, args)
@@ -0,0 +1,223 @@
+# Brain Tumor Classification
+# Threading and CPU affinity of TensorFlow sessions.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+#     ,,,         ,,,
+#   ;"   ';     ;'   ",
+#   ;  @.ss$$$$$$s.@  ;
+#   `s$$$$$$$$$$$$$$$'
+#   $$$$$$$$$$$$$$$$$$
+#  $$$$P""Y$$$Y""W$$$$$
+#  $$$$  p"$$$"q  $$$$$
+#  $$$$  .$$$$$.  $$$$'
+#   $$$DaU$$O$$DaU$$$'
+#    '$$$$'.^.'$$$$'
+#       '&$$$$$&'
+
+
+from __future__ import print_function
+
+
+import os
+import sys
+
+
+# Keys of session settings in pre_paras.json
+SESSION_KEYS = ["intra_op_threads", "inter_op_threads", "cpu_affinity"]
+
+
+def parse_cores(cpu_affinity):
+    '''PARSE_CORES
+
+        Convert CPU affinity into a list of core indices.
+
+        Input:
+        ------
+
+        - cpu_affinity: None, int list or string like "0-3,8",
+                        cores to run on. None means no change.
+
+        Output:
+        -------
+
+        - int list of cores, or None.
+
+    '''
+
+    if cpu_affinity is None or cpu_affinity == "":
+        return None
+    if not hasattr(cpu_affinity, "split"):
+        return [int(c) for c in cpu_affinity]
+
+    cores = []
+    for part in cpu_affinity.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            cores += list(range(int(start), int(end) + 1))
+        else:
+            cores.append(int(part))
+    return cores
+
+
+def set_affinity(cpu_affinity):
+    '''SET_AFFINITY
+
+        Pin current process on given cores, and limit
+        OMP_NUM_THREADS by limit_omp_threads.
+
+        Input:
+        ------
+
+        - cpu_affinity: None, int list or string, see parse_cores.
+
+        Output:
+        -------
+
+        - int list of cores, or None if affinity is not changed.
+
+    '''
+
+    cores = parse_cores(cpu_affinity)
+    if cores is None:
+        return None
+
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    else:
+        print("CPU affinity is not supported on this platform.")
+    limit_omp_threads(cores)
+
+    return cores
+
+
+def limit_omp_threads(cpu_affinity):
+    '''LIMIT_OMP_THREADS
+
+        Limit OMP_NUM_THREADS to the number of given cores,
+        which is required by builds with MKL. The thread pool
+        of OpenMP reads it once TensorFlow is imported, thus
+        entry points call it before importing modules which
+        import Keras.
+
+        Input:
+        ------
+
+        - cpu_affinity: None, int list or string, see parse_cores.
+
+        Output:
+        -------
+
+        - boolean, True if OMP_NUM_THREADS is limited.
+
+    '''
+
+    cores = parse_cores(cpu_affinity)
+    if cores is None:
+        return False
+
+    threads = str(len(cores))
+    if os.environ.get("OMP_NUM_THREADS") == threads:
+        return True
+    if "tensorflow" in sys.modules:
+        print("TensorFlow has been imported, OMP_NUM_THREADS "
+              "is not limited.")
+        return False
+
+    os.environ["OMP_NUM_THREADS"] = threads
+    return True
+
+
+def set_session(intra_op_threads=0,
+                inter_op_threads=0,
+                cpu_affinity=None):
+    '''SET_SESSION
+
+        Set TensorFlow session of Keras with given threads
+        and CPU affinity. It should be called before building
+        model, since K.clear_session() resets session to
+        default one.
+
+        Inputs:
+        -------
+
+        - intra_op_threads: int, the number of threads used
+                            within one operation. 0 means the
+                            number of cores (after pinning).
+        - inter_op_threads: int, the number of operations run
+                            in parallel. 0 lets TensorFlow decide.
+        - cpu_affinity: None, int list or string like "0-3,8",
+                        cores to run on. Default is None.
+
+    '''
+
+    import tensorflow as tf
+    from keras import backend as K
+
+    cores = set_affinity(cpu_affinity)
+    if intra_op_threads == 0 and cores is not None:
+        intra_op_threads = len(cores)
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                            inter_op_parallelism_threads=inter_op_threads)
+    K.set_session(tf.Session(config=config))
+
+    return
+
+
+def add_session_args(parser):
+    '''ADD_SESSION_ARGS
+
+        Add command line options of session settings,
+        which override values in pre_paras.json.
+
+        Input:
+        ------
+
+        - parser: argparse.ArgumentParser instance.
+
+    '''
+
+    help_str = "Threads within one operation, 0 for all cores."
+    parser.add_argument("--intra_op_threads", action="store", type=int,
+                        default=None, dest="intra_op_threads", help=help_str)
+    help_str = "Operations run in parallel, 0 lets TensorFlow decide."
+    parser.add_argument("--inter_op_threads", action="store", type=int,
+                        default=None, dest="inter_op_threads", help=help_str)
+    help_str = "Cores to run on, such as 0-3,8."
+    parser.add_argument("--cpu_affinity", action="store", default=None,
+                        dest="cpu_affinity", help=help_str)
+
+    return
+
+
+def session_paras(pre_paras, args=None):
+    '''SESSION_PARAS
+
+        Merge session settings in pre_paras.json and
+        command line options.
+
+        Inputs:
+        -------
+
+        - pre_paras: dictionary, loaded from pre_paras.json.
+        - args: argparse Namespace with options added by
+                add_session_args, default is None.
+
+        Output:
+        -------
+
+        - A dictionary of arguments of set_session.
+
+    '''
+
+    paras = {"intra_op_threads": 0,
+             "inter_op_threads": 0,
+             "cpu_affinity": None}
+    for key in SESSION_KEYS:
+        if key in pre_paras:
+            paras[key] = pre_paras[key]
+        if args is not None and getattr(args, key, None) is not None:
+            paras[key] = getattr(args, key)
+
+    return paras
@@ -0,0 +1,482 @@
+# Brain Tumor Classification
+# Train and test several sets of hyperparameters
+# in parallel processes which share one dataset.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+#     ,,,         ,,,
+#   ;"   ';     ;'   ",
+#   ;  @.ss$$$$$$s.@  ;
+#   `s$$$$$$$$$$$$$$$'
+#   $$$$$$$$$$$$$$$$$$
+#  $$$$P""Y$$$Y""W$$$$$
+#  $$$$  p"$$$"q  $$$$$
+#  $$$$  .$$$$$.  $$$$'
+#   $$$DaU$$O$$DaU$$$'
+#    '$$$$'.^.'$$$$'
+#       '&$$$$$&'
+
+
+from __future__ import print_function
+
+
+import os
+import glob
+import json
+import time
+import queue
+import shutil
+import argparse
+import tempfile
+import traceback
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+
+from btc_session import set_affinity
+
+
+class SharedDataset(object):
+
+    # Arrays of BTCDataset to be shared
+    ARRAYS = ["train_x", "train_y", "valid_x", "valid_y", "test_x", "test_y"]
+    # Optional tumor masks, shared if they are loaded
+    MASKS = ["train_m", "valid_m", "test_m"]
+
+    def __init__(self, shared_dir):
+        '''__INIT__
+
+            Load arrays saved by SharedDataset.share as memory
+            mapped files. Pages of files are shared by all
+            processes which load the same directory, thus the
+            dataset is kept in memory only once.
+            Attributes are the same as BTCDataset:
+            - train_x, train_y
+            - valid_x, valid_y
+            - test_x, test_y
+            - train_m, valid_m, test_m (None if not shared)
+
+            Input:
+            ------
+
+            - shared_dir: string, directory of shared arrays.
+
+        '''
+
+        for name in self.ARRAYS + self.MASKS:
+            path = os.path.join(shared_dir, name + ".npy")
+            if os.path.isfile(path):
+                setattr(self, name, np.load(path, mmap_mode="r"))
+            else:
+                setattr(self, name, None)
+
+        return
+
+    @staticmethod
+    def share(data, shared_dir):
+        '''SHARE
+
+            Save arrays of a loaded BTCDataset instance
+            into shared directory.
+
+            Inputs:
+            -------
+
+            - data: BTCDataset instance after running.
+            - shared_dir: string, directory to save arrays, a
+                          directory in memory file system, such
+                          as "/dev/shm", avoids disk access.
+
+        '''
+
+        if not os.path.isdir(shared_dir):
+            os.makedirs(shared_dir)
+
+        for name in SharedDataset.ARRAYS + SharedDataset.MASKS:
+            if getattr(data, name, None) is None:
+                continue
+            path = os.path.join(shared_dir, name + ".npy")
+            np.save(path, getattr(data, name))
+
+        return
+
+
+def sweep_worker(cores, tasks, results, settings):
+    '''SWEEP_WORKER
+
+        Worker process to train and test models. Each worker
+        is pinned to given cores, and takes names of
+        hyperparameters sets from tasks queue until None.
+
+        Inputs:
+        -------
+
+        - cores: int list, indices of CPU cores for this worker.
+        - tasks: multiprocessing Queue, names of hyperparameters
+                 sets to run, None to stop the worker.
+        - results: multiprocessing Queue, to put the state
+                   of each finished task.
+        - settings: dictionary, directories and options to
+                    initialize BTCTrain and BTCTest.
+
+    '''
+
+    # Pin worker on cores and limit threads of libraries
+    # before importing TensorFlow
+    set_affinity(cores)
+    session_paras = {"intra_op_threads": len(cores),
+                     "inter_op_threads": 1,
+                     "cpu_affinity": cores}
+
+    from btc_test import BTCTest
+    from btc_train import BTCTrain
+
+    data = SharedDataset(settings["shared_dir"])
+
+    while True:
+        paras_name = tasks.get()
+        if paras_name is None:
+            break
+
+        start = time.time()
+        try:
+            train = BTCTrain(paras_name=paras_name,
+                             paras_json_path=settings["paras_json_path"],
+                             weights_save_dir=settings["weights_save_dir"],
+                             logs_save_dir=settings["logs_save_dir"],
+                             save_best_weights=settings["save_best_weights"],
+                             resume=settings["resume"],
+                             session_paras=session_paras)
+            train.run(data)
+
+            if settings["run_test"]:
+                test = BTCTest(paras_name=paras_name,
+                               paras_json_path=settings["paras_json_path"],
+                               weights_save_dir=settings["weights_save_dir"],
+                               results_save_dir=settings["results_save_dir"],
+                               test_weights=settings["test_weights"],
+                               pred_trainset=settings["pred_trainset"],
+                               session_paras=session_paras)
+                test.run(data)
+            error = None
+        except Exception:
+            error = traceback.format_exc()
+
+        results.put([paras_name, time.time() - start, error])
+
+    return
+
+
+class BTCSweep(object):
+
+    def __init__(self,
+                 paras_names,
+                 paras_json_path,
+                 weights_save_dir,
+                 logs_save_dir,
+                 results_save_dir,
+                 shared_dir=None,
+                 workers_num=2,
+                 save_best_weights=True,
+                 test_weights="last",
+                 pred_trainset=False,
+                 resume=False,
+                 run_test=True):
+        '''__INIT__
+
+            Set configurations of sweep.
+
+            Inputs:
+            -------
+
+            - paras_names: string list, names of hyperparameters sets,
+                           can be found in hyper_paras.json.
+            - paras_json_path: string, path of file which provides
+                               hyperparamters, "hyper_paras.json"
+                               in this project.
+            - weights_save_dir: string, directory path where saves
+                                trained model.
+            - logs_save_dir: string, directory path where saves
+                             logs of training process.
+            - results_save_dir: string, directory to save results.
+            - shared_dir: string, directory to save shared arrays,
+                          default is a temporary directory in
+                          "/dev/shm" if it exists.
+            - workers_num: int, the number of parallel workers,
+                           CPU cores are divided equally among
+                           workers. Default is 2.
+            - save_best_weights: boolean, if save the model with best
+                                 validation accuracy. Default is True.
+            - test_weights: string, which weights used to do test,
+                            "last" or "best".
+            - pred_trainset: boolean, whether evaluate model on
+                             training set, default is False.
+            - resume: boolean, if True, continue training of each
+                      set from its checkpoint. Default is False.
+            - run_test: boolean, if True, test each set after
+                        training. Default is True.
+
+        '''
+
+        self.paras_names = paras_names
+        self.results_save_dir = results_save_dir
+        self.workers_num = min(workers_num, len(paras_names))
+
+        if shared_dir is None:
+            root = "/dev/shm" if os.path.isdir("/dev/shm") else None
+            shared_dir = tempfile.mkdtemp(prefix="btc_sweep_", dir=root)
+        self.shared_dir = shared_dir
+
+        self.settings = {"paras_json_path": paras_json_path,
+                         "weights_save_dir": weights_save_dir,
+                         "logs_save_dir": logs_save_dir,
+                         "results_save_dir": results_save_dir,
+                         "shared_dir": shared_dir,
+                         "save_best_weights": save_best_weights,
+                         "test_weights": test_weights,
+                         "pred_trainset": pred_trainset,
+                         "resume": resume,
+                         "run_test": run_test}
+
+        return
+
+    def _split_cores(self):
+        '''_SPLIT_CORES
+
+            Divide available CPU cores into self.workers_num
+            groups, sizes of groups differ by one at most, thus
+            no core is left.
+
+            Output:
+            -------
+
+            - list of int lists, cores of each worker.
+
+        '''
+
+        if hasattr(os, "sched_getaffinity"):
+            cores = sorted(os.sched_getaffinity(0))
+        else:
+            cores = list(range(mp.cpu_count()))
+
+        if self.workers_num > len(cores):
+            raise ValueError("{0} workers are more than {1} cores.".format(
+                             self.workers_num, len(cores)))
+
+        return [[int(c) for c in group]
+                for group in np.array_split(cores, self.workers_num)]
+
+    def _collect(self, results, workers):
+        '''_COLLECT
+
+            Wait for results of all hyperparameters sets. Results
+            queue is polled, so that if all workers exit while
+            some sets are not finished, such as workers are
+            killed by OOM, these sets are reported as failed
+            instead of waiting forever.
+
+            Inputs:
+            -------
+
+            - results: multiprocessing Queue, states of finished tasks.
+            - workers: list of multiprocessing Process.
+
+        '''
+
+        pending = list(self.paras_names)
+        while pending:
+            try:
+                paras_name, duration, error = results.get(timeout=5)
+            except queue.Empty:
+                if any([worker.is_alive() for worker in workers]):
+                    continue
+                codes = [worker.exitcode for worker in workers]
+                for paras_name in pending:
+                    print("Failed {0}: workers exited with codes {1}.".format(
+                          paras_name, codes))
+                break
+
+            pending.remove(paras_name)
+            if error is None:
+                print("Finished {0} in {1:.1f} s.".format(paras_name, duration))
+            else:
+                print("Failed {0}:\n{1}".format(paras_name, error))
+
+        return
+
+    def _aggregate(self):
+        '''_AGGREGATE
+
+            Merge all *_res.csv of sweeped hyperparameters sets
+            into [results_save_dir]/sweep_res.csv.
+
+        '''
+
+        dfs = []
+        for paras_name in self.paras_names:
+            results_dir = os.path.join(self.results_save_dir, paras_name)
+            for path in sorted(glob.glob(os.path.join(results_dir, "*_res.csv"))):
+                df = pd.read_csv(path)
+                # File name is [dataset]_[weights]_res.csv
+                dataset, weights = os.path.basename(path).split("_")[:2]
+                df.insert(1, "dataset", dataset)
+                df.insert(2, "weights", weights)
+                dfs.append(df)
+
+        if not dfs:
+            print("No result is found.")
+            return
+
+        res_df = pd.concat(dfs, ignore_index=True)
+        res_path = os.path.join(self.results_save_dir, "sweep_res.csv")
+        res_df.to_csv(res_path, index=False)
+        print(res_df.to_string(index=False))
+
+        return
+
+    def run(self, data):
+        '''RUN
+
+            Share dataset, run all hyperparameters sets in
+            parallel workers, and aggregate results.
+
+            Input:
+            ------
+
+            - data: an BTCDataset instance, including features and
+                    labels of training, validation and testing set.
+
+        '''
+
+        print("\nSweeping {0} sets of hyperparameters in {1} workers.\n".format(
+              len(self.paras_names), self.workers_num))
+
+        cores_list = self._split_cores()
+
+        workers = []
+        try:
+            SharedDataset.share(data, self.shared_dir)
+
+            # Processes are spawned to avoid copying
+            # TensorFlow's state from parent process
+            ctx = mp.get_context("spawn")
+            tasks, results = ctx.Queue(), ctx.Queue()
+            for paras_name in self.paras_names:
+                tasks.put(paras_name)
+
+            for cores in cores_list:
+                tasks.put(None)
+                worker = ctx.Process(target=sweep_worker,
+                                     args=(cores, tasks, results, self.settings))
+                worker.start()
+                workers.append(worker)
+
+            self._collect(results, workers)
+            for worker in workers:
+                worker.join()
+        finally:
+            # Stop workers left by errors and remove shared arrays
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                    worker.join()
+            shutil.rmtree(self.shared_dir, ignore_errors=True)
+
+        if self.settings["run_test"]:
+            self._aggregate()
+
+        return
+
+
+def main(hyper_paras_names, workers_num, shared_dir=None, preprocess=False):
+    '''MAIN
+
+        Main process to sweep hyperparameters sets.
+
+        Inputs:
+        -------
+
+        - hyper_paras_names: string list, names of hyperparameters
+                             sets, which can be found in hyper_paras.json.
+        - workers_num: int, the number of parallel workers.
+        - shared_dir: string, directory to save shared arrays.
+        - preprocess: boolean, if True, run preprocessing once
+                      before loading dataset.
+
+    '''
+
+    from btc_dataset import load_dataset
+    from btc_preprocess import BTCPreprocess
+
+    # Basic settings in pre_paras.json, including
+    # 1. directory paths for input and output
+    # 2. necessary information for splitting dataset
+    pre_paras_path = "pre_paras.json"
+    pre_paras = json.load(open(pre_paras_path))
+
+    # Get root path of input data
+    parent_dir = os.path.dirname(os.getcwd())
+    data_dir = os.path.join(parent_dir, pre_paras["data_dir"])
+
+    # Set directories of preprocessed images
+    hgg_dir = os.path.join(data_dir, pre_paras["hgg_out"])
+    lgg_dir = os.path.join(data_dir, pre_paras["lgg_out"])
+
+    # Set directories to save weights, logs and results
+    weights_save_dir = os.path.join(parent_dir, pre_paras["weights_save_dir"])
+    logs_save_dir = os.path.join(parent_dir, pre_paras["logs_save_dir"])
+    results_save_dir = os.path.join(parent_dir, pre_paras["results_save_dir"])
+
+    if preprocess:
+        # Preprocessing to enhance tumor regions
+        hgg_in_dir = os.path.join(data_dir, pre_paras["hgg_in"])
+        lgg_in_dir = os.path.join(data_dir, pre_paras["lgg_in"])
+        prep = BTCPreprocess([hgg_in_dir, lgg_in_dir],
+                             [hgg_dir, lgg_dir],
+                             pre_paras["volume_type"])
+        prep.run(is_mask=pre_paras["is_mask"],
+                 non_mask_coeff=pre_paras["non_mask_coeff"],
+                 processes=pre_paras["processes_num"],
+                 save_mask=pre_paras["save_mask"])
+
+    # Partition dataset, only once for all sets
+    data = load_dataset(hgg_dir, lgg_dir, pre_paras)
+
+    sweep = BTCSweep(paras_names=hyper_paras_names,
+                     paras_json_path=pre_paras["paras_json_path"],
+                     weights_save_dir=weights_save_dir,
+                     logs_save_dir=logs_save_dir,
+                     results_save_dir=results_save_dir,
+                     shared_dir=shared_dir,
+                     workers_num=workers_num,
+                     save_best_weights=pre_paras["save_best_weights"],
+                     test_weights=pre_paras["test_weights"],
+                     pred_trainset=pre_paras["pred_trainset"])
+    sweep.run(data)
+
+    return
+
+
+if __name__ == "__main__":
+
+    # Command line
+    # python btc_sweep.py --paras=paras-1,paras-2 --workers=2
+
+    parser = argparse.ArgumentParser()
+
+    help_str = "Comma separated sets of hyper-parameters in hyper_paras.json."
+    parser.add_argument("--paras", action="store", default="paras-1,paras-2",
+                        dest="hyper_paras_names", help=help_str)
+    help_str = "Number of parallel workers."
+    parser.add_argument("--workers", action="store", type=int, default=2,
+                        dest="workers_num", help=help_str)
+    help_str = "Directory to save shared dataset."
+    parser.add_argument("--shared_dir", action="store", default=None,
+                        dest="shared_dir", help=help_str)
+    help_str = "Run preprocessing once before loading dataset."
+    parser.add_argument("--preprocess", action="store_true", default=False,
+                        dest="preprocess", help=help_str)
+
+    args = parser.parse_args()
+    main(args.hyper_paras_names.split(","), args.workers_num,
+         args.shared_dir, args.preprocess)
@@ -21,13 +21,14 @@ from __future__ import print_function
 
 import os
 import json
+import time
 import shutil
 import argparse
 import numpy as np
 import pandas as pd
 
-from keras import backend as K
-from btc_models import BTCModels
+from btc_backends import BACKENDS, load_backend
+from btc_session import session_paras, add_session_args
 from sklearn.metrics import (log_loss,
                              roc_curve,
                              recall_score,
@@ -36,6 +37,14 @@ from sklearn.metrics import (log_loss,
                              confusion_matrix)
 
 
+# Metrics in results, in order of columns
+METRICS = ["acc", "hgg_acc", "lgg_acc",
+           "loss", "hgg_loss", "lgg_loss",
+           "hgg_precision", "hgg_recall",
+           "lgg_precision", "lgg_recall",
+           "roc_auc", "tn", "fp", "fn", "tp"]
+
+
 class BTCTest(object):
 
     def __init__(self,
@@ -44,7 +53,10 @@ class BTCTest(object):
                  weights_save_dir,
                  results_save_dir,
                  test_weights="last",
-                 pred_trainset=False):
+                 pred_trainset=False,
+                 session_paras=None,
+                 reuse_pred=False,
+                 backend="keras"):
         '''_INIT__
 
             Set configurations before testing model.
@@ -65,16 +77,36 @@ class BTCTest(object):
                             from "best" epoch.
             - pred_trainset: boolean, whether evaluate model on
                              training set, default is False.
+            - session_paras: dictionary, threads and CPU affinity
+                             of TensorFlow session, see set_session
+                             in btc_session.py. Default is None,
+                             which uses the default session.
+            - reuse_pred: boolean, if True, reuse predictions saved
+                          by BTCTrain in last_pred.npz when testing
+                          weights of last epoch by Keras backend,
+                          since they are predicted by Keras model.
+                          Default is False.
+            - backend: string, runtime to predict, "keras" or "onnx",
+                       see btc_backends.py. Default is "keras".
 
         '''
 
         if not os.path.isdir(weights_save_dir):
             raise IOError("Model directory is not exist.")
 
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend: " + backend)
+
         self.paras_name = paras_name
+        self.paras_json_path = paras_json_path
+        self.weights_save_dir = weights_save_dir
+        self.backend = backend
         self.results_save_dir = results_save_dir
         self.weights = test_weights
         self.pred_trainset = pred_trainset
+        self.session_paras = session_paras
+        self.reuse_pred = reuse_pred and test_weights == "last" and \
+            backend == "keras"
 
         # Load hyperparameters
         self.paras = self.load_paras(paras_json_path, paras_name)
@@ -82,6 +114,8 @@ class BTCTest(object):
 
         self.weights_path = os.path.join(weights_save_dir,
                                          paras_name, test_weights + ".h5")
+        self.pred_path = os.path.join(weights_save_dir,
+                                      paras_name, test_weights + "_pred.npz")
         self.results_dir = os.path.join(results_save_dir, paras_name)
         self.create_dir(self.results_dir, rm=False)
 
@@ -94,21 +128,82 @@ class BTCTest(object):
 
         '''
 
-        self.model_name = self.paras["model_name"]
         self.batch_size = self.paras["batch_size"]
+
+        # Model trained on patches predicts by sliding windows
+        self.patch_shape = self.paras["patch_shape"]
+        self.patch_stride = self.paras["patch_stride"]
+
+        # Model with early exit is also evaluated at each threshold
+        self.early_exit = self.paras["early_exit"]
+        self.exit_thresholds = self.paras["exit_thresholds"]
         return
 
     def _load_model(self):
         '''_LOAD_MODEL
 
-            Create 3D Multi-Scale CNN.
+            Load trained 3D Multi-Scale CNN in self.backend,
+            threads and CPU affinity are set before loading.
 
         '''
 
-        self.model = BTCModels(model_name=self.model_name).model
+        self.model = load_backend(self.backend, self.paras_name,
+                                  self.paras_json_path,
+                                  self.weights_save_dir, self.weights,
+                                  self.session_paras)
         return
 
-    def _pred_evaluate(self, x, y, dataset):
+    def _load_pred(self, data):
+        '''_LOAD_PRED
+
+            Load predictions saved by BTCTrain. Predictions are
+            ignored if they are older than weights or were made
+            with other hyperparameters. Predictions of a set are
+            kept only if they cover the whole set and were saved
+            for the same subjects.
+
+            Input:
+            ------
+
+            - data: an BTCDataset instance.
+
+            Output:
+            -------
+
+            - A dictionary of predictions of each set.
+
+        '''
+
+        if not self.reuse_pred or not os.path.isfile(self.pred_path):
+            return {}
+
+        if os.path.getmtime(self.pred_path) < \
+                os.path.getmtime(self.weights_path):
+            print("Predictions in {} are older than weights.".format(
+                  self.pred_path))
+            return {}
+
+        saved = np.load(self.pred_path)
+        paras = json.dumps(self.paras, sort_keys=True)
+        if "paras" not in saved or str(saved["paras"]) != paras:
+            print("Predictions in {} were made with other "
+                  "hyperparameters.".format(self.pred_path))
+            return {}
+
+        preds = {}
+        for dataset in ["train", "valid", "test"]:
+            ids = getattr(data, dataset + "_ids", None)
+            if ids is None or dataset + "_ids" not in saved or \
+                    list(saved[dataset + "_ids"]) != list(ids):
+                continue
+            if len(saved[dataset]) == len(getattr(data, dataset + "_x")):
+                preds[dataset] = saved[dataset]
+
+        print("Reuse predictions of {} from {}".format(
+              ", ".join(sorted(preds.keys())), self.pred_path))
+        return preds
+
+    def _pred_evaluate(self, x, y, dataset, pred=None):
         '''_PRED_EVALUATE
 
             Predict input data and evaluate performance, including:
@@ -127,6 +222,8 @@ class BTCTest(object):
             - y: numpy ndarray, ground truth labels
             - dataset: string, indicates which set to use,
                        "train", "valid" or "test".
+            - pred: numpy ndarray, predictions of x, default is
+                    None, which means predicting x by model.
 
             Outputs:
             --------
@@ -136,66 +233,32 @@ class BTCTest(object):
 
         '''
 
-        # Helper function to compute metrics
-        # true_y: ground truth labels
-        # pred_y: predicted labels
-        def acc(true_y, pred_y):
-            return (true_y == pred_y).all(axis=1).mean()
-
-        def loss(true_y, pred_y):
-            return log_loss(true_y, pred_y, normalize=True)
-
-        def precision(true_y, pred_y, label):
-            return precision_score(true_y, pred_y, pos_label=label)
-
-        def recall(true_y, pred_y, label):
-            return recall_score(true_y, pred_y, pos_label=label)
-
         print("Dataset to be predicted: " + dataset)
 
         # Obtain predictions of input data
-        pred = self.model.predict(x, self.batch_size, 0)
-
-        # Ground truth labels
-        arg_y = np.argmax(y, axis=1)
-        arg_y = np.reshape(arg_y, (-1, 1))
-
-        # Indices for HGG and LGG subjects
-        hgg = np.where(arg_y == 1)[0]
-        lgg = np.where(arg_y == 0)[0]
-
-        # Predicted labels
-        arg_pred = np.argmax(pred, axis=1)
-        arg_pred = np.reshape(arg_pred, (-1, 1))
+        if pred is None and self.patch_shape:
+            from btc_patches import sliding_window_predict
+            pred = sliding_window_predict(self.model, x,
+                                          self.patch_shape,
+                                          self.patch_stride,
+                                          self.batch_size)
+        elif pred is None:
+            pred = self.model.predict(x, self.batch_size)
+            if isinstance(pred, list):
+                # Predictions of fc3 if model has early exit
+                pred = pred[0]
 
         # Generate ROC curve
-        roc_line = roc_curve(arg_y, pred[:, 1], pos_label=1)
-        # Compute confusion matrix
-        tn, fp, fn, tp = confusion_matrix(arg_y, arg_pred).ravel()
+        roc_line = roc_curve(np.argmax(y, axis=1), pred[:, 1], pos_label=1)
 
         # A dictionary conains all result to be written
         # in [dataset]_[self.weights]_res.csv
-        results = {"name": self.paras_name,
-                   "acc": acc(arg_y, arg_pred),
-                   "hgg_acc": acc(arg_y[hgg], arg_pred[hgg]),
-                   "lgg_acc": acc(arg_y[lgg], arg_pred[lgg]),
-                   "loss": loss(y, pred),
-                   "hgg_loss": loss(y[hgg], pred[hgg]),
-                   "lgg_loss": loss(y[lgg], pred[lgg]),
-                   "hgg_precision": precision(arg_y, arg_pred, 1),
-                   "lgg_precision": precision(arg_y, arg_pred, 0),
-                   "hgg_recall": recall(arg_y, arg_pred, 1),
-                   "lgg_recall": recall(arg_y, arg_pred, 0),
-                   "roc_auc": roc_auc_score(arg_y, pred[:, 1]),
-                   "tn": tn, "fp": fp, "fn": fn, "tp": tp}
+        results = self.compute_metrics(y, pred)
+        results["name"] = self.paras_name
 
         # Create pandas DataFrame, and reorder columns
         res_df = pd.DataFrame(data=results, index=[0])
-        res_df = res_df[["name", "acc", "hgg_acc", "lgg_acc",
-                         "loss", "hgg_loss", "lgg_loss",
-                         "hgg_precision", "hgg_recall",
-                         "lgg_precision", "lgg_recall",
-                         "roc_auc", "tn", "fp", "fn", "tp"]]
+        res_df = res_df[["name"] + METRICS]
 
         # Save results to [dataset]_[self.weights]_res.csv
         root_name = [dataset, self.weights]
@@ -210,6 +273,83 @@ class BTCTest(object):
 
         return
 
+    def _early_exit_evaluate(self, x, y, dataset):
+        '''_EARLY_EXIT_EVALUATE
+
+            Evaluate early exit at each threshold in exit_thresholds.
+            Each sample is predicted alone by BTCModels.early_exit_predict
+            and timed, thus the latency of a sample which does not
+            exit is the time of the coarse model plus the fine model
+            which reuses activations of the coarse model.
+            Threshold "full" is the full model alone.
+            Only Keras backend is supported.
+
+            Inputs:
+            -------
+
+            - x: numpy ndarray, input images.
+            - y: numpy ndarray, ground truth labels.
+            - dataset: string, "train", "valid" or "test".
+
+            Output:
+            -------
+
+            - [dataset]_[self.weights]_early_exit.csv, including
+              threshold, exit_rate, acc and latency_ms.
+
+        '''
+
+        print("Early exit on dataset: " + dataset)
+
+        from btc_models import BTCModels
+        model = self.model.model
+        coarse, fine = BTCModels.exit_models(model)
+
+        # Helper function to predict each sample and time it
+        def timed(predict):
+            preds, latency = [], []
+            for i in range(len(x)):
+                start = time.time()
+                preds.append(predict(x[i:i + 1]))
+                latency.append((time.time() - start) * 1000.0)
+            return np.concatenate(preds), np.mean(latency)
+
+        # The first prediction of each model includes
+        # building functions, thus it is not timed
+        model.predict(x[:1], 1, 0)
+        BTCModels.early_exit_predict(coarse, fine, x[:1], np.inf)
+
+        arg_y = np.argmax(y, axis=1)
+        pred, latency = timed(lambda sample: model.predict_on_batch(sample)[0])
+        rows = [{"threshold": "full", "exit_rate": 0.0,
+                 "acc": np.mean(np.argmax(pred, axis=1) == arg_y),
+                 "latency_ms": latency}]
+        for threshold in self.exit_thresholds:
+            exited = []
+
+            def predict(sample):
+                pred, sample_exited = BTCModels.early_exit_predict(
+                    coarse, fine, sample, threshold)
+                exited.append(sample_exited)
+                return pred
+
+            pred, latency = timed(predict)
+            rows.append({"threshold": threshold,
+                         "exit_rate": np.mean(np.concatenate(exited)),
+                         "acc": np.mean(np.argmax(pred, axis=1) == arg_y),
+                         "latency_ms": latency})
+
+        res_df = pd.DataFrame(rows)
+        res_df = res_df[["threshold", "exit_rate", "acc", "latency_ms"]]
+        print(res_df.to_string(index=False))
+
+        # Save results to [dataset]_[self.weights]_early_exit.csv
+        res_csv_name = "_".join([dataset, self.weights, "early_exit.csv"])
+        res_df.to_csv(os.path.join(self.results_dir, res_csv_name),
+                      index=False)
+
+        return
+
     def run(self, data):
         '''RUN
 
@@ -225,23 +365,98 @@ class BTCTest(object):
 
         print("\nTesting the model.\n")
 
-        # Load model and weights
-        self._load_model()
-        self.model.load_weights(self.weights_path)
-
+        # Predictions computed after training
+        preds = self._load_pred(data)
+        datasets = ["valid", "test"]
         if self.pred_trainset:
-            # Predict and evluate on training set
-            self._pred_evaluate(data.train_x, data.train_y, "train")
+            datasets = ["train"] + datasets
+
+        # Early exit is evaluated on Keras model
+        early_exit = self.early_exit and self.backend == "keras"
+        if early_exit or not all([dataset in preds for dataset in datasets]):
+            # Load model and weights
+            self._load_model()
+
+        # Predict and evluate on training (optional),
+        # validation and testing set
+        for dataset in datasets:
+            self._pred_evaluate(getattr(data, dataset + "_x"),
+                                getattr(data, dataset + "_y"),
+                                dataset, preds.get(dataset))
+            if early_exit:
+                self._early_exit_evaluate(getattr(data, dataset + "_x"),
+                                          getattr(data, dataset + "_y"),
+                                          dataset)
+
+        if self.backend == "keras":
+            # Destroy the current TF graph
+            from keras import backend as K
+            K.clear_session()
+
+        return
 
-        # Predict and evluate on validation set
-        self._pred_evaluate(data.valid_x, data.valid_y, "valid")
-        # Predict and evluate on testing set
-        self._pred_evaluate(data.test_x, data.test_y, "test")
+    @staticmethod
+    def compute_metrics(y, pred):
+        '''COMPUTE_METRICS
 
-        # Destroy the current TF graph
-        K.clear_session()
+            Compute metrics of predictions, see METRICS.
 
-        return
+            Inputs:
+            -------
+
+            - y: numpy ndarray, ground truth labels in one-hot.
+            - pred: numpy ndarray, predicted probabilities.
+
+            Output:
+            -------
+
+            - results: dictionary, name and value of each metric.
+
+        '''
+
+        # Helper function to compute metrics
+        # true_y: ground truth labels
+        # pred_y: predicted labels
+        def acc(true_y, pred_y):
+            return (true_y == pred_y).all(axis=1).mean()
+
+        def loss(true_y, pred_y):
+            return log_loss(true_y, pred_y, normalize=True)
+
+        def precision(true_y, pred_y, label):
+            return precision_score(true_y, pred_y, pos_label=label)
+
+        def recall(true_y, pred_y, label):
+            return recall_score(true_y, pred_y, pos_label=label)
+
+        # Ground truth labels
+        arg_y = np.argmax(y, axis=1)
+        arg_y = np.reshape(arg_y, (-1, 1))
+
+        # Indices for HGG and LGG subjects
+        hgg = np.where(arg_y == 1)[0]
+        lgg = np.where(arg_y == 0)[0]
+
+        # Predicted labels
+        arg_pred = np.argmax(pred, axis=1)
+        arg_pred = np.reshape(arg_pred, (-1, 1))
+
+        # Compute confusion matrix
+        tn, fp, fn, tp = confusion_matrix(arg_y, arg_pred).ravel()
+
+        results = {"acc": acc(arg_y, arg_pred),
+                   "hgg_acc": acc(arg_y[hgg], arg_pred[hgg]),
+                   "lgg_acc": acc(arg_y[lgg], arg_pred[lgg]),
+                   "loss": loss(y, pred),
+                   "hgg_loss": loss(y[hgg], pred[hgg]),
+                   "lgg_loss": loss(y[lgg], pred[lgg]),
+                   "hgg_precision": precision(arg_y, arg_pred, 1),
+                   "lgg_precision": precision(arg_y, arg_pred, 0),
+                   "hgg_recall": recall(arg_y, arg_pred, 1),
+                   "lgg_recall": recall(arg_y, arg_pred, 0),
+                   "roc_auc": roc_auc_score(arg_y, pred[:, 1]),
+                   "tn": tn, "fp": fp, "fn": fn, "tp": tp}
+        return results
 
     @staticmethod
     def load_paras(paras_json_path, paras_name):
@@ -292,7 +507,7 @@ class BTCTest(object):
         return
 
 
-def main(hyper_paras_name):
+def main(hyper_paras_name, args=None):
     '''MAIN
 
         Main process to train model.
@@ -302,10 +517,12 @@ def main(hyper_paras_name):
 
         - hyper_paras_name: string, the name of hyperparameters set,
                             which can be found in hyper_paras.json.
+        - args: argparse Namespace, session settings from command
+                line which override pre_paras.json. Default is None.
 
     '''
 
-    from btc_dataset import BTCDataset
+    from btc_dataset import load_dataset
 
     # Basic settings in pre_paras.json, including
     # 1. directory paths for input and output
@@ -327,15 +544,7 @@ def main(hyper_paras_name):
     results_save_dir = os.path.join(parent_dir, pre_paras["results_save_dir"])
 
     # Partition dataset
-    data = BTCDataset(hgg_dir, lgg_dir,
-                      volume_type=pre_paras["volume_type"],
-                      pre_trainset_path=pre_paras["pre_trainset_path"],
-                      pre_validset_path=pre_paras["pre_validset_path"],
-                      pre_testset_path=pre_paras["pre_testset_path"],
-                      data_format=pre_paras["data_format"])
-    data.run(pre_split=pre_paras["pre_split"],
-             save_split=pre_paras["save_split"],
-             save_split_dir=pre_paras["save_split_dir"])
+    data = load_dataset(hgg_dir, lgg_dir, pre_paras)
 
     # Test the model
     train = BTCTest(paras_name=hyper_paras_name,
@@ -343,7 +552,10 @@ def main(hyper_paras_name):
                     weights_save_dir=weights_save_dir,
                     results_save_dir=results_save_dir,
                     test_weights=pre_paras["test_weights"],
-                    pred_trainset=pre_paras["pred_trainset"])
+                    pred_trainset=pre_paras["pred_trainset"],
+                    session_paras=session_paras(pre_paras, args),
+                    reuse_pred=pre_paras["reuse_pred"],
+                    backend=pre_paras["backend"])
     train.run(data)
 
     return
@@ -353,6 +565,7 @@ if __name__ == "__main__":
 
     # Command line
     # python btc_test.py --paras=paras-1
+    # python btc_test.py --paras=paras-1 --intra_op_threads=4
 
     parser = argparse.ArgumentParser()
 
@@ -360,6 +573,7 @@ if __name__ == "__main__":
     help_str = "Select a set of hyper-parameters in hyper_paras.json."
     parser.add_argument("--paras", action="store", default="paras-1",
                         dest="hyper_paras_name", help=help_str)
+    add_session_args(parser)
 
     args = parser.parse_args()
-    main(args.hyper_paras_name)
+    main(args.hyper_paras_name, args)
@@ -21,15 +21,43 @@ from __future__ import print_function
 
 import os
 import json
+import math
+import time
 import shutil
+import resource
 import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from btc_cache import FeatureCache
 from btc_models import BTCModels
+from btc_dataset import BTCDataset, load_dataset
+from btc_prune import Pruning
+from btc_patches import PatchSampler, sliding_window_predict
+from btc_session import (set_session,
+                         session_paras,
+                         add_session_args)
+from btc_optimizers import AdamAccumulate
+from btc_distributed import (shard,
+                             launch,
+                             ShardSequence,
+                             is_launched,
+                             import_horovod)
+from btc_callbacks import (AsyncWriter,
+                           CallbackState,
+                           ThroughputLogger,
+                           PeriodicValidation,
+                           TrainingCheckpoint,
+                           AsyncModelCheckpoint)
 
 from keras import backend as K
+from keras.models import Model
 from keras.optimizers import Adam
 from keras.callbacks import (CSVLogger,
                              TensorBoard,
-                             ModelCheckpoint,
+                             EarlyStopping,
+                             ReduceLROnPlateau,
                              LearningRateScheduler)
 
 
@@ -40,7 +68,10 @@ class BTCTrain(object):
                  paras_json_path,
                  weights_save_dir,
                  logs_save_dir,
-                 save_best_weights=True):
+                 save_best_weights=True,
+                 resume=False,
+                 session_paras=None,
+                 distributed=False):
         '''__INIT__
 
             Initalization before training model.
@@ -59,33 +90,95 @@ class BTCTrain(object):
                              logs of training process.
             - save_best_weights: boolean, if save the model with best
                                  validation accuracy. Default is True.
+            - resume: boolean, if True and checkpoint exists, continue
+                      training from checkpoint, and keep weights and
+                      logs directories. Default is False.
+            - session_paras: dictionary, threads and CPU affinity
+                             of TensorFlow session, see set_session
+                             in btc_session.py. Default is None,
+                             which uses the default session.
+            - distributed: boolean, if True, train model in data
+                           parallel by Horovod, each worker process
+                           is started by horovodrun and trains on
+                           a shard of training set, reshuffled in
+                           each epoch, validation set is sharded
+                           and metrics are averaged. Only the first
+                           worker writes logs and weights.
+                           Default is False.
 
         '''
 
         # Dataset: training, validation and test
         self.data = None
+        # Multipliers of learning rate of frozen parameters
+        self.lr_multipliers = {}
 
         # If save the model which provides best validation accuracy
         self.save_best_weights = save_best_weights
 
+        # Threads and CPU affinity of TensorFlow session
+        self.session_paras = session_paras
+
+        # Rank of this worker and the number of workers
+        self.distributed = distributed
+        self.rank, self.size = 0, 1
+        if distributed:
+            self.hvd = import_horovod()
+            self.hvd.init()
+            self.rank, self.size = self.hvd.rank(), self.hvd.size()
+            if self.session_paras is None:
+                # Divide cores among workers on the same host
+                threads = multiprocessing.cpu_count() // self.hvd.local_size()
+                self.session_paras = {"intra_op_threads": max(1, threads),
+                                      "inter_op_threads": 1}
+        # Only the chief worker writes files
+        self.is_chief = self.rank == 0
+
         # Load hyperparameters
         self.paras = self.load_paras(paras_json_path, paras_name)
         self._load_paras()
 
-        # Create folder for saving weights
+        # Checkpoint files to resume training
         self.weights_dir = os.path.join(weights_save_dir, paras_name)
-        self.create_dir(self.weights_dir)
 
-        # Create folder for saving training logs
+        self.init_weights_path = None
+        if self.init_weights:
+            self.init_weights_path = os.path.join(weights_save_dir,
+                                                  self.init_weights)
+            if os.path.dirname(os.path.abspath(self.init_weights_path)) == \
+               os.path.abspath(self.weights_dir):
+                raise ValueError("init_weights should be out of " +
+                                 self.weights_dir + ", which is cleaned.")
+        self.checkpoint_path = os.path.join(self.weights_dir,
+                                            "checkpoint_{epoch:03d}.h5")
+        self.resume = resume and \
+            TrainingCheckpoint.latest(self.checkpoint_path) is not None
+        # All workers follow the chief, which owns checkpoints
+        self.resume = bool(self._broadcast(self.resume, "resume"))
+        if resume and not self.resume:
+            print("No checkpoint is found, train model from scratch.")
+
         self.logs_dir = os.path.join(logs_save_dir, paras_name)
-        self.create_dir(self.logs_dir)
+        if self.is_chief:
+            # Create folder for saving weights
+            self.create_dir(self.weights_dir, rm=not self.resume)
+            # Create folder for saving training logs
+            self.create_dir(self.logs_dir, rm=not self.resume)
 
         # Initialize files' names for weights at last or best epoch
         self.last_weights_path = os.path.join(self.weights_dir, "last.h5")
         self.best_weights_path = os.path.join(self.weights_dir, "best.h5")
+        # Predictions of weights at last epoch, reused by BTCTest
+        self.last_pred_path = os.path.join(self.weights_dir, "last_pred.npz")
+        # Snapshots of each sparsity in pruning
+        self.pruned_path = os.path.join(self.weights_dir, "pruned_{:.2f}.h5")
 
         # CSV file path for writing learning curves
         self.curves_path = os.path.join(self.logs_dir, "curves.csv")
+        # CSV file path for writing timing of each batch
+        self.throughput_path = os.path.join(self.logs_dir, "throughput.csv")
+        # CSV file path for writing trials of batch size
+        self.batch_size_path = os.path.join(self.logs_dir, "batch_size.csv")
 
         return
 
@@ -104,47 +197,430 @@ class BTCTrain(object):
         self.drop_rate = self.paras["drop_rate"]
         self.bn_momentum = self.paras["bn_momentum"]
         self.initializer = self.paras["initializer"]
+        self.width_mult = self.paras["width_mult"]
+        self.depth_mult = self.paras["depth_mult"]
+        self.scales = self.paras["scales"]
+        self.conv_type = self.paras["conv_type"]
+        self.global_pool = self.paras["global_pool"]
 
         # Parameters to train model
         self.optimizer = self.paras["optimizer"]
         self.lr_start = self.paras["lr_start"]
+
+        # Parameters of learning rate schedule and early stopping
+        self.lr_schedule = self.paras["lr_schedule"]
+        self.lr_steps = self.paras["lr_steps"]
+        self.lr_decay = self.paras["lr_decay"]
+        self.lr_min = self.paras["lr_min"]
+        self.lr_warmup = self.paras["lr_warmup"]
+        # Horizon of "cosine" and "onecycle" schedules, None means
+        # epochs_num, it is fixed when training is stopped earlier
+        # and continued later, such as in btc_search.py
+        self.lr_epochs = self.paras["lr_epochs"] or self.paras["epochs_num"]
+        self.plateau_patience = self.paras["plateau_patience"]
+        self.early_stopping_patience = self.paras["early_stopping_patience"]
+
+        # Validate every n epochs, patience above is counted
+        # in validations, thus it is scaled by valid_freq
+        self.valid_freq = self.paras["valid_freq"]
+        # Proportion of training set to be scored after training
+        self.train_score_frac = self.paras["train_score_frac"]
+
+        # Progressive resolution, a list of [epoch, scale], inputs
+        # are resized by scale from the epoch, empty list means
+        # training in full resolution
+        self.prog_schedule = sorted(self.paras["prog_schedule"])
+        if self.prog_schedule and not self.global_pool:
+            raise ValueError("Progressive resolution requires global_pool.")
+
+        # Patch training, model is trained on random patches in
+        # patch_shape, and predicts volumes by sliding windows
+        # with patch_stride, None means training on whole volumes
+        self.patch_shape = self.paras["patch_shape"]
+        self.patch_stride = self.paras["patch_stride"]
+        self.patch_tumor_prob = self.paras["patch_tumor_prob"]
+        if self.patch_shape:
+            if not self.global_pool or self.prog_schedule:
+                raise ValueError("Patch training requires global_pool "
+                                 "and no progressive resolution.")
+            # Inputs of model are patches
+            self.input_shape = self.patch_shape + self.input_shape[3:]
+
+        # Weights of a trained model, path relative to weights_save_dir
+        self.init_weights = self.paras["init_weights"]
+        # Only train dense layers on cached outputs of convolutional
+        # layers, which are computed by model with init_weights
+        self.head_only = self.paras["head_only"]
+        # Layers whose names start with these prefixes are frozen,
+        # their learning rate is lr * frozen_lr, or they are not
+        # trainable if frozen_lr is 0
+        self.freeze_prefixes = self.paras["freeze_prefixes"]
+        self.frozen_lr = self.paras["frozen_lr"]
+        if self.head_only and (not self.init_weights or
+                               self.patch_shape or self.prog_schedule):
+            raise ValueError("Head-only training requires init_weights, "
+                             "and no patch or progressive training.")
+
+        # Early exit, an extra output on scale 1 is trained jointly,
+        # its loss is weighted by exit_loss_weight
+        self.early_exit = self.paras["early_exit"]
+        self.exit_loss_weight = self.paras["exit_loss_weight"]
+        if self.early_exit and self.patch_shape:
+            raise ValueError("Early exit is not supported in patch training.")
+        # Quantity monitored by callbacks, only loss of fc3 is
+        # monitored if early exit is enabled, since val_loss
+        # also includes weighted loss of exit1
+        self.monitor = "val_fc3_loss" if self.early_exit else "val_loss"
+
+        # Pruning while training, "magnitude" or "channel", None
+        # means no pruning, schedule is a list of [epoch, sparsity]
+        self.prune_mode = self.paras["prune_mode"]
+        self.prune_schedule = self.paras["prune_schedule"]
+        if self.prune_mode and (not self.prune_schedule or self.head_only):
+            raise ValueError("Pruning requires prune_schedule "
+                             "and no head-only training.")
+
         self.epochs_num = self.paras["epochs_num"]
         self.batch_size = self.paras["batch_size"]
+        # batch_size is the size of micro-batch if gradients
+        # are accumulated, the effective batch size in each
+        # update is batch_size * accum_steps
+        self.accum_steps = self.paras["accum_steps"]
+
+        # Parameters to search batch size automatically
+        self.auto_batch_size = self.paras["auto_batch_size"]
+        self.max_batch_size = self.paras["max_batch_size"]
+        self.memory_budget_mb = self.paras["memory_budget_mb"]
+        self.trial_steps = self.paras["trial_steps"]
+        if self.auto_batch_size and self.trial_steps < 1:
+            raise ValueError("Batch size search requires trial_steps "
+                             "no less than 1.")
+
+        # Save checkpoint to resume training every n epochs
+        self.checkpoint_period = self.paras["checkpoint_period"]
+        # The number of newest checkpoints to keep
+        self.max_checkpoints = self.paras["max_checkpoints"]
+        # Compression of weights files, None, "gzip" or "lzf"
+        self.checkpoint_compression = self.paras["checkpoint_compression"]
         return
 
-    def _load_model(self):
+    def _load_model(self, input_shape=None, model_name=None):
         '''_LOAD_MODEL
 
             Create 3D Multi-Scale CNN.
 
+            Inputs:
+            -------
+
+            - input_shape: list, shape of inputs, default is None,
+                           which means self.input_shape.
+            - model_name: string, default is None, which means
+                          "head" in head-only training, otherwise
+                          self.model_name.
+
+        '''
+
+        if model_name is None:
+            model_name = "head" if self.head_only else self.model_name
+
+        self.models = BTCModels(model_name=model_name,
+                                input_shape=input_shape or self.input_shape,
+                                pooling=self.pooling,
+                                l2_coeff=self.l2_coeff,
+                                drop_rate=self.drop_rate,
+                                bn_momentum=self.bn_momentum,
+                                initializer=self.initializer,
+                                width_mult=self.width_mult,
+                                depth_mult=self.depth_mult,
+                                scales=self.scales,
+                                conv_type=self.conv_type,
+                                global_pool=self.global_pool,
+                                early_exit=self.early_exit)
+        self.model = self.models.model
+        return
+
+    def _compile(self):
+        '''_COMPILE
+
+            Compile model with self.opt_fcn. If early exit is
+            enabled, loss of exit1 is added with exit_loss_weight.
+
+        '''
+
+        loss_weights = [1.0, self.exit_loss_weight] \
+            if self.early_exit else None
+        self.model.compile(loss="categorical_crossentropy",
+                           loss_weights=loss_weights,
+                           optimizer=self.opt_fcn,
+                           metrics=["accuracy"])
+        return
+
+    def _targets(self, y):
+        '''_TARGETS
+
+            Targets of model's outputs, labels are repeated
+            for fc3 and exit1 if early exit is enabled.
+
+            Input:
+            ------
+
+            - y: numpy ndarray, labels.
+
+            Output:
+            -------
+
+            - numpy ndarray or list of it.
+
+        '''
+
+        return [y, y] if self.early_exit else y
+
+    def _cache_features(self, data):
+        '''_CACHE_FEATURES
+
+            Compute outputs of selected scales by convolutional
+            layers with init_weights, only if they are not cached.
+            Outputs are cached in [init_weights]_cache directory,
+            and are shared by head-only training of all sets of
+            hyperparameters with the same init_weights.
+
+            Input:
+            ------
+
+            - data: an BTCDataset instance.
+
+            Output:
+            -------
+
+            - a FeatureCache instance, whose x are cached outputs.
+
+        '''
+
+        cache_dir = os.path.splitext(self.init_weights_path)[0] + "_cache"
+        cache = FeatureCache(cache_dir, self.scales)
+
+        missing = cache.missing(data, self.init_weights_path)
+        if missing:
+            self._set_session()
+            self._load_model(model_name="pyramid")
+            self.model.load_weights(self.init_weights_path, by_name=True)
+
+            # Only compute outputs of missing scales
+            outputs = [self.models.backbone.outputs[self.models.scales.index(s)]
+                       for s in missing]
+            backbone = Model(inputs=self.model.input, outputs=outputs)
+            cache.build(backbone, missing, data, self.batch_size)
+            K.clear_session()
+
+        cache.load(data)
+        return cache
+
+    def _merge_head(self):
+        '''_MERGE_HEAD
+
+            Save weights of the whole model after head-only training,
+            convolutional layers are from init_weights and dense
+            layers are from trained head. Both last.h5 and best.h5
+            are replaced, so that BTCTest works as usual.
+
+        '''
+
+        # Wait for weights of best head
+        self.writer.flush()
+
+        head = self.model
+        self._load_model(model_name="pyramid")
+        model, self.model = self.model, head
+        model.load_weights(self.init_weights_path, by_name=True)
+
+        # Helper function to copy weights of head into whole model
+        def merge(to_path):
+            for layer in head.layers:
+                if layer.weights:
+                    model.get_layer(layer.name).set_weights(layer.get_weights())
+            self.writer.save(model, to_path)
+            return
+
+        merge(self.last_weights_path)
+        if self.save_best_weights and os.path.isfile(self.best_weights_path):
+            last_weights = head.get_weights()
+            head.load_weights(self.best_weights_path)
+            merge(self.best_weights_path)
+            head.set_weights(last_weights)
+
+        return
+
+    def _load_checkpoint(self):
+        '''_LOAD_CHECKPOINT
+
+            Restore weights, optimizer's state, learning rate,
+            batch size and random states from the newest checkpoint,
+            and remove rows of learning curves after checkpoint.
+            State of tracked callbacks and patch sampler is kept in
+            self.tracked_state, and is restored when training begins
+            (see _set_callbacks). Model should be compiled before.
+
+            Output:
+            -------
+
+            - int, index of the epoch to start training.
+
+        '''
+
+        checkpoint_path = TrainingCheckpoint.latest(self.checkpoint_path)
+        print("Resume training from " + checkpoint_path)
+
+        self.model.load_weights(checkpoint_path)
+        AsyncWriter.load_optimizer_weights(self.model, checkpoint_path)
+
+        state = TrainingCheckpoint.load_state(checkpoint_path)
+        K.set_value(self.opt_fcn.lr, state["lr"])
+        self.best_monitored = state.get("best")
+        self.tracked_state = state.get("tracked", {})
+
+        # Keep learning curves until checkpoint
+        if os.path.isfile(self.curves_path):
+            curves = pd.read_csv(self.curves_path)
+            curves = curves[curves["epoch"] <= state["epoch"]]
+            curves.to_csv(self.curves_path, index=False)
+
+        return state["epoch"] + 1
+
+    def _broadcast(self, value, name):
+        '''_BROADCAST
+
+            Send an integer from the chief to all workers
+            in distributed training.
+
+            Inputs:
+            -------
+
+            - value: int or boolean of this worker.
+            - name: string, unique name of the operation,
+                    which matches operations among workers.
+
+            Output:
+            -------
+
+            - int, value of the chief worker.
+
+        '''
+
+        if not self.distributed:
+            return int(value)
+        return int(self.hvd.broadcast(np.array(int(value)), 0, name=name))
+
+    def _broadcast_state(self, tracked, state):
+        '''_BROADCAST_STATE
+
+            Send state of tracked objects (see CallbackState)
+            from the chief to all workers in distributed training.
+
+            Inputs:
+            -------
+
+            - tracked: dictionary, name and [object, attribute names].
+            - state: dictionary, name and {attribute: value} of
+                     this worker.
+
+            Output:
+            -------
+
+            - dictionary, state of the chief worker.
+
         '''
 
-        self.model = BTCModels(model_name=self.model_name,
-                               input_shape=self.input_shape,
-                               pooling=self.pooling,
-                               l2_coeff=self.l2_coeff,
-                               drop_rate=self.drop_rate,
-                               bn_momentum=self.bn_momentum,
-                               initializer=self.initializer).model
+        if not self.distributed:
+            return state
+
+        keys = [[name, attr] for name in sorted(tracked)
+                for attr in tracked[name][1]]
+        values = [state.get(name, {}).get(attr, np.nan) for name, attr in keys]
+        values = self.hvd.broadcast(np.array(values, dtype=np.float64), 0,
+                                    name="tracked_state")
+
+        state = {}
+        for (name, attr), value in zip(keys, values):
+            if not np.isnan(value):
+                state.setdefault(name, {})[attr] = float(value)
+        return state
+
+    def _init_weights(self, load_weights=True):
+        '''_INIT_WEIGHTS
+
+            Warm start from init_weights and freeze layers.
+            -1- Load weights by name, layers which are not found
+                or whose shapes are changed keep initialized.
+            -2- Layers whose names start with freeze_prefixes are
+                not trainable if frozen_lr is 0, otherwise their
+                learning rate is multiplied by frozen_lr.
+            It should be called before compiling model.
+
+            Input:
+            ------
+
+            - load_weights: boolean, if False, skip -1-.
+                            Default is True.
+
+        '''
+
+        if load_weights and self.init_weights_path and not self.head_only:
+            print("Initialize weights from " + self.init_weights_path)
+            self.model.load_weights(self.init_weights_path, by_name=True,
+                                    skip_mismatch=True)
+
+        self.lr_multipliers = {}
+        frozen = [layer for layer in self.model.layers
+                  if any([layer.name.startswith(prefix)
+                          for prefix in self.freeze_prefixes])]
+        for layer in frozen:
+            if self.frozen_lr == 0:
+                layer.trainable = False
+            else:
+                for weight in layer.trainable_weights:
+                    self.lr_multipliers[weight.name] = self.frozen_lr
+
+        if frozen:
+            print("Frozen layers ({0} x lr): {1}".format(
+                  self.frozen_lr, ", ".join([l.name for l in frozen])))
+
         return
 
     def _set_optimizer(self):
         '''_SET_OPTIMIZER
 
             Set optimizer according to the given parameter.
-            Use "Adam" in this project.
+            Use "Adam" in this project. If accum_steps is larger
+            than 1, gradients of accum_steps micro-batches are
+            accumulated before each update. AdamAccumulate is
+            also used if learning rate of frozen layers is
+            multiplied (see self._init_weights).
 
         '''
 
         if self.optimizer == "adam":
-            self.opt_fcn = Adam(lr=self.lr_start)
+            if self.accum_steps > 1 or self.lr_multipliers:
+                self.opt_fcn = AdamAccumulate(lr=self.lr_start,
+                                              accum_steps=self.accum_steps,
+                                              lr_multipliers=self.lr_multipliers)
+            else:
+                self.opt_fcn = Adam(lr=self.lr_start)
         return
 
     def _set_lr_scheduler(self, epoch):
         '''_SET_LR_SCHEDULER
 
-            Learning rate scheduler for training process.
-            LR: [init] * 40 + [init * 0.1] * 30 + [init * 0.01] * 30
+            Learning rate scheduler for training process,
+            selected by lr_schedule in hyper_paras.json.
+            - "step": multiply init by lr_decay at each epoch in
+                      lr_steps, [40, 70] and 0.1 give
+                      [init] * 40 + [init * 0.1] * 30 + [init * 0.01] * ...
+            - "cosine": cosine annealing from init to lr_min
+                        in lr_epochs epochs.
+            - "onecycle": linear warmup from init / 25 to init in
+                          the first lr_warmup part of lr_epochs, then
+                          cosine annealing to lr_min.
+            "plateau" is not scheduled by epoch, see _set_callbacks.
 
             Input:
             ------
@@ -158,43 +634,286 @@ class BTCTrain(object):
 
         '''
 
-        lrs = [self.lr_start] * 40 + \
-              [self.lr_start * 0.1] * 30 + \
-              [self.lr_start * 0.01] * 30
-        print("Learning rate:", lrs[epoch])
+        # Helper function for cosine annealing
+        # progress: float from 0 to 1
+        def cosine(lr_max, progress):
+            progress = min(1.0, progress)
+            return self.lr_min + 0.5 * (lr_max - self.lr_min) * \
+                (1 + math.cos(math.pi * progress))
+
+        if self.lr_schedule == "step":
+            decay_num = sum([epoch >= step for step in self.lr_steps])
+            lr = self.lr_start * self.lr_decay ** decay_num
+        elif self.lr_schedule == "cosine":
+            lr = cosine(self.lr_start, epoch / float(self.lr_epochs))
+        elif self.lr_schedule == "onecycle":
+            warmup = max(1, int(round(self.lr_epochs * self.lr_warmup)))
+            if epoch < warmup:
+                lr_init = self.lr_start / 25.0
+                lr = lr_init + (self.lr_start - lr_init) * epoch / float(warmup)
+            else:
+                lr = cosine(self.lr_start, (epoch - warmup) /
+                            float(max(1, self.lr_epochs - warmup)))
+        else:
+            raise ValueError("Unknown learning rate schedule: " +
+                             self.lr_schedule)
+        print("Learning rate:", lr)
+
+        return lr
+
+    def _find_batch_size(self):
+        '''_FIND_BATCH_SIZE
+
+            Search the batch size which provides the highest
+            throughput within memory budget. Batch size grows
+            from 1 to self.max_batch_size by doubling. For each
+            batch size, a few training steps are run on synthetic
+            inputs in shape of self.input_shape. The search stops
+            once the estimated memory (see BTCModels.profile) or
+            the measured growth of peak RSS exceeds the budget,
+            or the backend runs out of memory.
+            Trials are saved in batch_size.csv in logs directory.
+
+        '''
+
+        print("\nSearching batch size within {} MB.\n".format(
+              self.memory_budget_mb))
+
+        # Build a model only for trials
+        self._set_session()
+        self._load_model()
+        self._set_optimizer()
+        self._compile()
+
+        # Peak RSS in MB before trials
+        def peak_rss():
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        base_rss = peak_rss()
+
+        trials, batch_size = [], 1
+        while batch_size <= self.max_batch_size:
+            _, estimated = BTCModels.profile(self.model, batch_size,
+                                             self.optimizer, verbose=False)
+            estimated /= 1024.0 ** 2
+            if estimated > self.memory_budget_mb:
+                break
+
+            x = np.random.randn(*([batch_size] + self.input_shape))
+            y = self._targets(np.eye(2)[np.random.randint(0, 2, batch_size)])
+            try:
+                # The first step is not timed since it
+                # includes graph building and allocation
+                self.model.train_on_batch(x, y)
+                start = time.time()
+                for _ in range(self.trial_steps):
+                    self.model.train_on_batch(x, y)
+                duration = time.time() - start
+            except (tf.errors.ResourceExhaustedError, MemoryError):
+                break
+
+            measured = peak_rss() - base_rss
+            if measured > self.memory_budget_mb:
+                break
+
+            throughput = batch_size * self.trial_steps / duration
+            print("Batch size: {0}, Samples/sec: {1:.2f}, "
+                  "Memory (MB): estimated {2:.1f}, measured {3:.1f}".format(
+                      batch_size, throughput, estimated, measured))
+            trials.append({"batch_size": batch_size,
+                           "throughput": throughput,
+                           "estimated_mb": estimated,
+                           "measured_mb": measured})
+            batch_size *= 2
+
+        # Destroy the graph for trials
+        K.clear_session()
+
+        if not trials:
+            raise RuntimeError("No batch size fits in memory budget.")
+
+        # Select the fastest batch size and save all trials
+        trials_df = pd.DataFrame(trials)
+        self.batch_size = int(trials_df.loc[trials_df["throughput"].idxmax(),
+                                            "batch_size"])
+        trials_df["selected"] = trials_df["batch_size"] == self.batch_size
+        trials_df.to_csv(self.batch_size_path, index=False)
+        print("Selected batch size:", self.batch_size)
+
+        return
+
+    def _set_session(self):
+        '''_SET_SESSION
+
+            Set threads and CPU affinity of TensorFlow session
+            before building model.
+
+        '''
+
+        if self.session_paras is not None:
+            set_session(**self.session_paras)
+        return
+
+    def _stages(self, initial_epoch):
+        '''_STAGES
+
+            Split epochs into stages of progressive resolution.
 
-        return lrs[epoch]
+            Input:
+            ------
+
+            - initial_epoch: int, the epoch to start training.
+
+            Output:
+            -------
+
+            - list of [start, end, scale], epochs from start
+              (included) to end (excluded) are trained on inputs
+              resized by scale. Stages before initial_epoch
+              are skipped.
+
+        '''
+
+        schedule = self.prog_schedule or [[0, 1.0]]
+        if schedule[0][0] > 0:
+            # Full resolution before the first stage
+            schedule = [[0, 1.0]] + schedule
+
+        stages = []
+        ends = [s[0] for s in schedule[1:]] + [self.epochs_num]
+        for (start, scale), end in zip(schedule, ends):
+            start, end = max(start, initial_epoch), min(end, self.epochs_num)
+            if start < end:
+                stages.append([start, end, scale])
+
+        return stages
 
     def _set_callbacks(self):
         '''_SET_CALLBACKS
 
             Set callback functions while training model.
-            -1- Save learning curves while training.
-            -2- Set learning rate scheduler.
+            -1- Save learning curves and throughput while training.
+            -2- Set learning rate scheduler, or reduce learning
+                rate on plateau of validation loss (self.monitor).
             -3- Add support for TensorBoard.
             -4- Save best model while training. (optional)
+            -5- Save checkpoint to resume training. (optional)
+            -6- Stop training if validation loss does not
+                decrease. (optional)
+            -7- Prune model on schedule. (optional)
+            -8- Restore state of ReduceLROnPlateau, EarlyStopping
+                and patch sampler when resuming, and keep it
+                between stages of resolution.
+            If valid_freq is larger than 1, validation set is
+            evaluated by PeriodicValidation instead of fit.
+            Weights and checkpoints are written by self.writer
+            in background thread.
 
         '''
 
+        if self.distributed:
+            # -1- Copy initial weights and optimizer's state
+            #     of the chief to all workers
+            # -2- Average metrics over workers before they are
+            #     logged or monitored
+            hvd_callbacks = [
+                self.hvd.callbacks.BroadcastGlobalVariablesCallback(0),
+                self.hvd.callbacks.MetricAverageCallback()]
+        else:
+            hvd_callbacks = []
+
+        if self.valid_freq > 1:
+            # Validate before metrics are averaged or logged
+            if self.patch_shape:
+                valid = [self.valid_patches, None]
+            else:
+                valid = [self.valid_x, self._targets(self.valid_y)]
+            hvd_callbacks = [PeriodicValidation(valid[0], valid[1],
+                                                self.batch_size,
+                                                self.valid_freq)] + \
+                hvd_callbacks
+
+        if self.prune_mode:
+            # Prune after initial weights are broadcast
+            hvd_callbacks += [Pruning(self.prune_mode, self.prune_schedule,
+                                      self.pruned_path if self.is_chief else None,
+                                      self.hvd if self.distributed else None)]
+
         # Save learning curves in csv file while training
         csv_logger = CSVLogger(self.curves_path,
                                append=True, separator=",")
+        # Save timing and memory of each batch
+        self.throughput = ThroughputLogger(self.throughput_path)
 
         # Set learning rate scheduler
-        lr_scheduler = LearningRateScheduler(self._set_lr_scheduler)
+        if self.lr_schedule == "plateau":
+            lr_scheduler = ReduceLROnPlateau(monitor=self.monitor,
+                                             factor=self.lr_decay,
+                                             patience=self.plateau_patience *
+                                             self.valid_freq,
+                                             min_lr=self.lr_min,
+                                             verbose=1)
+        else:
+            lr_scheduler = LearningRateScheduler(self._set_lr_scheduler)
 
         # Add support for TensorBoard
         tb = TensorBoard(log_dir=self.logs_dir,
                          batch_size=self.batch_size)
-        self.callbacks = [csv_logger, lr_scheduler, tb]
+        if self.is_chief:
+            self.callbacks = hvd_callbacks + [csv_logger, lr_scheduler, tb]
+        else:
+            self.callbacks = hvd_callbacks + [lr_scheduler]
 
-        if self.save_best_weights:
+        if self.save_best_weights and self.is_chief:
             # Save best model while training
-            checkpoint = ModelCheckpoint(filepath=self.best_weights_path,
-                                         monitor="val_loss",
-                                         verbose=0,
-                                         save_best_only=True)
+            checkpoint = AsyncModelCheckpoint(self.writer,
+                                              filepath=self.best_weights_path,
+                                              monitor=self.monitor,
+                                              verbose=0,
+                                              save_best_only=True)
+            if self.best_monitored is not None:
+                # Continue to compare with the best before resuming
+                checkpoint.best = self.best_monitored
             self.callbacks += [checkpoint]
+        else:
+            checkpoint = None
+
+        # Attributes to be saved in checkpoint and restored
+        # when resuming, the order of patches continues
+        tracked = {}
+        if self.lr_schedule == "plateau":
+            tracked["lr_scheduler"] = [lr_scheduler,
+                                       ["wait", "cooldown_counter", "best"]]
+        if self.train_patches is not None:
+            tracked["train_patches"] = [self.train_patches, ["epoch"]]
+
+        if self.early_stopping_patience > 0:
+            # Stop training when validation loss converges
+            early_stopping = EarlyStopping(monitor=self.monitor,
+                                           patience=self.early_stopping_patience *
+                                           self.valid_freq,
+                                           verbose=1)
+            self.callbacks += [early_stopping]
+            tracked["early_stopping"] = [early_stopping, ["wait", "best"]]
+
+        if self.checkpoint_period > 0 and self.is_chief:
+            # Save state of training periodically
+            state = {"batch_size": self.batch_size}
+            self.callbacks += [TrainingCheckpoint(self.writer,
+                                                  self.checkpoint_path,
+                                                  self.checkpoint_period,
+                                                  self.max_checkpoints,
+                                                  checkpoint, state,
+                                                  tracked)]
+
+        # Callbacks reset their state in on_train_begin, thus
+        # state is restored after them, workers follow the chief
+        if self.resume:
+            self.tracked_state = self._broadcast_state(tracked,
+                                                       self.tracked_state)
+        self.callbacks += [CallbackState(tracked, self.tracked_state)]
+        if self.is_chief:
+            # Time of other callbacks is not counted as waiting
+            self.callbacks += [self.throughput]
 
         return
 
@@ -203,19 +922,66 @@ class BTCTrain(object):
 
             Print out metrics (loss and accuracy) of
             training, validation and testing set.
+            Each set is predicted only once, loss is computed
+            from predictions without regularization terms.
+            A random proportion of training set is scored if
+            train_score_frac is less than 1. Predictions are
+            saved in last_pred.npz, with subjects' IDs of each set
+            and hyperparameters, so that BTCTest can reuse them
+            instead of predicting again. If early exit is
+            enabled, metrics of exit1 are also printed, and only
+            predictions of fc3 are saved.
 
         '''
 
-        # Helper function to compute and print metrics
+        # Helper function to predict, compute and print metrics
         def evaluate(x, y, data_str):
-            score = self.model.evaluate(x, y, self.batch_size, 0)
-            print(data_str + " Set: Loss: {0:.4f}, Accuracy: {1:.4f}".format(
-                  score[0], score[1]))
+            if self.patch_shape:
+                pred = sliding_window_predict(self.model, x,
+                                              self.patch_shape,
+                                              self.patch_stride,
+                                              self.batch_size)
+            else:
+                pred = self.model.predict(x, self.batch_size, 0)
+            if self.early_exit:
+                pred, exit_pred = pred
+                metrics(exit_pred, y, data_str + " Set (exit1)")
+            metrics(pred, y, data_str + " Set")
+            return pred
+
+        def metrics(pred, y, name):
+            clipped = np.clip(pred, K.epsilon(), 1 - K.epsilon())
+            loss = -np.mean(np.sum(y * np.log(clipped), axis=1))
+            acc = np.mean(np.argmax(pred, axis=1) == np.argmax(y, axis=1))
+            print(name + ": Loss: {0:.4f}, Accuracy: {1:.4f}".format(
+                  loss, acc))
             return
 
-        evaluate(self.data.train_x, self.data.train_y, "Training")
-        evaluate(self.data.valid_x, self.data.valid_y, "Validation")
-        evaluate(self.data.test_x, self.data.test_y, "Testing")
+        # Inputs are lists of cached outputs in head-only training
+        train_x, train_y = self.data.train_x, self.data.train_y
+        train_num = len(train_y)
+        train_idx = np.arange(train_num)
+        if self.train_score_frac < 1:
+            score_num = max(1, int(round(train_num * self.train_score_frac)))
+            train_idx = np.sort(np.random.choice(train_num, score_num,
+                                                 replace=False))
+            if isinstance(train_x, list):
+                train_x = [x[train_idx] for x in train_x]
+            else:
+                train_x = train_x[train_idx]
+            train_y = train_y[train_idx]
+
+        preds = {"train_idx": train_idx}
+        preds["train"] = evaluate(train_x, train_y, "Training")
+        preds["valid"] = evaluate(self.data.valid_x, self.data.valid_y,
+                                  "Validation")
+        preds["test"] = evaluate(self.data.test_x, self.data.test_y,
+                                 "Testing")
+        for dataset, ids in self.subject_ids.items():
+            if ids is not None:
+                preds[dataset + "_ids"] = np.array(ids)
+        preds["paras"] = np.array(json.dumps(self.paras, sort_keys=True))
+        np.savez(self.last_pred_path, **preds)
 
         return
 
@@ -235,31 +1001,166 @@ class BTCTrain(object):
         print("\nTraining the model.\n")
 
         self.data = data
-
-        # Configurations of model and optimizer
-        self._load_model()
+        # Subjects' IDs are saved with predictions
+        self.subject_ids = {s: getattr(data, s + "_ids", None)
+                            for s in ["train", "valid", "test"]}
+        self.best_monitored = None
+        self.tracked_state = {}
+        self.train_patches = None
+        self.throughput = None
+
+        if self.head_only:
+            if self.distributed:
+                raise ValueError("Head-only training is not distributed.")
+            # Cached outputs of scales replace images
+            data = self.data = self._cache_features(data)
+
+        # Each worker trains on its own shard of training set,
+        # which is reshuffled in each epoch (see ShardSequence),
+        # and validates on its own shard of validation set,
+        # metrics are averaged over workers
+        train_x, train_y = data.train_x, data.train_y
+        train_m = getattr(data, "train_m", None)
+        self.valid_x, self.valid_y = data.valid_x, data.valid_y
+        valid_m = getattr(data, "valid_m", None)
+        if self.distributed:
+            self.valid_x, self.valid_y, valid_m = shard(
+                [self.valid_x, self.valid_y, valid_m], self.rank, self.size)
+
+        if self.patch_shape:
+            # Random patches, validation patches are fixed
+            self.train_patches = PatchSampler(train_x, train_y, train_m,
+                                              self.patch_shape,
+                                              self.batch_size,
+                                              self.patch_tumor_prob,
+                                              rank=self.rank,
+                                              size=self.size)
+            self.valid_patches = PatchSampler(self.valid_x, self.valid_y,
+                                              valid_m,
+                                              self.patch_shape,
+                                              self.batch_size,
+                                              self.patch_tumor_prob,
+                                              fixed=True)
+
+        if self.resume and self.is_chief:
+            # Use the batch size before resuming
+            state = TrainingCheckpoint.load_state(
+                TrainingCheckpoint.latest(self.checkpoint_path))
+            self.batch_size = state["batch_size"]
+        elif self.auto_batch_size and self.is_chief and not self.head_only:
+            # Replace batch size in hyper_paras.json
+            self._find_batch_size()
+        self.batch_size = self._broadcast(self.batch_size, "batch_size")
+
+        # Configurations of session, model and optimizer,
+        # spatial dimensions are not fixed in progressive
+        # resolution training
+        self._set_session()
+        if self.prog_schedule:
+            self._load_model([None, None, None] + self.input_shape[3:])
+        else:
+            self._load_model()
+        # Weights are loaded from checkpoint if resuming
+        self._init_weights(load_weights=not self.resume)
         self._set_optimizer()
+        if self.distributed:
+            # Average gradients over workers in each step
+            self.opt_fcn = self.hvd.DistributedOptimizer(self.opt_fcn)
 
         # Compile model and print its structure
-        self.model.compile(loss="categorical_crossentropy",
-                           optimizer=self.opt_fcn,
-                           metrics=["accuracy"])
-        self.model.summary()
-
-        self._set_callbacks()
-        # Train model
-        self.model.fit(self.data.train_x, self.data.train_y,
-                       batch_size=self.batch_size,
-                       epochs=self.epochs_num,
-                       validation_data=(self.data.valid_x,
-                                        self.data.valid_y),
-                       shuffle=True,
-                       callbacks=self.callbacks)
-
-        # Save model in last epoch
-        self.model.save(self.last_weights_path)
-        # Print metrics
-        self._print_score()
+        self._compile()
+        if self.is_chief:
+            self.model.summary()
+
+        # Write weights in background thread
+        self.writer = AsyncWriter(compression=self.checkpoint_compression)
+        try:
+            initial_epoch = 0
+            if self.resume and self.is_chief:
+                # Restore weights and state from checkpoint, other
+                # workers receive them when training begins
+                initial_epoch = self._load_checkpoint()
+            elif self.head_only:
+                # Fine-tune trained head, layers whose shapes
+                # are changed are initialized as usual
+                self.model.load_weights(self.init_weights_path, by_name=True,
+                                        skip_mismatch=True)
+            initial_epoch = self._broadcast(initial_epoch, "initial_epoch")
+
+            self._set_callbacks()
+            print("Effective batch size:",
+                  self.batch_size * self.accum_steps * self.size)
+            # Validation set is evaluated by callback if valid_freq > 1
+            if self.valid_freq > 1:
+                validation_data = None
+            elif self.patch_shape:
+                validation_data = self.valid_patches
+            else:
+                validation_data = (self.valid_x, self._targets(self.valid_y))
+
+            # Train model in stages of resolution, always validate
+            # in full resolution, "wait" and "best" of callbacks
+            # are kept between stages by CallbackState
+            for start, end, scale in self._stages(initial_epoch):
+                if self.patch_shape:
+                    # Only one stage in patch training
+                    self.model.fit_generator(self.train_patches,
+                                             epochs=end,
+                                             initial_epoch=start,
+                                             validation_data=validation_data,
+                                             callbacks=self.callbacks,
+                                             verbose=1 if self.is_chief else 0)
+                    break
+
+                stage_x = train_x if scale == 1 else \
+                    BTCDataset.rescale(train_x, scale)
+                if self.prog_schedule:
+                    print("Epoch {0} to {1}: input size {2}".format(
+                          start + 1, end, list(stage_x.shape[1:])))
+                if self.distributed:
+                    # Shard of each worker is reshuffled in each epoch
+                    shards = ShardSequence(stage_x, train_y, self.batch_size,
+                                           self.rank, self.size, epoch=start,
+                                           targets=self._targets)
+                    self.model.fit_generator(shards,
+                                             epochs=end,
+                                             initial_epoch=start,
+                                             validation_data=validation_data,
+                                             callbacks=self.callbacks,
+                                             verbose=1 if self.is_chief else 0)
+                else:
+                    self.model.fit(stage_x, self._targets(train_y),
+                                   batch_size=self.batch_size,
+                                   epochs=end,
+                                   initial_epoch=start,
+                                   validation_data=validation_data,
+                                   shuffle=True,
+                                   callbacks=self.callbacks,
+                                   verbose=1 if self.is_chief else 0)
+                del stage_x
+                if self.model.stop_training:
+                    # Stopped by EarlyStopping
+                    break
+
+            if self.is_chief and self.head_only:
+                # Save whole model with trained head
+                self._merge_head()
+            elif self.is_chief:
+                # Save model in last epoch
+                self.writer.save(self.model, self.last_weights_path)
+
+            # Wait for all weights to be written, thus predictions
+            # are saved after weights of the last epoch
+            self.writer.flush()
+            if self.is_chief:
+                # Print metrics
+                self._print_score()
+        finally:
+            # Stop background thread and close files
+            # even if training fails
+            self.writer.close()
+            if self.throughput is not None:
+                self.throughput.close()
 
         # Destroy the current TF graph
         K.clear_session()
@@ -315,7 +1216,8 @@ class BTCTrain(object):
         return
 
 
-def main(hyper_paras_name):
+def main(hyper_paras_name, resume=False, args=None,
+         workers_num=1, hosts=None):
     '''MAIN
 
         Main process to train model.
@@ -325,10 +1227,21 @@ def main(hyper_paras_name):
 
         - hyper_paras_name: string, the name of hyperparameters set,
                             which can be found in hyper_paras.json.
+        - resume: boolean, if True, continue training from checkpoint.
+        - args: argparse Namespace, session settings from command
+                line which override pre_paras.json. Default is None.
+        - workers_num: int, the number of workers in data parallel
+                       training. If it is larger than 1, this script
+                       is started again in each worker by horovodrun.
+        - hosts: string, hosts and slots of workers such as
+                 "h1:2,h2:2", default is None, which means localhost.
 
     '''
 
-    from btc_dataset import BTCDataset
+    if workers_num > 1 and not is_launched():
+        # Start workers, which run this function with is_launched()
+        launch(workers_num, hosts)
+        return
 
     # Basic settings in pre_paras.json, including
     # 1. directory paths for input and output
@@ -350,22 +1263,17 @@ def main(hyper_paras_name):
     logs_save_dir = os.path.join(parent_dir, pre_paras["logs_save_dir"])
 
     # Partition dataset
-    data = BTCDataset(hgg_dir, lgg_dir,
-                      volume_type=pre_paras["volume_type"],
-                      pre_trainset_path=pre_paras["pre_trainset_path"],
-                      pre_validset_path=pre_paras["pre_validset_path"],
-                      pre_testset_path=pre_paras["pre_testset_path"],
-                      data_format=pre_paras["data_format"])
-    data.run(pre_split=pre_paras["pre_split"],
-             save_split=pre_paras["save_split"],
-             save_split_dir=pre_paras["save_split_dir"])
+    data = load_dataset(hgg_dir, lgg_dir, pre_paras)
 
     # Train the model
     train = BTCTrain(paras_name=hyper_paras_name,
                      paras_json_path=pre_paras["paras_json_path"],
                      weights_save_dir=weights_save_dir,
                      logs_save_dir=logs_save_dir,
-                     save_best_weights=pre_paras["save_best_weights"])
+                     save_best_weights=pre_paras["save_best_weights"],
+                     resume=resume,
+                     session_paras=session_paras(pre_paras, args),
+                     distributed=is_launched())
     train.run(data)
 
 
@@ -373,6 +1281,10 @@ if __name__ == "__main__":
 
     # Command line
     # python btc_train.py --paras=paras-1
+    # python btc_train.py --paras=paras-1 --resume
+    # python btc_train.py --paras=paras-1 --intra_op_threads=8 --cpu_affinity=0-7
+    # python btc_train.py --paras=paras-1 --workers=4
+    # python btc_train.py --paras=paras-1 --workers=4 --hosts=h1:2,h2:2
 
     parser = argparse.ArgumentParser()
 
@@ -380,6 +1292,17 @@ if __name__ == "__main__":
     help_str = "Select a set of hyper-parameters in hyper_paras.json."
     parser.add_argument("--paras", action="store", default="paras-1",
                         dest="hyper_paras_name", help=help_str)
+    help_str = "Continue training from the last checkpoint."
+    parser.add_argument("--resume", action="store_true", default=False,
+                        dest="resume", help=help_str)
+    help_str = "Number of workers in data parallel training."
+    parser.add_argument("--workers", action="store", type=int, default=1,
+                        dest="workers_num", help=help_str)
+    help_str = "Hosts and slots of workers, such as h1:2,h2:2."
+    parser.add_argument("--hosts", action="store", default=None,
+                        dest="hosts", help=help_str)
+    add_session_args(parser)
 
     args = parser.parse_args()
-    main(args.hyper_paras_name)
+    main(args.hyper_paras_name, args.resume, args,
+         args.workers_num, args.hosts)
@@ -0,0 +1,14 @@
+# Brain Tumor Classification
+# Settings of tests, modules are imported from src.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+
+import os
+import sys
+
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "src")
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
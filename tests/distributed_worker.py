@@ -0,0 +1,47 @@
+# Brain Tumor Classification
+# Worker of data-parallel test, started by horovodrun.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "src"))
+
+import numpy as np
+from keras.layers import Dense
+from keras.optimizers import SGD
+from keras.models import Sequential
+from btc_distributed import import_horovod, ShardSequence
+
+
+def main(output_dir):
+    # Train a tiny model on the shard of this worker
+    # for one step and save its weights
+    hvd = import_horovod()
+    hvd.init()
+
+    # Initial weights differ in workers, they are
+    # replaced by weights of the first worker
+    np.random.seed(hvd.rank())
+    model = Sequential([Dense(2, activation="softmax", input_shape=(4,))])
+    model.compile(loss="categorical_crossentropy",
+                  optimizer=hvd.DistributedOptimizer(SGD(lr=0.1)))
+
+    rng = np.random.RandomState(0)
+    x = rng.rand(9, 4).astype(np.float32)
+    y = np.eye(2)[rng.randint(0, 2, 9)]
+    shards = ShardSequence(x, y, 8, hvd.rank(), hvd.size())
+    model.fit_generator(shards, epochs=1, verbose=0,
+                        callbacks=[hvd.callbacks.
+                                   BroadcastGlobalVariablesCallback(0)])
+
+    np.savez(os.path.join(output_dir, "{}.npz".format(hvd.rank())),
+             *model.get_weights())
+    return
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
@@ -0,0 +1,29 @@
+# Brain Tumor Classification
+# Check parity of inference backends on a random model.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+
+import os
+import json
+import pytest
+
+pytest.importorskip("keras")
+pytest.importorskip("tf2onnx")
+pytest.importorskip("onnxruntime")
+
+from conftest import SRC_DIR
+from btc_backends import parity
+
+
+def test_onnx_parity_random_weights(tmpdir):
+    # A narrow model in paras-1, weights are randomly initialized
+    paras = json.load(open(os.path.join(SRC_DIR, "hyper_paras.json")))
+    tiny = dict(paras["paras-1"], width_mult=0.25)
+    paras_json_path = str(tmpdir.join("hyper_paras.json"))
+    json.dump({"tiny": tiny}, open(paras_json_path, "w"))
+
+    res_df = parity("tiny", paras_json_path, str(tmpdir), weights=None,
+                    backends=["onnx"], samples_num=2, repeats=1)
+    assert list(res_df["backend"]) == ["keras", "onnx"]
+    assert res_df["max_diff"].max() <= 1e-4
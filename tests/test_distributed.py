@@ -0,0 +1,52 @@
+# Brain Tumor Classification
+# Check sharding and data-parallel training with Horovod.
+# Author: Qixun QU
+# Copyleft: MIT Licience
+
+
+import os
+import shutil
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("keras")
+
+from btc_distributed import shard, shard_indices, launch
+
+
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "distributed_worker.py")
+
+
+def test_shard_indices_cover_all_samples():
+    total, size = 10, 3
+    for epoch in range(2):
+        shards = [shard_indices(total, rank, size, epoch)
+                  for rank in range(size)]
+        # Workers run the same number of steps
+        assert len(set(len(s) for s in shards)) == 1
+        assert set(np.concatenate(shards)) == set(range(total))
+
+    # Shards are reshuffled in each epoch
+    assert not np.array_equal(shard_indices(total, 0, size, 0),
+                              shard_indices(total, 0, size, 1))
+
+
+def test_shard_splits_validation_set():
+    x = np.arange(7)
+    shards = [shard([x, None], rank, 2) for rank in range(2)]
+    assert [s[1] for s in shards] == [None, None]
+    assert sorted(np.concatenate([s[0] for s in shards])) == list(x)
+
+
+def test_workers_share_weights_after_step(tmpdir):
+    pytest.importorskip("horovod.keras")
+    if shutil.which("horovodrun") is None:
+        pytest.skip("horovodrun is not found")
+
+    assert launch(2, argv=[WORKER_PATH, str(tmpdir)]) == 0
+
+    weights = [np.load(str(tmpdir.join("{}.npz".format(rank))))
+               for rank in range(2)]
+    for key in weights[0].files:
+        assert np.allclose(weights[0][key], weights[1][key])